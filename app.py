@@ -1,29 +1,276 @@
-import requests
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, send_file
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, session, jsonify, has_request_context, g, stream_with_context
 from functools import wraps
+from contextlib import contextmanager
 import os
-from openai import OpenAI
 import io
 import json
 import base64
-from datetime import datetime
+import hashlib
+import heapq
+import math
+import random
+import tempfile
+import re
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
 from bson.json_util import dumps
 from bson.objectid import ObjectId
+from bson.binary import Binary
+from bson import BSON
 import certifi
-from pymongo import MongoClient
-import numpy as np 
-from fpdf import FPDF
-
+import click
+import gridfs
+from pymongo import MongoClient, UpdateOne, ReplaceOne, DeleteMany, ReturnDocument, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from werkzeug.local import LocalProxy
+import numpy as np
+
+# Cold starts only pay for what the first requests use: openai, httpx, fpdf, joblib,
+# tiktoken and redis are imported inside the functions that need them, and Mongo and
+# OpenAI clients are created on first use (see get_db and get_openai_client). numpy is
+# imported up front; it is cheap next to those, and deferring it was not thread-safe.
+# `python benchmark.py --startup-only` reports the import time.
 app = Flask(__name__)
 app.secret_key = '123'
-client = MongoClient(
-    "uri",
-    tls=True,
-    tlsCAFile=certifi.where()
-)
-db = client['NoteSync']
-users_collection = db['user_data']
-notes_collection = db['notes']
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get("MAX_UPLOAD_BYTES", 200 * 1024 * 1024))
+
+
+class Histogram:
+    """Prometheus-style histogram keyed by label values."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.setdefault(label_values, {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, series in sorted(self.series.items()):
+                labels = ','.join(f'{key}="{value}"' for key, value in zip(self.labels, label_values))
+                for bound, count in zip(self.BUCKETS, series['buckets']):
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series["count"]}')
+                lines.append(f'{self.name}_sum{{{labels}}} {series["sum"]:.6f}')
+                lines.append(f'{self.name}_count{{{labels}}} {series["count"]}')
+        return lines
+
+class Counter:
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount, *label_values):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                labels = ','.join(f'{key}="{value}"' for key, value in zip(self.labels, label_values))
+                lines.append(f'{self.name}{{{labels}}} {value}')
+        return lines
+
+request_seconds = Histogram('flowsync_request_seconds', 'Time spent in each route.', ('route', 'status'))
+stage_seconds = Histogram('flowsync_stage_seconds', 'Time spent in each stage of a route.', ('route', 'stage'))
+model_calls = Counter('flowsync_model_calls_total', 'Model API calls.', ('model', 'outcome'))
+model_tokens = Counter('flowsync_model_tokens_total', 'Tokens reported by the model API.', ('model', 'kind'))
+model_bytes = Counter('flowsync_model_bytes_total', 'Approximate payload bytes sent to and received from the model API.', ('model', 'direction'))
+METRICS = [request_seconds, stage_seconds, model_calls, model_tokens, model_bytes]
+
+def current_route():
+    if has_request_context() and request.endpoint:
+        return request.endpoint
+    return 'background'
+
+@contextmanager
+def span(stage):
+    """Time a block of work as one stage of the current route."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, current_route(), stage)
+
+class _TimedCursor:
+    """Cursor proxy that times iteration (where Mongo actually does the work) as a 'mongo' stage."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        attribute = getattr(self.cursor, name)
+        if name in ('sort', 'limit', 'skip', 'batch_size', 'hint'):
+            def chain(*args, **kwargs):
+                attribute(*args, **kwargs)
+                return self
+            return chain
+        return attribute
+
+    def __iter__(self):
+        # Documents stream batch by batch; only the time spent waiting on the cursor
+        # is summed, and recorded once when iteration ends.
+        route = current_route()
+        waited = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    document = next(self.cursor)
+                except StopIteration:
+                    return
+                finally:
+                    waited += time.perf_counter() - started
+                yield document
+        finally:
+            stage_seconds.observe(waited, route, 'mongo')
+
+class InstrumentedCollection:
+    """Collection proxy that records every call as a 'mongo' stage.
+
+    It wraps pymongo and stand-ins such as mongomock alike.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        attribute = getattr(self.collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def timed(*args, **kwargs):
+            with span('mongo'):
+                result = attribute(*args, **kwargs)
+            if name == 'find' or name == 'aggregate':
+                return _TimedCursor(result)
+            return result
+        return timed
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    if 'request_started' in g:
+        request_seconds.observe(time.perf_counter() - g.request_started, current_route(), str(response.status_code))
+    return response
+
+class LRUCache:
+    """Thread-safe LRU map with an optional per-entry TTL and hit/miss counters."""
+
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[1] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return None if entry is None else entry[0]
+
+    def pop_where(self, predicate):
+        """Drop every entry whose value matches predicate and return how many were dropped."""
+        with self.lock:
+            keys = [key for key, (value, _) in self.entries.items() if predicate(value)]
+            for key in keys:
+                del self.entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+_mongo_client = None
+_gridfs_buckets = {}
+_clients_lock = threading.Lock()
+
+def get_db():
+    """The NoteSync database; the client is created by the first call in each process."""
+    global _mongo_client
+    if _mongo_client is None:
+        with _clients_lock:
+            if _mongo_client is None:
+                _mongo_client = MongoClient(
+                    os.environ.get("MONGO_URI", "uri"),
+                    tls=True,
+                    tlsCAFile=certifi.where(),
+                    maxPoolSize=int(os.environ.get("MONGO_MAX_POOL_SIZE", 50)),
+                    minPoolSize=int(os.environ.get("MONGO_MIN_POOL_SIZE", 0)),
+                    maxIdleTimeMS=int(os.environ.get("MONGO_MAX_IDLE_MS", 60000)),
+                    connectTimeoutMS=int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 5000)),
+                    serverSelectionTimeoutMS=int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000)),
+                    socketTimeoutMS=int(os.environ.get("MONGO_SOCKET_TIMEOUT_MS", 30000)),
+                    waitQueueTimeoutMS=int(os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000))
+                )
+    return _mongo_client['NoteSync']
+
+def get_gridfs(collection):
+    bucket = _gridfs_buckets.get(collection)
+    if bucket is None:
+        bucket = _gridfs_buckets.setdefault(collection, gridfs.GridFS(get_db(), collection=collection))
+    return bucket
+
+db = LocalProxy(get_db)
+users_collection = InstrumentedCollection(LocalProxy(lambda: get_db()['user_data']))
+notes_collection = InstrumentedCollection(LocalProxy(lambda: get_db()['notes']))
+jobs_collection = InstrumentedCollection(LocalProxy(lambda: get_db()['jobs']))
+tasks_collection = InstrumentedCollection(LocalProxy(lambda: get_db()['tasks']))
+artifact_queue_collection = InstrumentedCollection(LocalProxy(lambda: get_db()['artifact_queue']))
+embedding_cache_collection = InstrumentedCollection(LocalProxy(lambda: get_db()['embedding_cache']))
+audio_fs = LocalProxy(lambda: get_gridfs('audio'))
+exports_fs = LocalProxy(lambda: get_gridfs('exports'))
 openai_api_key = os.environ.get("api_key")
 if not openai_api_key:
     openai_api_key = "key"
@@ -31,8 +278,302 @@ if not openai_api_key:
 if not openai_api_key:
     raise ValueError("api key err.")
 
-openai_client = OpenAI(api_key=openai_api_key)
+# OpenAI calls share one keep-alive connection pool, have hard timeouts, and are
+# capped both globally and per user so a slow model can't tie up every worker.
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", 60))
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 32))
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", 16))
+OPENAI_MAX_CONCURRENCY_PER_USER = int(os.environ.get("OPENAI_MAX_CONCURRENCY_PER_USER", 4))
+OPENAI_QUEUE_TIMEOUT = float(os.environ.get("OPENAI_QUEUE_TIMEOUT", 30))
+# Users whose per-user slots are remembered. Only idle users should fall out, so keep
+# it well above the number of users active within a few seconds of each other.
+OPENAI_SLOT_USERS = int(os.environ.get("OPENAI_SLOT_USERS", 10000))
+# Seconds a client told to back off (503) should wait before retrying.
+OPENAI_BUSY_RETRY_AFTER = int(os.environ.get("OPENAI_BUSY_RETRY_AFTER", 5))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", 3))
+
+class OpenAIBusyError(Exception):
+    pass
+
+@app.errorhandler(OpenAIBusyError)
+def openai_busy(error):
+    response = jsonify({'error': str(error)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(OPENAI_BUSY_RETRY_AFTER)
+    return response
+
+def error_response(error):
+    """What a route's catch-all returns: 503 with Retry-After when the model API is saturated, else 500."""
+    if isinstance(error, OpenAIBusyError):
+        return openai_busy(error)
+    return jsonify({'error': str(error)}), 500
+
+def retryable_openai_errors():
+    import openai
+    return (
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+        openai.RateLimitError,
+        openai.InternalServerError
+    )
+
+openai_slots = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+user_openai_slots = LRUCache(OPENAI_SLOT_USERS)
+user_openai_slots_lock = threading.Lock()
+
+def _acquire_openai_slots():
+    """Take a global slot and, inside a request, one of the user's slots. Returns the slots held."""
+    held = []
+    slots = [openai_slots]
+    username = session.get('username') if has_request_context() else None
+    if username:
+        with user_openai_slots_lock:
+            user_slots = user_openai_slots.get(username)
+            if user_slots is None:
+                user_slots = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY_PER_USER)
+                user_openai_slots.put(username, user_slots)
+        slots.append(user_slots)
+    for slot in slots:
+        if not slot.acquire(timeout=OPENAI_QUEUE_TIMEOUT):
+            for taken in held:
+                taken.release()
+            raise OpenAIBusyError("Too many AI requests in flight. Please try again shortly.")
+        held.append(slot)
+    return held
+
+def _retry_delay(attempt, error):
+    retry_after = getattr(getattr(error, 'response', None), 'headers', {}).get('retry-after')
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    # Exponential backoff with full jitter, capped at 20s.
+    return random.uniform(0, min(20, 0.5 * 2 ** attempt))
+
+def call_openai(method, **kwargs):
+    """Call an OpenAI SDK method under the concurrency limits, retrying transient errors."""
+    held = _acquire_openai_slots()
+    released = False
+    try:
+        model = kwargs.get('model', 'unknown')
+        model_bytes.inc(_request_bytes(kwargs), model, 'request')
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            try:
+                with span('openai'):
+                    result = method(**kwargs)
+                break
+            except retryable_openai_errors() as e:
+                model_calls.inc(1, model, 'retry')
+                if attempt == OPENAI_MAX_RETRIES:
+                    model_calls.inc(1, model, 'error')
+                    raise
+                print(f"OpenAI call failed ({e.__class__.__name__}), retrying (attempt {attempt + 1})")
+                time.sleep(_retry_delay(attempt, e))
+                upload = kwargs.get('file')
+                if hasattr(upload, 'seek'):
+                    upload.seek(0)
+
+        model_calls.inc(1, model, 'ok')
+        if kwargs.get('stream'):
+            # Keep the slots until the caller has finished reading the stream.
+            released = True
+            return _hold_slots_while_streaming(result, held, model)
+        _record_usage(model, getattr(result, 'usage', None))
+        model_bytes.inc(_response_bytes(result), model, 'response')
+        return result
+    finally:
+        if not released:
+            for slot in held:
+                slot.release()
+
+def _hold_slots_while_streaming(stream, held, model):
+    try:
+        for chunk in stream:
+            _record_usage(model, getattr(chunk, 'usage', None))
+            if getattr(chunk, 'choices', None) and chunk.choices[0].delta.content:
+                model_bytes.inc(len(chunk.choices[0].delta.content.encode('utf-8')), model, 'response')
+            yield chunk
+    finally:
+        for slot in held:
+            slot.release()
+
+def _record_usage(model, usage):
+    if usage is None:
+        return
+    model_tokens.inc(getattr(usage, 'prompt_tokens', 0) or 0, model, 'prompt')
+    model_tokens.inc(getattr(usage, 'completion_tokens', 0) or 0, model, 'completion')
+
+def _request_bytes(kwargs):
+    size = len(json.dumps({key: value for key, value in kwargs.items() if key != 'file'}, default=str))
+    upload = kwargs.get('file')
+    if hasattr(upload, 'fileno'):
+        size += os.fstat(upload.fileno()).st_size
+    return size
+
+def _response_bytes(result):
+    if hasattr(result, 'model_dump_json'):
+        return len(result.model_dump_json())
+    if hasattr(result, 'text') and isinstance(result.text, str):
+        return len(result.text.encode('utf-8'))
+    return 0
+
+class _ManagedResource:
+    def __init__(self, resource):
+        self.resource = resource
+
+    def create(self, **kwargs):
+        return call_openai(self.resource.create, **kwargs)
+
+class ManagedOpenAI:
+    """Exposes the parts of the OpenAI client the app uses, with every call routed through call_openai."""
+
+    def __init__(self, raw_client):
+        self.raw_client = raw_client
+        self.embeddings = _ManagedResource(raw_client.embeddings)
+        self.chat = _Namespace(completions=_ManagedResource(raw_client.chat.completions))
+        self.audio = _Namespace(transcriptions=_ManagedResource(raw_client.audio.transcriptions))
+
+class _Namespace:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+_openai_client = None
+
+def get_openai_client():
+    """The shared ManagedOpenAI client; the SDK is imported and configured by the first call."""
+    global _openai_client
+    if _openai_client is None:
+        with _clients_lock:
+            if _openai_client is None:
+                import httpx
+                from openai import OpenAI
+                _openai_client = ManagedOpenAI(OpenAI(
+                    api_key=openai_api_key,
+                    timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=5.0),
+                    max_retries=0,
+                    http_client=httpx.Client(
+                        limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS),
+                        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=5.0)
+                    )
+                ))
+    return _openai_client
+
+openai_client = LocalProxy(get_openai_client)
 FINE_TUNED_MODEL_ID = "enter your model file/id"
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Users with more embedded notes than this are searched through the IVF
+# (approximate) path instead of a full matrix-vector product.
+VECTOR_INDEX_IVF_THRESHOLD = int(os.environ.get("VECTOR_INDEX_IVF_THRESHOLD", 20000))
+VECTOR_INDEX_IVF_NPROBE = int(os.environ.get("VECTOR_INDEX_IVF_NPROBE", 8))
+# Indexes are per process, so rebuild them from Mongo every so often to pick up
+# writes made by other workers.
+VECTOR_INDEX_TTL = int(os.environ.get("VECTOR_INDEX_TTL", 300))
+# Users whose vector and keyword indexes are kept in memory; the least recently
+# searched are dropped.
+VECTOR_INDEX_CACHE_USERS = int(os.environ.get("VECTOR_INDEX_CACHE_USERS", 200))
+# The semantic map is built server-side from the vector index: each note keeps
+# edges to its GRAPH_NEIGHBOURS most similar notes. Small edits are patched in;
+# once more than GRAPH_REBUILD_FRACTION of the notes have changed it is rebuilt.
+GRAPH_NEIGHBOURS = int(os.environ.get("GRAPH_NEIGHBOURS", 5))
+# semantic_search modes: "vector" (embeddings), "keyword" (local BM25, no API call)
+# and "hybrid", which blends both scores with HYBRID_ALPHA weight on the vector side.
+SEARCH_MODES = ('vector', 'keyword', 'hybrid')
+SEARCH_MAX_RESULTS = int(os.environ.get("SEARCH_MAX_RESULTS", 50))
+HYBRID_ALPHA = float(os.environ.get("HYBRID_ALPHA", 0.5))
+KEYWORD_FIELD_WEIGHTS = {'title': 2, 'tags': 2, 'summary': 1, 'transcript': 1}
+GRAPH_MAX_CLUSTERS = int(os.environ.get("GRAPH_MAX_CLUSTERS", 12))
+GRAPH_REBUILD_FRACTION = float(os.environ.get("GRAPH_REBUILD_FRACTION", 0.2))
+GRAPH_CACHE_USERS = int(os.environ.get("GRAPH_CACHE_USERS", 200))
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 100))
+# Note embeddings are stored as packed little-endian binary instead of BSON float
+# arrays. "int8" quantizes them to a quarter of that again, and EMBEDDING_DIMENSIONS
+# keeps only the leading dimensions (text-embedding-3 is Matryoshka-trained),
+# renormalized. Run `flask migrate-embeddings` after changing either.
+EMBEDDING_STORAGE = os.environ.get("EMBEDDING_STORAGE", "float32")
+EMBEDDING_DIMENSIONS = int(os.environ.get("EMBEDDING_DIMENSIONS", 0))
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000))
+EMBEDDING_CACHE_TTL = int(os.environ.get("EMBEDDING_CACHE_TTL", 30 * 24 * 3600))
+# Each note records, per derived artifact, a hash of the inputs it was built from and
+# the model version that built it. Edits queue only the artifacts whose inputs
+# changed; `flask sweep-artifacts` also queues notes built by an older version, a
+# bounded number per run, so a new EMBEDDING_MODEL rolls out gradually.
+TASKS_ARTIFACT_VERSION = 1
+ARTIFACT_SWEEP_BATCH = int(os.environ.get("ARTIFACT_SWEEP_BATCH", 100))
+# Summaries and common topics are reused for identical inputs. Bump a prompt
+# version whenever its prompt text changes so older entries stop matching.
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 2000))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 24 * 3600))
+SUMMARY_PROMPT_VERSION = 1
+TOPIC_PROMPT_VERSION = 1
+AUDIO_STREAM_CHUNK_SIZE = 256 * 1024
+UPLOAD_TMP_DIR = os.environ.get("UPLOAD_TMP_DIR")
+ALLOWED_AUDIO_EXTENSIONS = {'webm', 'mp3', 'wav', 'm4a', 'mp4', 'aac', 'flac', 'ogg'}
+
+# Recordings longer than TRANSCRIPTION_CHUNK_SECONDS are cut into overlapping
+# pieces (needs ffmpeg) and transcribed concurrently.
+TRANSCRIPTION_BACKEND = os.environ.get("TRANSCRIPTION_BACKEND", "whisper")
+TRANSCRIPTION_CHUNK_SECONDS = int(os.environ.get("TRANSCRIPTION_CHUNK_SECONDS", 300))
+TRANSCRIPTION_OVERLAP_SECONDS = int(os.environ.get("TRANSCRIPTION_OVERLAP_SECONDS", 3))
+TRANSCRIPTION_WORKERS = int(os.environ.get("TRANSCRIPTION_WORKERS", 4))
+
+# Idrak only sees the notes most relevant to the question, within a token budget,
+# and older turns of long conversations are folded into a summary.
+IDRAK_CONTEXT_NOTES = int(os.environ.get("IDRAK_CONTEXT_NOTES", 8))
+IDRAK_CONTEXT_TOKENS = int(os.environ.get("IDRAK_CONTEXT_TOKENS", 6000))
+IDRAK_HISTORY_TOKENS = int(os.environ.get("IDRAK_HISTORY_TOKENS", 2000))
+IDRAK_RECENT_TURNS = int(os.environ.get("IDRAK_RECENT_TURNS", 6))
+HISTORY_SUMMARY_MODEL = "gpt-3.5-turbo"
+
+# generate_common_topic sends small selections as one prompt. Larger ones, or
+# mode=digest, are summarized as a tree: groups of about DIGEST_FAN_IN notes, then
+# groups of those digests, up to one root. Every group's digest is cached, and
+# group boundaries depend only on the members, so a changed selection re-runs
+# just the groups it touches. Groups not done within DIGEST_TIMEOUT are stood in
+# for by their titles (and keep running, so the next call finds them cached); the
+# levels above them are then stood in for without a call, up to the root.
+DIGEST_MODEL = "gpt-3.5-turbo"
+DIGEST_PROMPT_VERSION = 1
+DIGEST_FAN_IN = int(os.environ.get("DIGEST_FAN_IN", 8))
+DIGEST_DIRECT_TOKENS = int(os.environ.get("DIGEST_DIRECT_TOKENS", 3000))
+DIGEST_NOTE_CHARS = int(os.environ.get("DIGEST_NOTE_CHARS", 1500))
+DIGEST_WORKERS = int(os.environ.get("DIGEST_WORKERS", 4))
+DIGEST_TIMEOUT = float(os.environ.get("DIGEST_TIMEOUT", 20))
+
+# Local TF-IDF + LogisticRegression tagger (see logisticRegression.ipynb), trained
+# with `flask train-classifier`. Below the threshold, tags come from the LLM.
+CLASSIFIER_DIR = os.environ.get("CLASSIFIER_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "models"))
+CLASSIFIER_THRESHOLD = float(os.environ.get("CLASSIFIER_THRESHOLD", 0.6))
+CLASSIFIER_DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "note_classification_dataset.jsonl")
+
+# Per-user vault metadata (note count, tag counts, last modified). The local backend
+# is per process; the redis backend is shared by all workers. Either way an entry is
+# only used while its version matches the vault version stored in Mongo.
+USER_CACHE_BACKEND = os.environ.get("USER_CACHE_BACKEND", "local")
+USER_CACHE_REDIS_URL = os.environ.get("USER_CACHE_REDIS_URL", "redis://localhost:6379/0")
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 1000))
+USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 60))
+
+NOTES_PAGE_SIZE = 50
+NOTES_MAX_PAGE_SIZE = 200
+NOTE_CARD_FIELDS = ['title', 'summary', 'tags', 'timestamp', 'embedding_model']
+NOTE_OPTIONAL_FIELDS = {'transcript', 'detected_tasks', 'is_timeline'}
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_STAGE_RETRIES = int(os.environ.get("JOB_STAGE_RETRIES", 3))
+
+# PDF exports are rendered by fpdf2 with this TrueType font so any script prints.
+# Without it (or one of the fallbacks) they use Helvetica and non-Latin-1
+# characters become '?'. Bump the template version when the layout changes.
+PDF_FONT_PATH = os.environ.get("PDF_FONT_PATH")
+PDF_FONT_FALLBACKS = [
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/dejavu/DejaVuSans.ttf',
+    '/Library/Fonts/Arial Unicode.ttf',
+    'C:\\Windows\\Fonts\\arial.ttf'
+]
+PDF_TEMPLATE_VERSION = 1
 
 def login_required(f):
     """Decorator to ensure user is logged in."""
@@ -44,6 +585,1253 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+
+class VectorIndex:
+    """In-memory embedding index for one user's notes."""
+
+    def __init__(self, dim=None):
+        self.dim = dim
+        self.ids = []
+        self.positions = {}
+        self.matrix = np.empty((0, dim or 0), dtype=np.float32)
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.built_at = time.time()
+        self.lock = threading.Lock()
+        self.centroids = None
+        self.assignments = None
+        self.changes_since_ivf = 0
+        self.version = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def is_expired(self):
+        return time.time() - self.built_at > VECTOR_INDEX_TTL
+
+    def _normalize(self, embedding):
+        vector = np.asarray(embedding, dtype=np.float32).ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _grow(self, size):
+        capacity = self.matrix.shape[0]
+        if size <= capacity:
+            return
+        new_capacity = max(size, capacity * 2, 64)
+        matrix = np.empty((new_capacity, self.dim), dtype=np.float32)
+        matrix[:len(self.ids)] = self.matrix[:len(self.ids)]
+        self.matrix = matrix
+        hashes = np.empty(new_capacity, dtype=np.uint64)
+        hashes[:len(self.ids)] = self.hashes[:len(self.ids)]
+        self.hashes = hashes
+        if self.assignments is not None:
+            assignments = np.full(new_capacity, -1, dtype=np.int32)
+            assignments[:len(self.ids)] = self.assignments[:len(self.ids)]
+            self.assignments = assignments
+
+    def upsert(self, note_id, embedding):
+        vector = self._normalize(embedding)
+        with self.lock:
+            if self.dim is None:
+                self.dim = vector.shape[0]
+                self.matrix = np.empty((0, self.dim), dtype=np.float32)
+                self.hashes = np.empty(0, dtype=np.uint64)
+                self.centroids = None
+                self.assignments = None
+            if vector.shape[0] != self.dim:
+                print(f"Skipping embedding of note {note_id}: {vector.shape[0]} dimensions, index has {self.dim}")
+                return
+            row = self.positions.get(note_id)
+            if row is None:
+                row = len(self.ids)
+                self._grow(row + 1)
+                self.ids.append(note_id)
+                self.positions[note_id] = row
+            self.matrix[row] = vector
+            # Lets a SemanticGraph spot changed rows without keeping its own copy of the matrix.
+            self.hashes[row] = int.from_bytes(hashlib.blake2b(vector.tobytes(), digest_size=8).digest(), 'little')
+            if self.centroids is not None:
+                self.assignments[row] = int(np.argmax(self.centroids @ vector))
+            self.changes_since_ivf += 1
+            self.version += 1
+
+    def get_vector(self, note_id):
+        with self.lock:
+            row = self.positions.get(note_id)
+            return None if row is None else self.matrix[row].copy()
+
+    def _build_ivf(self, iterations=10):
+        """Cluster the rows with a few rounds of k-means (spherical, on a sample)."""
+        size = len(self.ids)
+        vectors = self.matrix[:size]
+        n_lists = max(1, int(np.sqrt(size)))
+        rng = np.random.default_rng(0)
+        sample = vectors[rng.choice(size, min(size, n_lists * 64), replace=False)]
+        self.centroids, _ = spherical_kmeans(sample, n_lists, iterations)
+        self.assignments = np.full(self.matrix.shape[0], -1, dtype=np.int32)
+        self.assignments[:size] = np.argmax(vectors @ self.centroids.T, axis=1)
+        self.changes_since_ivf = 0
+
+    def search(self, query_embedding, k, exclude_id=None, approximate=None):
+        """Return up to k (note_id, score) pairs, best first."""
+        query = self._normalize(query_embedding)
+        with self.lock:
+            size = len(self.ids)
+            if not size or query.shape[0] != self.dim:
+                return []
+            if approximate is None:
+                approximate = size >= VECTOR_INDEX_IVF_THRESHOLD
+            if approximate and (self.centroids is None or self.changes_since_ivf > size // 5):
+                self._build_ivf()
+
+            if approximate:
+                probes = np.argsort(self.centroids @ query)[::-1][:VECTOR_INDEX_IVF_NPROBE]
+                rows = np.flatnonzero(np.isin(self.assignments[:size], probes))
+            else:
+                rows = np.arange(size)
+            scores = self.matrix[rows] @ query
+
+            exclude_row = self.positions.get(exclude_id)
+            if exclude_row is not None:
+                scores[rows == exclude_row] = -np.inf
+
+            k = min(k, len(rows))
+            if k <= 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(self.ids[rows[i]], float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+
+def spherical_kmeans(vectors, n_clusters, iterations=10):
+    """k-means on unit vectors by cosine similarity. Returns (centroids, labels)."""
+    rng = np.random.default_rng(0)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        labels = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.eye(n_clusters, dtype=np.float32)[labels].T @ vectors
+        norms = np.linalg.norm(sums, axis=1)
+        filled = norms > 0
+        centroids[filled] = sums[filled] / norms[filled, None]
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+vector_indexes = LRUCache(VECTOR_INDEX_CACHE_USERS)
+
+def indexed_embedding_filter(username):
+    """Notes whose vectors get_vector_index loads (verify-indexes explains the same query).
+
+    Vectors from an older model are left out until the sweeper re-embeds them; untagged
+    legacy vectors predate model switches and stay in.
+    """
+    return {'username': username, 'embedding': {'$exists': True}, 'embedding_model': {'$in': [EMBEDDING_MODEL, None]}}
+
+def get_vector_index(username):
+    """Return the user's vector index, loading it from Mongo if needed."""
+    index = vector_indexes.get(username)
+    if index is not None and not index.is_expired():
+        return index
+
+    index = VectorIndex(EMBEDDING_DIMENSIONS or None)
+    cursor = notes_collection.find(indexed_embedding_filter(username), {'embedding': 1, 'embedding_format': 1})
+    skipped = 0
+    for note in cursor:
+        if not embedding_fits(note.get('embedding_format')):
+            skipped += 1
+        elif note.get('embedding') is not None and len(note['embedding']):
+            index.upsert(str(note['_id']), compact_vector(note['embedding']))
+    if skipped:
+        print(f"Left {skipped} embeddings of {username} out of the index: stored with fewer than {EMBEDDING_DIMENSIONS or 'all'} dimensions")
+    vector_indexes.put(username, index)
+    return index
+
+def index_note_embedding(username, note_id, embedding):
+    """Push a freshly written embedding into the user's index if it is loaded."""
+    index = vector_indexes.get(username)
+    if index is not None:
+        index.upsert(str(note_id), compact_vector(embedding))
+
+
+def tokenize(text):
+    return re.findall(r"\w+", text.lower())
+
+class KeywordIndex:
+    """BM25 inverted index over one user's note titles, summaries, transcripts and tags."""
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.postings = {}
+        self.fields = {}
+        self.lengths = {}
+        self.total_length = 0
+        self.built_at = time.time()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def is_expired(self):
+        return time.time() - self.built_at > VECTOR_INDEX_TTL
+
+    def _unlink(self, note_id):
+        fields = self.fields.pop(note_id, None)
+        if fields is None:
+            return {}
+        for term in {term for counts in fields.values() for term in counts}:
+            postings = self.postings[term]
+            del postings[note_id]
+            if not postings:
+                del self.postings[term]
+        self.total_length -= self.lengths.pop(note_id)
+        return fields
+
+    def upsert(self, note_id, note):
+        """Index the searchable fields present in note; fields it leaves out keep their old terms."""
+        with self.lock:
+            fields = self._unlink(note_id)
+            for field in KEYWORD_FIELD_WEIGHTS:
+                if field in note:
+                    value = note[field] or ''
+                    text = ' '.join(value) if isinstance(value, list) else str(value)
+                    counts = {}
+                    for term in tokenize(text):
+                        counts[term] = counts.get(term, 0) + 1
+                    fields[field] = counts
+            frequencies = {}
+            for field, counts in fields.items():
+                for term, count in counts.items():
+                    frequencies[term] = frequencies.get(term, 0) + KEYWORD_FIELD_WEIGHTS[field] * count
+            for term, frequency in frequencies.items():
+                self.postings.setdefault(term, {})[note_id] = frequency
+            self.fields[note_id] = fields
+            self.lengths[note_id] = sum(frequencies.values())
+            self.total_length += self.lengths[note_id]
+
+    def search(self, query, k):
+        """Return up to k (note_id, score) pairs, best first."""
+        with self.lock:
+            size = len(self.lengths)
+            if not size:
+                return []
+            average_length = self.total_length / size or 1.0
+            scores = {}
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (size - len(postings) + 0.5) / (len(postings) + 0.5))
+                for note_id, frequency in postings.items():
+                    norm = self.K1 * (1 - self.B + self.B * self.lengths[note_id] / average_length)
+                    scores[note_id] = scores.get(note_id, 0.0) + idf * frequency * (self.K1 + 1) / (frequency + norm)
+            return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+keyword_indexes = LRUCache(VECTOR_INDEX_CACHE_USERS)
+
+def get_keyword_index(username):
+    """Return the user's keyword index, loading it from Mongo if needed."""
+    index = keyword_indexes.get(username)
+    if index is not None and not index.is_expired():
+        return index
+
+    index = KeywordIndex()
+    for note in notes_collection.find({'username': username}, {field: 1 for field in KEYWORD_FIELD_WEIGHTS}):
+        index.upsert(str(note['_id']), note)
+    keyword_indexes.put(username, index)
+    return index
+
+def index_note_text(username, note_id, note):
+    """Push a note's changed text fields into the user's keyword index if it is loaded."""
+    index = keyword_indexes.get(username)
+    if index is not None:
+        index.upsert(str(note_id), note)
+
+def fuse_rankings(vector_hits, keyword_hits, k, alpha=HYBRID_ALPHA):
+    """Blend min-max normalized vector and BM25 scores; a note missing from one list scores 0 there."""
+    def normalized(hits):
+        if not hits:
+            return {}
+        scores = [score for _, score in hits]
+        low, high = min(scores), max(scores)
+        return {note_id: (score - low) / (high - low) if high > low else 1.0 for note_id, score in hits}
+
+    vector_scores, keyword_scores = normalized(vector_hits), normalized(keyword_hits)
+    combined = {
+        note_id: alpha * vector_scores.get(note_id, 0.0) + (1 - alpha) * keyword_scores.get(note_id, 0.0)
+        for note_id in set(vector_scores) | set(keyword_scores)
+    }
+    return heapq.nlargest(k, combined.items(), key=lambda item: item[1])
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+EMBEDDING_SUBTYPES = {'float32': 0x80, 'int8': 0x81}
+
+def embedding_format(storage=None, dimensions=None):
+    storage = storage or EMBEDDING_STORAGE
+    dimensions = EMBEDDING_DIMENSIONS if dimensions is None else dimensions
+    return f"{storage}/{dimensions}" if dimensions else storage
+
+def decode_embedding(value):
+    """float32 vector from any stored form: packed binary (read without copying) or a legacy list."""
+    if isinstance(value, Binary) and value.subtype == EMBEDDING_SUBTYPES['int8']:
+        scale = np.frombuffer(value, dtype='<f4', count=1)[0]
+        return np.frombuffer(value, dtype=np.int8, offset=4).astype(np.float32) * scale
+    if isinstance(value, (bytes, bytearray)):
+        return np.frombuffer(value, dtype='<f4')
+    return np.asarray(value, dtype=np.float32)
+
+def compact_vector(embedding, dimensions=None):
+    """Embedding as float32, cut to the configured dimensions and renormalized."""
+    dimensions = EMBEDDING_DIMENSIONS if dimensions is None else dimensions
+    vector = decode_embedding(embedding)
+    if dimensions and vector.shape[0] > dimensions:
+        vector = vector[:dimensions]
+        norm = np.linalg.norm(vector)
+        vector = vector / norm if norm else vector
+    return vector
+
+def embedding_fits(stored_format):
+    """Whether a vector stored as stored_format still has every dimension the configuration keeps."""
+    if not stored_format or '/' not in stored_format:
+        return True
+    return bool(EMBEDDING_DIMENSIONS) and int(stored_format.split('/', 1)[1]) >= EMBEDDING_DIMENSIONS
+
+def encode_embedding(embedding, storage=None, dimensions=None):
+    """Pack an embedding for Mongo. int8 payloads start with their float32 scale."""
+    vector = compact_vector(embedding, dimensions)
+    if (storage or EMBEDDING_STORAGE) == 'int8':
+        scale = float(np.abs(vector).max()) / 127 or 1.0
+        payload = np.float32(scale).astype('<f4').tobytes() + np.round(vector / scale).astype(np.int8).tobytes()
+        return Binary(payload, EMBEDDING_SUBTYPES['int8'])
+    return Binary(vector.astype('<f4').tobytes(), EMBEDDING_SUBTYPES['float32'])
+
+def stored_embedding(embedding, text):
+    """Fields to $set on a note for a freshly computed embedding of text."""
+    return {
+        'embedding': encode_embedding(embedding),
+        'embedding_format': embedding_format(),
+        'embedding_model': EMBEDDING_MODEL,
+        'artifacts.embedding': {'hash': text_hash(text), 'version': EMBEDDING_MODEL}
+    }
+
+class EmbeddingCache:
+    """Embeddings keyed by (model, sha256(text)): an in-memory LRU in front of a Mongo TTL collection."""
+
+    def __init__(self, collection, max_entries, ttl):
+        self.collection = collection
+        self.ttl = ttl
+        self.memory = LRUCache(max_entries)
+        self.persistent_hits = 0
+        self.misses = 0
+        self.ttl_index_ready = False
+
+    def _key(self, model, text):
+        return f"{model}:{text_hash(text)}"
+
+    def get_many(self, model, texts):
+        """Return a list aligned with texts, with None for every miss."""
+        keys = [self._key(model, text) for text in texts]
+        results = [self.memory.get(key) for key in keys]
+        missing = [key for key, value in zip(keys, results) if value is None]
+        if missing:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+            found = {
+                doc['_id']: decode_embedding(doc['embedding'])
+                for doc in self.collection.find({'_id': {'$in': missing}, 'created_at': {'$gt': cutoff}})
+            }
+            for i, key in enumerate(keys):
+                if results[i] is None and key in found:
+                    results[i] = found[key]
+                    self.memory.put(key, found[key])
+                    self.persistent_hits += 1
+        self.misses += sum(1 for value in results if value is None)
+        return results
+
+    def put_many(self, model, texts, embeddings):
+        if not self.ttl_index_ready:
+            self.collection.create_index('created_at', expireAfterSeconds=self.ttl)
+            self.ttl_index_ready = True
+        now = datetime.utcnow()
+        operations = []
+        for text, embedding in zip(texts, embeddings):
+            key = self._key(model, text)
+            self.memory.put(key, embedding)
+            operations.append(UpdateOne(
+                {'_id': key},
+                {'$set': {'model': model, 'embedding': encode_embedding(embedding, 'float32', 0), 'created_at': now}},
+                upsert=True
+            ))
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+
+    def stats(self):
+        memory = self.memory.stats()
+        return {
+            'memory_entries': memory['entries'],
+            'memory_hits': memory['hits'],
+            'persistent_hits': self.persistent_hits,
+            'misses': self.misses
+        }
+
+embedding_cache = EmbeddingCache(embedding_cache_collection, EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL)
+
+
+def nearest_neighbours(rows, matrix, k, block_size=1024):
+    """Top-k most similar other rows of matrix for each of rows, best first."""
+    neighbours = np.empty((len(rows), k), dtype=np.int64)
+    similarities = np.empty((len(rows), k), dtype=np.float32)
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        scores = matrix[block] @ matrix.T
+        scores[np.arange(len(block)), block] = -np.inf
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        neighbours[start:start + len(block)] = np.take_along_axis(top, order, axis=1)
+        similarities[start:start + len(block)] = np.take_along_axis(top_scores, order, axis=1)
+    return neighbours, similarities
+
+def principal_axes(centered, count=2, iterations=8):
+    """Top principal directions of a centered matrix by subspace iteration."""
+    basis = np.random.default_rng(0).standard_normal((centered.shape[1], count)).astype(np.float32)
+    for _ in range(iterations):
+        basis, _ = np.linalg.qr(centered.T @ (centered @ basis))
+    return basis
+
+class SemanticGraph:
+    """kNN edges, k-means clusters and a PCA layout for one user's vector index."""
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {}
+        self.hashes = None
+        self.dim = None
+        self.index = None
+        self.index_version = -1
+        self.changes_since_build = 0
+        self.payload = None
+        self.lock = threading.Lock()
+
+    def sync(self, index):
+        """Bring the graph up to date with the index and return the client payload."""
+        with self.lock:
+            if index is self.index and index.version == self.index_version and self.payload is not None:
+                return self.payload
+            with index.lock:
+                ids = list(index.ids)
+                matrix = index.matrix[:len(ids)].copy()
+                hashes = index.hashes[:len(ids)].copy()
+                version = index.version
+            if not self._update(ids, matrix, hashes):
+                self._build(ids, matrix, hashes)
+            self.index, self.index_version = index, version
+            self.payload = self._render()
+            return self.payload
+
+    def _build(self, ids, matrix, hashes):
+        size = len(ids)
+        k = min(GRAPH_NEIGHBOURS, size - 1)
+        self.ids, self.positions = ids, {note_id: row for row, note_id in enumerate(ids)}
+        self.hashes, self.dim = hashes, matrix.shape[1]
+        self.changes_since_build = 0
+        if k > 0:
+            self.neighbours, self.similarities = nearest_neighbours(np.arange(size), matrix, k)
+        else:
+            self.neighbours = np.empty((size, 0), dtype=np.int64)
+            self.similarities = np.empty((size, 0), dtype=np.float32)
+        if not size:
+            self.centroids, self.labels = None, np.empty(0, dtype=np.int64)
+            self.coords = np.empty((0, 2), dtype=np.float32)
+            return
+        n_clusters = min(GRAPH_MAX_CLUSTERS, max(1, int(round(np.sqrt(size / 2)))))
+        self.centroids, self.labels = spherical_kmeans(matrix, n_clusters, iterations=20)
+        self.mean = matrix.mean(axis=0)
+        self.axes = principal_axes(matrix - self.mean)
+        coords = (matrix - self.mean) @ self.axes
+        self.scale = float(np.abs(coords).max()) or 1.0
+        self.coords = coords / self.scale
+
+    def _update(self, ids, matrix, hashes):
+        """Patch in added, changed and removed notes. Returns False when a rebuild is due."""
+        size = len(ids)
+        k = min(GRAPH_NEIGHBOURS, size - 1)
+        if self.hashes is None or not self.ids or k < 1 or k != self.neighbours.shape[1] or matrix.shape[1] != self.dim:
+            return False
+
+        new_positions = {note_id: row for row, note_id in enumerate(ids)}
+        kept_ids = [note_id for note_id in self.ids if note_id in new_positions]
+        old_rows = np.array([self.positions[note_id] for note_id in kept_ids], dtype=np.int64)
+        new_rows = np.array([new_positions[note_id] for note_id in kept_ids], dtype=np.int64)
+        changed = self.hashes[old_rows] != hashes[new_rows]
+        added = [new_positions[note_id] for note_id in ids if note_id not in self.positions]
+        touched = (len(self.ids) - len(kept_ids)) + len(added) + int(changed.sum())
+        if self.changes_since_build + touched > GRAPH_REBUILD_FRACTION * size:
+            return False
+
+        old_to_new = np.full(len(self.ids), -1, dtype=np.int64)
+        old_to_new[old_rows] = new_rows
+        neighbours = np.full((size, k), -1, dtype=np.int64)
+        similarities = np.full((size, k), -np.inf, dtype=np.float32)
+        labels = np.zeros(size, dtype=np.int64)
+        coords = np.zeros((size, 2), dtype=np.float32)
+        neighbours[new_rows] = old_to_new[self.neighbours[old_rows]]
+        similarities[new_rows] = self.similarities[old_rows]
+        labels[new_rows] = self.labels[old_rows]
+        coords[new_rows] = self.coords[old_rows]
+
+        fresh = np.array(sorted(added + new_rows[changed].tolist()), dtype=np.int64)
+        # Recompute a node's neighbours if it is new or changed, if one of its
+        # neighbours was removed or changed, or if a fresh note now beats its kth.
+        dirty = np.zeros(size, dtype=bool)
+        dirty[fresh] = True
+        dirty |= np.any((neighbours < 0) | np.isin(neighbours, fresh), axis=1)
+        if len(fresh):
+            scores = matrix[fresh] @ matrix.T
+            scores[np.arange(len(fresh)), fresh] = -np.inf
+            dirty |= scores.max(axis=0) > similarities[:, -1]
+            labels[fresh] = np.argmax(matrix[fresh] @ self.centroids.T, axis=1)
+            coords[fresh] = (matrix[fresh] - self.mean) @ self.axes / self.scale
+        rows = np.flatnonzero(dirty)
+        if len(rows):
+            neighbours[rows], similarities[rows] = nearest_neighbours(rows, matrix, k)
+
+        self.ids, self.positions, self.hashes = ids, new_positions, hashes
+        self.neighbours, self.similarities, self.labels, self.coords = neighbours, similarities, labels, coords
+        self.changes_since_build += touched
+        return True
+
+    def _render(self):
+        size, k = self.neighbours.shape
+        sources = np.repeat(np.arange(size), k)
+        targets = self.neighbours.ravel()
+        weights = self.similarities.ravel()
+        low, high = np.minimum(sources, targets), np.maximum(sources, targets)
+        _, first = np.unique(low * size + high, return_index=True)
+        return {
+            'nodes': [
+                {'id': note_id, 'cluster': int(label), 'x': round(float(x), 4), 'y': round(float(y), 4)}
+                for note_id, label, (x, y) in zip(self.ids, self.labels, self.coords)
+            ],
+            'edges': [
+                {'from': self.ids[low[i]], 'to': self.ids[high[i]], 'similarity': round(float(weights[i]), 4)}
+                for i in first
+            ],
+            'clusters': 0 if self.centroids is None else len(self.centroids)
+        }
+
+semantic_graphs = LRUCache(GRAPH_CACHE_USERS)
+
+def get_semantic_graph(username):
+    graph = semantic_graphs.get(username)
+    if graph is None:
+        graph = SemanticGraph()
+        semantic_graphs.put(username, graph)
+    return graph.sync(get_vector_index(username))
+
+
+class LocalUserCache:
+    """In-process user metadata, one LRU per worker."""
+
+    def __init__(self):
+        self.entries = LRUCache(USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+    def get(self, username):
+        return self.entries.get(username)
+
+    def put(self, username, metadata):
+        self.entries.put(username, metadata)
+
+    def delete(self, username):
+        self.entries.pop(username)
+
+class RedisUserCache:
+    """User metadata in Redis, so every worker sees the same entries and invalidations."""
+
+    def __init__(self):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("USER_CACHE_BACKEND=redis needs the redis package.")
+        self.client = redis.Redis.from_url(USER_CACHE_REDIS_URL)
+
+    def _key(self, username):
+        return f"user_metadata:{username}"
+
+    def get(self, username):
+        value = self.client.get(self._key(username))
+        return None if value is None else json.loads(value)
+
+    def put(self, username, metadata):
+        self.client.setex(self._key(username), USER_CACHE_TTL, json.dumps(metadata))
+
+    def delete(self, username):
+        self.client.delete(self._key(username))
+
+USER_CACHE_BACKENDS = {
+    'local': LocalUserCache,
+    'redis': RedisUserCache
+}
+
+user_cache = USER_CACHE_BACKENDS[USER_CACHE_BACKEND]()
+
+def touch_vault(username):
+    """Bump the user's vault version; list ETags and the user metadata cache depend on it."""
+    users_collection.update_one(
+        {'username': username},
+        {'$inc': {'notes_version': 1}, '$set': {'notes_modified_at': datetime.utcnow()}}
+    )
+    user_cache.delete(username)
+
+def vault_version(username):
+    user = users_collection.find_one({'username': username}, {'notes_version': 1})
+    return (user or {}).get('notes_version', 0)
+
+def user_metadata(username):
+    """{'version', 'note_count', 'tags': {tag: count}, 'modified_at'} for the user's vault.
+
+    Entries are checked against the stored version in either backend: a scan that started before a
+    write can put its result back after the write's invalidation.
+    """
+    metadata = user_cache.get(username)
+    if metadata is not None and metadata['version'] == vault_version(username):
+        return metadata
+
+    # The version is read first, so a write during the scan leaves the entry already outdated.
+    user = users_collection.find_one({'username': username}, {'notes_version': 1, 'notes_modified_at': 1}) or {}
+    modified_at = user.get('notes_modified_at')
+    metadata = {
+        'version': user.get('notes_version', 0),
+        'note_count': notes_collection.count_documents({'username': username}),
+        'tags': {row['_id']: row['count'] for row in notes_collection.aggregate([
+            {'$match': {'username': username}},
+            {'$unwind': '$tags'},
+            {'$group': {'_id': '$tags', 'count': {'$sum': 1}}}
+        ])},
+        'modified_at': modified_at.isoformat() if modified_at else None
+    }
+    user_cache.put(username, metadata)
+    return metadata
+
+
+def note_embedding_text(note):
+    return note.get('summary') or note.get('transcript') or note.get('title')
+
+def embed_texts(texts):
+    """Embed a list of texts through the cache, EMBEDDING_BATCH_SIZE API inputs per call.
+
+    Returns full-length float32 vectors.
+    """
+    embeddings = embedding_cache.get_many(EMBEDDING_MODEL, texts)
+    # Identical texts in one call are only sent once.
+    pending = list(dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None))
+    fetched = {}
+    for start in range(0, len(pending), EMBEDDING_BATCH_SIZE):
+        batch = pending[start:start + EMBEDDING_BATCH_SIZE]
+        response = openai_client.embeddings.create(input=batch, model=EMBEDDING_MODEL)
+        batch_embeddings = [np.asarray(item.embedding, dtype=np.float32) for item in sorted(response.data, key=lambda item: item.index)]
+        embedding_cache.put_many(EMBEDDING_MODEL, batch, batch_embeddings)
+        fetched.update(zip(batch, batch_embeddings))
+    return [embedding if embedding is not None else fetched[text] for text, embedding in zip(texts, embeddings)]
+
+def missing_embedding_filter(username):
+    """Notes that were never embedded. Ones embedded by an older model wait for sweep-artifacts."""
+    return {'username': username, 'embedding': {'$exists': False}}
+
+
+# Derived artifacts: what each is built from, and which version builds it now.
+# A None version (no classifier loaded) means the artifact is not tracked.
+ARTIFACT_FIELDS = {'username': 1, 'title': 1, 'summary': 1, 'transcript': 1, 'tags': 1,
+                   'detected_tasks': 1, 'timestamp': 1, 'artifacts': 1}
+ARTIFACT_INPUTS = {
+    'embedding': lambda note: note_embedding_text(note) or '',
+    'tags': lambda note: note_embedding_text(note) or '',
+    # Completed flags are written to both copies by /tasks/bulk and update_note, so they are not an input.
+    'tasks': lambda note: json.dumps([note.get('title'), [task['task'] for task in note_tasks(note)]])
+}
+
+def artifact_versions():
+    return {
+        'embedding': EMBEDDING_MODEL,
+        'tags': get_note_classifier()['version'] if get_note_classifier() is not None else None,
+        'tasks': TASKS_ARTIFACT_VERSION
+    }
+
+def artifact_record(note, name):
+    return {'hash': text_hash(ARTIFACT_INPUTS[name](note)), 'version': artifact_versions()[name]}
+
+def stale_artifacts(note):
+    """Names of the note's artifacts whose inputs or version differ from what built them."""
+    stored = note.get('artifacts') or {}
+    return [
+        name for name, version in artifact_versions().items()
+        if version is not None and stored.get(name) != artifact_record(note, name)
+    ]
+
+def enqueue_artifacts(username, note_ids, names):
+    now = datetime.utcnow()
+    artifact_queue_collection.bulk_write([
+        UpdateOne({'_id': f"{note_id}:{name}"}, {'$set': {
+            'username': username, 'note_id': note_id, 'artifact': name, 'enqueued_at': now
+        }}, upsert=True)
+        for note_id in note_ids for name in names
+    ], ordered=False)
+
+def build_embedding_artifacts(notes):
+    texts = [note_embedding_text(note) for note in notes]
+    embedded = [(note, text) for note, text in zip(notes, texts) if text]
+    embeddings = embed_texts([text for _, text in embedded])
+    operations = [
+        UpdateOne({'_id': note['_id']}, {'$set': stored_embedding(embedding, text)})
+        for (note, text), embedding in zip(embedded, embeddings)
+    ]
+    # Notes without any text still record that there was nothing to embed.
+    operations.extend(
+        UpdateOne({'_id': note['_id']}, {'$set': {'artifacts.embedding': artifact_record(note, 'embedding')}})
+        for note, text in zip(notes, texts) if not text
+    )
+    notes_collection.bulk_write(operations, ordered=False)
+    for (note, _), embedding in zip(embedded, embeddings):
+        index_note_embedding(note['username'], note['_id'], embedding)
+
+def build_tag_artifacts(notes):
+    """Make the classifier's label each note's first tag when it is confident. Returns the number retagged."""
+    predictions = classify_notes([note_embedding_text(note) or '' for note in notes])
+    operations = []
+    retagged = 0
+    for note, (label, confidence) in zip(notes, predictions):
+        fields = {'artifacts.tags': artifact_record(note, 'tags')}
+        tags = note.get('tags') or []
+        new_tags = [label] + [tag for tag in tags if tag != label]
+        if note_embedding_text(note) and confidence >= CLASSIFIER_THRESHOLD and new_tags != tags:
+            fields['tags'] = new_tags
+            index_note_text(note['username'], note['_id'], {'tags': new_tags})
+            retagged += 1
+        operations.append(UpdateOne({'_id': note['_id']}, {'$set': fields}))
+    if operations:
+        notes_collection.bulk_write(operations, ordered=False)
+    return retagged
+
+def build_task_artifacts(notes):
+    for note in notes:
+        sync_note_tasks(note['username'], note['_id'], note_tasks(note), note.get('title'), note.get('timestamp'))
+    notes_collection.bulk_write([
+        UpdateOne({'_id': note['_id']}, {'$set': {'artifacts.tasks': artifact_record(note, 'tasks')}})
+        for note in notes
+    ], ordered=False)
+
+ARTIFACT_BUILDERS = {
+    'embedding': build_embedding_artifacts,
+    'tags': build_tag_artifacts,
+    'tasks': build_task_artifacts
+}
+
+def sweep_artifacts(username=None, batch_size=ARTIFACT_SWEEP_BATCH):
+    """Build queued artifacts oldest first, batch_size queue entries at a time. Returns the number built."""
+    query = {} if username is None else {'username': username}
+    built = 0
+    while True:
+        entries = list(artifact_queue_collection.find(query).sort('enqueued_at', ASCENDING).limit(batch_size))
+        if not entries:
+            return built
+        notes = {note['_id']: note for note in notes_collection.find(
+            {'_id': {'$in': list({entry['note_id'] for entry in entries})}}, ARTIFACT_FIELDS
+        )}
+        pending = defaultdict(list)
+        for entry in entries:
+            note = notes.get(entry['note_id'])
+            # Entries for deleted notes, or already rebuilt by another path, are just dropped.
+            if note is not None and entry['artifact'] in stale_artifacts(note):
+                pending[entry['artifact']].append(note)
+        for name, batch in pending.items():
+            ARTIFACT_BUILDERS[name](batch)
+            built += len(batch)
+        # An edit during the build re-queues with a newer enqueued_at, which this leaves in place.
+        artifact_queue_collection.delete_many({'$or': [
+            {'_id': entry['_id'], 'enqueued_at': entry['enqueued_at']} for entry in entries
+        ]})
+        for owner in {note['username'] for batch in pending.values() for note in batch}:
+            touch_vault(owner)
+
+artifact_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='artifact-sweep')
+artifact_sweeps = {}
+artifact_sweep_errors = {}
+artifact_sweeps_lock = threading.Lock()
+
+def start_artifact_sweep(username):
+    """Sweep the user's queued artifacts in the background, or have the sweep in flight go round again."""
+    with artifact_sweeps_lock:
+        artifact_sweep_errors.pop(username, None)
+        if username in artifact_sweeps:
+            # It may already have found the queue empty; make it look once more before stopping.
+            artifact_sweeps[username] = True
+            return
+        artifact_sweeps[username] = False
+
+    def run():
+        try:
+            while True:
+                sweep_artifacts(username)
+                with artifact_sweeps_lock:
+                    if not artifact_sweeps[username]:
+                        del artifact_sweeps[username]
+                        return
+                    artifact_sweeps[username] = False
+        except Exception as e:
+            print(f"Error sweeping artifacts for {username}: {e}")
+            with artifact_sweeps_lock:
+                artifact_sweeps.pop(username, None)
+                artifact_sweep_errors[username] = str(e)
+
+    artifact_executor.submit(run)
+
+_token_encoding = None
+
+def count_tokens(text):
+    """Token count for gpt-4o prompts; a chars/4 estimate when tiktoken isn't installed."""
+    global _token_encoding
+    if _token_encoding is None:
+        try:
+            import tiktoken
+            _token_encoding = tiktoken.get_encoding("o200k_base")
+        except ImportError:
+            _token_encoding = False
+    if _token_encoding is False:
+        return len(text) // 4 + 1
+    return len(_token_encoding.encode(text))
+
+def format_context_note(note):
+    note_content = f"Title: {note.get('title', 'Untitled')}\n"
+    if note.get('summary'):
+        note_content += f"Summary: {note['summary']}\n"
+    elif note.get('transcript'):
+        note_content += f"Transcript: {note['transcript']}\n"
+    return note_content
+
+def select_context_notes(username, question):
+    """Pick the notes most similar to the question that fit in IDRAK_CONTEXT_TOKENS.
+
+    Falls back to the most recent notes when the user has no embeddings yet.
+    """
+    projection = {'title': 1, 'summary': 1, 'transcript': 1}
+    index = get_vector_index(username)
+    if len(index):
+        hits = index.search(compact_vector(embed_texts([question])[0]), IDRAK_CONTEXT_NOTES)
+        notes_by_id = {
+            str(note['_id']): note
+            for note in notes_collection.find(
+                {'_id': {'$in': [ObjectId(note_id) for note_id, _ in hits]}, 'username': username},
+                projection
+            )
+        }
+        candidates = [notes_by_id[note_id] for note_id, _ in hits if note_id in notes_by_id]
+    else:
+        candidates = list(notes_collection.find({'username': username}, projection)
+                          .sort('timestamp', -1).limit(IDRAK_CONTEXT_NOTES))
+
+    context_notes = []
+    used_tokens = 0
+    for note in candidates:
+        note_content = format_context_note(note)
+        note_tokens = count_tokens(note_content)
+        if used_tokens + note_tokens > IDRAK_CONTEXT_TOKENS:
+            continue
+        context_notes.append(note_content)
+        used_tokens += note_tokens
+    return context_notes, used_tokens
+
+history_summary_cache = LRUCache(1000)
+
+def compact_history(history):
+    """Keep recent turns verbatim and replace older ones with a cached summary once over budget."""
+    messages = [{'role': msg['role'], 'content': msg['content']} for msg in history]
+    if sum(count_tokens(msg['content']) for msg in messages) <= IDRAK_HISTORY_TOKENS:
+        return messages
+
+    # Keep as many of the latest turns as fit in half the budget; the rest get summarized.
+    keep = 0
+    kept_tokens = 0
+    for msg in reversed(messages[-IDRAK_RECENT_TURNS:]):
+        kept_tokens += count_tokens(msg['content'])
+        if kept_tokens > IDRAK_HISTORY_TOKENS // 2:
+            break
+        keep += 1
+    older, recent = messages[:len(messages) - keep], messages[len(messages) - keep:]
+    key = text_hash(json.dumps(older))
+    summary = history_summary_cache.get(key)
+    if summary is None:
+        # Roughly 10k tokens, so the summary call itself stays inside gpt-3.5-turbo's window.
+        transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in older)[-40000:]
+        completion = openai_client.chat.completions.create(
+            model=HISTORY_SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": "Summarize this conversation between a user and an assistant in a few sentences, keeping any facts, names and decisions needed to continue it."},
+                {"role": "user", "content": transcript}
+            ],
+            max_tokens=300
+        )
+        summary = completion.choices[0].message.content.strip()
+        history_summary_cache.put(key, summary)
+    return [{'role': 'system', 'content': f"Summary of the earlier conversation: {summary}"}] + recent
+
+def load_note_classifier():
+    """Load the artifact named in models/note_classifier.json, or None if there isn't one."""
+    manifest_path = os.path.join(CLASSIFIER_DIR, 'note_classifier.json')
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        import joblib
+    except ImportError:
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    artifact = joblib.load(os.path.join(CLASSIFIER_DIR, manifest['artifact']))
+    artifact['version'] = manifest['version']
+    print(f"Loaded note classifier v{manifest['version']} (accuracy {manifest['accuracy']:.3f})")
+    return artifact
+
+_note_classifier = None
+_note_classifier_loaded = False
+
+def get_note_classifier():
+    """The classifier artifact, loaded (with scikit-learn) on first use; None if there isn't one."""
+    global _note_classifier, _note_classifier_loaded
+    if not _note_classifier_loaded:
+        _note_classifier = load_note_classifier()
+        _note_classifier_loaded = True
+    return _note_classifier
+
+def classify_notes(texts):
+    """Return a (label, confidence) pair per text, or None entries when no classifier is loaded."""
+    note_classifier = get_note_classifier()
+    if note_classifier is None or not texts:
+        return [None] * len(texts)
+    probabilities = note_classifier['model'].predict_proba(note_classifier['vectorizer'].transform(texts))
+    best = probabilities.argmax(axis=1)
+    classes = note_classifier['model'].classes_
+    return [(str(classes[i]), float(probabilities[row, i])) for row, i in enumerate(best)]
+
+def primary_tag(tags, text):
+    """Put the classifier's label first in tags when it is confident; otherwise return None."""
+    prediction = classify_notes([text])[0]
+    if prediction is None or prediction[1] < CLASSIFIER_THRESHOLD:
+        return None
+    label = prediction[0]
+    return [label] + [tag for tag in tags or [] if tag != label]
+
+def store_audio(username, audio, content_type='audio/webm', filename='recording.webm', pending=False):
+    """Put a recording (bytes or a seekable file) into GridFS, reusing an identical upload by the same user.
+
+    Pending files are uploads that no note refers to yet; save_note claims them.
+    """
+    if isinstance(audio, bytes):
+        audio = io.BytesIO(audio)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: audio.read(AUDIO_STREAM_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    digest = digest.hexdigest()
+
+    existing = audio_fs.find_one({'metadata.username': username, 'metadata.sha256': digest})
+    if existing and (pending or not existing.metadata.get('pending')):
+        return existing._id
+    if existing:
+        # The caller is about to refer to it, so prune-uploads must leave it alone from now on.
+        claimed = db['audio.files'].update_one({'_id': existing._id, 'metadata.pending': True}, {'$unset': {'metadata.pending': ''}})
+        if claimed.matched_count:
+            return existing._id
+    audio.seek(0)
+    metadata = {'username': username, 'sha256': digest}
+    if pending:
+        metadata['pending'] = True
+    return audio_fs.put(audio, filename=filename, content_type=content_type, metadata=metadata)
+
+def claim_audio_upload(username, upload_id):
+    """Attach a pending upload to a note. Returns the file id, or None if it isn't the user's."""
+    if not ObjectId.is_valid(upload_id):
+        return None
+    result = db['audio.files'].update_one(
+        {'_id': ObjectId(upload_id), 'metadata.username': username},
+        {'$unset': {'metadata.pending': ''}}
+    )
+    return ObjectId(upload_id) if result.matched_count else None
+
+def stream_byte_range(fileobj, length, content_type, etag=None):
+    """Serve a seekable file object, honouring a single HTTP Range if one was sent."""
+    start, stop, status = 0, length, 200
+    if request.range is not None:
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{length}'})
+        start, stop = byte_range
+        status = 206
+
+    def generate():
+        fileobj.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = fileobj.read(min(AUDIO_STREAM_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    response = Response(generate(), status=status, mimetype=content_type, direct_passthrough=True)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.headers['Content-Length'] = str(stop - start)
+    if status == 206:
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+    if etag:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+def sse_event(event, data):
+    """Format one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class WhisperBackend:
+    def transcribe(self, path):
+        with open(path, 'rb') as audio_io:
+            return openai_client.audio.transcriptions.create(model="whisper-1", file=audio_io).text
+
+class StubTranscriptionBackend:
+    """Offline backend for tests and local runs: no network, predictable text."""
+
+    def transcribe(self, path):
+        return f"Transcript of {os.path.basename(path)} ({os.path.getsize(path)} bytes)."
+
+TRANSCRIPTION_BACKENDS = {
+    'whisper': WhisperBackend,
+    'stub': StubTranscriptionBackend
+}
+
+transcription_backend = TRANSCRIPTION_BACKENDS[TRANSCRIPTION_BACKEND]()
+transcription_executor = ThreadPoolExecutor(max_workers=TRANSCRIPTION_WORKERS, thread_name_prefix='transcription')
+
+def probe_duration(path):
+    """Length of the recording in seconds, or None if ffprobe can't tell."""
+    if not shutil.which('ffprobe'):
+        return None
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', path],
+        capture_output=True, text=True
+    )
+    try:
+        return float(result.stdout.strip())
+    except ValueError:
+        return None
+
+def split_audio(path, duration, out_dir):
+    """Cut the recording into overlapping mono 16 kHz WAV chunks."""
+    step = TRANSCRIPTION_CHUNK_SECONDS - TRANSCRIPTION_OVERLAP_SECONDS
+    chunk_paths = []
+    start = 0.0
+    while start < duration:
+        chunk_path = os.path.join(out_dir, f'chunk_{len(chunk_paths):04d}.wav')
+        subprocess.run(
+            ['ffmpeg', '-v', 'error', '-y', '-ss', str(start), '-t', str(TRANSCRIPTION_CHUNK_SECONDS),
+             '-i', path, '-vn', '-ac', '1', '-ar', '16000', chunk_path],
+            check=True
+        )
+        chunk_paths.append(chunk_path)
+        start += step
+    return chunk_paths
+
+def iter_chunk_transcripts(path):
+    """Yield (index, total, text) for each chunk of the recording as soon as it is transcribed.
+
+    Short recordings, or any recording when ffmpeg is unavailable, are a single chunk.
+    """
+    duration = probe_duration(path)
+    if duration is None or duration <= TRANSCRIPTION_CHUNK_SECONDS or not shutil.which('ffmpeg'):
+        yield 0, 1, transcription_backend.transcribe(path)
+        return
+
+    with tempfile.TemporaryDirectory(dir=UPLOAD_TMP_DIR) as chunk_dir:
+        chunk_paths = split_audio(path, duration, chunk_dir)
+        futures = {
+            transcription_executor.submit(transcription_backend.transcribe, chunk_path): index
+            for index, chunk_path in enumerate(chunk_paths)
+        }
+        for future in as_completed(futures):
+            yield futures[future], len(chunk_paths), future.result()
+
+def _words(text):
+    return [re.sub(r'[^\w]', '', word).lower() for word in text.split()]
+
+def stitch_transcripts(parts, max_overlap_words=40, min_overlap_words=2):
+    """Join chunk transcripts in order, dropping words repeated across the overlap.
+
+    A single shared word at a boundary is as likely to be chance as overlap, so it is kept.
+    """
+    stitched = []
+    for part in parts:
+        words = part.split()
+        if stitched and words:
+            tail = _words(' '.join(stitched[-max_overlap_words:]))
+            head = _words(' '.join(words[:max_overlap_words]))
+            for size in range(min(len(tail), len(head)), min_overlap_words - 1, -1):
+                if tail[-size:] == head[:size]:
+                    words = words[size:]
+                    break
+        stitched.extend(words)
+    return ' '.join(stitched)
+
+def transcribe_file(path):
+    parts = {}
+    for index, _, text in iter_chunk_transcripts(path):
+        parts[index] = text
+    return stitch_transcripts([parts[index] for index in sorted(parts)])
+
+def spool_upload(audio_file):
+    """Save an uploaded file to a temp path (streamed to disk, never read whole into memory)."""
+    extension = audio_file.filename.rsplit('.', 1)[1].lower()
+    tmp = tempfile.NamedTemporaryFile(suffix=f'.{extension}', dir=UPLOAD_TMP_DIR, delete=False)
+    with tmp:
+        audio_file.save(tmp)
+    return tmp.name
+
+def keep_upload(username, path, audio_file):
+    with open(path, 'rb') as audio_io:
+        return str(store_audio(
+            username, audio_io,
+            content_type=audio_file.mimetype or f"audio/{path.rsplit('.', 1)[1]}",
+            filename=audio_file.filename,
+            pending=True
+        ))
+
+def validate_audio_upload():
+    """Return (audio_file, None) or (None, error response)."""
+    if 'audio_file' not in request.files:
+        return None, (jsonify({'error': 'No audio file provided'}), 400)
+
+    audio_file = request.files['audio_file']
+    if '.' not in audio_file.filename or \
+       audio_file.filename.rsplit('.', 1)[1].lower() not in ALLOWED_AUDIO_EXTENSIONS:
+        return None, (jsonify({'error': 'Unsupported file format. Please upload a .webm, .mp3, or .wav file.'}), 400)
+    return audio_file, None
+
+class ResponseCache:
+    """Chat results keyed by (model, prompt version, input hash).
+
+    Each entry remembers the notes it was built from so that editing a note drops it.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.entries = LRUCache(max_entries, ttl)
+        self.invalidations = 0
+
+    def key(self, model, prompt_version, input_hash):
+        return f"{model}:v{prompt_version}:{input_hash}"
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        return None if entry is None else entry[0]
+
+    def put(self, key, value, note_ids=()):
+        self.entries.put(key, (value, frozenset(str(note_id) for note_id in note_ids)))
+
+    def invalidate_note(self, note_id):
+        self.invalidations += self.entries.pop_where(lambda entry: str(note_id) in entry[1])
+
+    def stats(self):
+        stats = self.entries.stats()
+        stats['invalidations'] = self.invalidations
+        return stats
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+def summary_cache_key(transcript):
+    return response_cache.key(FINE_TUNED_MODEL_ID, SUMMARY_PROMPT_VERSION, text_hash(transcript))
+
+def build_summary_messages(transcript):
+    summary_prompt = (
+        "You are an intelligent assistant designed to summarize spoken notes, identify key information, suggest relevant tags, and create a concise title.\n"
+        "Your goal is to provide a concise summary, extract any explicit tasks or timeline information, categorize the content with appropriate tags, and generate a brief, descriptive title. IF ANY TYPOS OR WORDS WHICH DON'T MAKE SENSE ARE PRESENT IN THE INPUT, FIX THEM WITH THE MOST RELEVANT WORD.\n"
+        "\n"
+        "Please analyze the following transcript and return your response in a strict JSON format.\n"
+        "The JSON should contain these exact keys:\n"
+        "- \"title\": A concise, descriptive title for the note (max 10 words).\n"
+        "- \"summary\": A concise summary of the transcript.\n"
+        "- \"is_timeline\": boolean (true if the transcript describes a sequence of events, dates, or steps in a clear chronological order or process, false otherwise).\n"
+        "- \"detected_tasks\": an array of strings. Each string should be a clearly identified task, action item, or instruction mentioned in the transcript. If no tasks are explicitly mentioned, this array should be empty.\n"
+        "- \"tags\": an array of strings. Each string should be a relevant tag for the content (e.g., \"Work\", \"Study\", \"Meeting\", \"Personal\", \"Idea\", \"Literature\", \"History\", \"Science\", \"Programming\", \"Project\"). Limit to 3-5 tags.\n"
+        "\n"
+        "Example JSON output:\n"
+        "{\n"
+        "\"title\": \"Meeting Notes on Q3 Planning\",\n"
+        "\"summary\": \"This is a summary of the meeting, covering key discussion points.\",\n"
+        "\"is_timeline\": true,\n"
+        "\"detected_tasks\": [\"Schedule follow-up meeting by Friday\", \"Email report to stakeholders by end of day\"],\n"
+        "\"tags\": [\"Meeting\", \"Work\", \"Planning\"]\n"
+        "}\n"
+        "\n"
+        "If no tasks are detected, the \"detected_tasks\" array must be an empty list `[]`.\n"
+        "If no relevant tags are found, the \"tags\" array must be an empty list `[]`.\n"
+        "The title should be brief and directly reflect the main content.\n"
+        "\n"
+        "Transcript to process:\n"
+        f"{transcript}\n"
+    )
+    return [
+        {"role": "system", "content": "You are a helpful and precise assistant that summarizes text, extracts structured information, generates titles, and provides tags, always responding in valid JSON."},
+        {"role": "user", "content": summary_prompt}
+    ]
+
+def summary_fields(parsed_response):
+    return {
+        'title': parsed_response.get('title', 'Untitled Note'),
+        'summary': parsed_response.get('summary', 'No summary generated.'),
+        'is_timeline': parsed_response.get('is_timeline', False),
+        'detected_tasks': parsed_response.get('detected_tasks', []),
+        'tags': parsed_response.get('tags', [])
+    }
+
+def parse_partial_json(text):
+    """Best-effort parse of a JSON object that is still being streamed.
+
+    Open strings and brackets are closed; if that isn't enough, the text is cut
+    back to the last comma outside a string. Returns None if nothing parses yet.
+    """
+    stack = []
+    in_string = False
+    escape = False
+    last_comma = None
+    for position, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            stack.append('}' if char == '{' else ']')
+        elif char in '}]':
+            if stack:
+                stack.pop()
+        elif char == ',':
+            last_comma = (position, list(stack))
+
+    candidate = text[:-1] if escape else text
+    if in_string:
+        candidate += '"'
+    try:
+        return json.loads(candidate + ''.join(reversed(stack)))
+    except json.JSONDecodeError:
+        pass
+    if last_comma is None:
+        return None
+    position, comma_stack = last_comma
+    try:
+        return json.loads(text[:position] + ''.join(reversed(comma_stack)))
+    except json.JSONDecodeError:
+        return None
+
 @app.route('/error', methods=['GET'])
 def err():
     return render_template('error.html')
@@ -56,7 +1844,11 @@ def sign():
         if users_collection.find_one({'username': username}):
             flash('Username already exists. Try another one.', "warning")
             return redirect(url_for('sign'))
-        users_collection.insert_one({'username': username, 'password': password})
+        try:
+            users_collection.insert_one({'username': username, 'password': password})
+        except DuplicateKeyError:
+            flash('Username already exists. Try another one.', "warning")
+            return redirect(url_for('sign'))
         print(f"Flask Console: Account created for {username}")
         session['username'] = username
         flash('Account created successfully!', 'success')
@@ -105,32 +1897,54 @@ def neuralvault():
 @app.route('/transcribe_audio', methods=['POST'])
 @login_required
 def transcribe_audio():
-    if 'audio_file' not in request.files:
-        return jsonify({'error': 'No audio file provided'}), 400
-
-    audio_file = request.files['audio_file']
-
-    allowed_extensions = {'webm', 'mp3', 'wav', 'm4a', 'mp4', 'aac', 'flac', 'ogg'}
-    if '.' not in audio_file.filename or \
-       audio_file.filename.rsplit('.', 1)[1].lower() not in allowed_extensions:
-        return jsonify({'error': 'Unsupported file format. Please upload a .webm, .mp3, or .wav file.'}), 400
+    audio_file, error = validate_audio_upload()
+    if error:
+        return error
 
+    keep_audio = request.form.get('keep_audio') == '1'
+    path = spool_upload(audio_file)
     try:
-        audio_bytes = audio_file.read()
-        audio_io = io.BytesIO(audio_bytes)
-        audio_io.name = audio_file.filename 
-
-        transcript_response = openai_client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio_io
-        )
-
-        transcript = transcript_response.text
-        return jsonify({'transcript': transcript})
+        response = {'transcript': transcribe_file(path)}
+        if keep_audio:
+            response['upload_id'] = keep_upload(session.get('username'), path, audio_file)
+        return jsonify(response)
 
     except Exception as e:
         print(f"Error during transcription: {e}")
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+    finally:
+        os.remove(path)
+
+@app.route('/transcribe_audio_stream', methods=['POST'])
+@login_required
+def transcribe_audio_stream():
+    """Same as /transcribe_audio, but sends each chunk's text over SSE as it finishes."""
+    audio_file, error = validate_audio_upload()
+    if error:
+        return error
+
+    keep_audio = request.form.get('keep_audio') == '1'
+    username = session.get('username')
+    path = spool_upload(audio_file)
+
+    def generate():
+        try:
+            parts = {}
+            for index, total, text in iter_chunk_transcripts(path):
+                parts[index] = text
+                yield sse_event('chunk', {'index': index, 'total': total, 'text': text})
+            done = {'transcript': stitch_transcripts([parts[index] for index in sorted(parts)])}
+            if keep_audio:
+                done['upload_id'] = keep_upload(username, path, audio_file)
+            yield sse_event('done', done)
+        except Exception as e:
+            print(f"Error during transcription: {e}")
+            yield sse_event('error', {'error': str(e)})
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    # Not a finally in generate(): that never runs if the client leaves before the first read.
+    response.call_on_close(lambda: os.remove(path))
+    return response
 
 @app.route('/generate_summary', methods=['POST'])
 @login_required
@@ -141,70 +1955,153 @@ def generate_summary():
     if not transcript:
         return jsonify({'error': 'No transcript provided for summarization.'}), 400
 
+    if data.get('stream'):
+        return Response(stream_with_context(stream_summary(transcript)), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
     try:
-        summary_prompt = (
-            "You are an intelligent assistant designed to summarize spoken notes, identify key information, suggest relevant tags, and create a concise title.\n"
-            "Your goal is to provide a concise summary, extract any explicit tasks or timeline information, categorize the content with appropriate tags, and generate a brief, descriptive title. IF ANY TYPOS OR WORDS WHICH DON'T MAKE SENSE ARE PRESENT IN THE INPUT, FIX THEM WITH THE MOST RELEVANT WORD.\n"
-            "\n"
-            "Please analyze the following transcript and return your response in a strict JSON format.\n"
-            "The JSON should contain these exact keys:\n"
-            "- \"title\": A concise, descriptive title for the note (max 10 words).\n"
-            "- \"summary\": A concise summary of the transcript.\n"
-            "- \"is_timeline\": boolean (true if the transcript describes a sequence of events, dates, or steps in a clear chronological order or process, false otherwise).\n"
-            "- \"detected_tasks\": an array of strings. Each string should be a clearly identified task, action item, or instruction mentioned in the transcript. If no tasks are explicitly mentioned, this array should be empty.\n"
-            "- \"tags\": an array of strings. Each string should be a relevant tag for the content (e.g., \"Work\", \"Study\", \"Meeting\", \"Personal\", \"Idea\", \"Literature\", \"History\", \"Science\", \"Programming\", \"Project\"). Limit to 3-5 tags.\n"
-            "\n"
-            "Example JSON output:\n"
-            "{\n"
-            "\"title\": \"Meeting Notes on Q3 Planning\",\n"
-            "\"summary\": \"This is a summary of the meeting, covering key discussion points.\",\n"
-            "\"is_timeline\": true,\n"
-            "\"detected_tasks\": [\"Schedule follow-up meeting by Friday\", \"Email report to stakeholders by end of day\"],\n"
-            "\"tags\": [\"Meeting\", \"Work\", \"Planning\"]\n"
-            "}\n"
-            "\n"
-            "If no tasks are detected, the \"detected_tasks\" array must be an empty list `[]`.\n"
-            "If no relevant tags are found, the \"tags\" array must be an empty list `[]`.\n"
-            "The title should be brief and directly reflect the main content.\n"
-            "\n"
-            "Transcript to process:\n"
-            f"{transcript}\n"
-        )
+        return jsonify(summarize_transcript(transcript))
 
-        chat_completion = openai_client.chat.completions.create(
-            model=FINE_TUNED_MODEL_ID, 
-            messages=[
-                {"role": "system", "content": "You are a helpful and precise assistant that summarizes text, extracts structured information, generates titles, and provides tags, always responding in valid JSON."},
-                {"role": "user", "content": summary_prompt}
-            ],
-            response_format={"type": "json_object"}
-        )
+    except ValueError as e:
+        return error_response(e)
+    except Exception as e:
+        print(f"Error during summary generation: {e}")
+        return error_response(e)
 
-        llm_response_content = chat_completion.choices[0].message.content.strip()
+def summarize_transcript(transcript):
+    cache_key = summary_cache_key(transcript)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return apply_local_tags(dict(cached), transcript)
 
-        try:
-            parsed_response = json.loads(llm_response_content)
-        except json.JSONDecodeError:
-            print(f"LLM did not return valid JSON: {llm_response_content}")
-            return jsonify({'error': 'AI response could not be parsed. Please try again.'}), 500
+    chat_completion = openai_client.chat.completions.create(
+        model=FINE_TUNED_MODEL_ID, 
+        messages=build_summary_messages(transcript),
+        response_format={"type": "json_object"}
+    )
 
-        title = parsed_response.get('title', 'Untitled Note')
-        summary = parsed_response.get('summary', 'No summary generated.')
-        is_timeline = parsed_response.get('is_timeline', False)
-        detected_tasks = parsed_response.get('detected_tasks', [])
-        tags = parsed_response.get('tags', [])
+    llm_response_content = chat_completion.choices[0].message.content.strip()
 
-        return jsonify({
-            'title': title,
-            'summary': summary,
-            'is_timeline': is_timeline,
-            'detected_tasks': detected_tasks,
-            'tags': tags
-        })
+    try:
+        with span('json_parse'):
+            parsed_response = json.loads(llm_response_content)
+    except json.JSONDecodeError:
+        print(f"LLM did not return valid JSON: {llm_response_content}")
+        raise ValueError('AI response could not be parsed. Please try again.')
+
+    fields = summary_fields(parsed_response)
+    response_cache.put(cache_key, fields)
+    return apply_local_tags(dict(fields), transcript)
+
+def apply_local_tags(fields, transcript):
+    """Use the local classifier's label as the primary tag when it is confident."""
+    tags = primary_tag(fields['tags'], transcript)
+    if tags is not None:
+        fields['tags'] = tags[:5]
+    return fields
+
+def stream_summary(transcript):
+    """SSE stream: 'fields' events with each key as soon as its value changes, then 'done'."""
+    cache_key = summary_cache_key(transcript)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        yield sse_event('fields', cached)
+        yield sse_event('done', apply_local_tags(dict(cached), transcript))
+        return
+    try:
+        stream = openai_client.chat.completions.create(
+            model=FINE_TUNED_MODEL_ID,
+            messages=build_summary_messages(transcript),
+            response_format={"type": "json_object"},
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        content = ''
+        sent = {}
+        for chunk in stream:
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            content += chunk.choices[0].delta.content
+            partial = parse_partial_json(content)
+            if not isinstance(partial, dict):
+                continue
+            changed = {key: value for key, value in partial.items() if sent.get(key) != value}
+            if changed:
+                sent.update(changed)
+                yield sse_event('fields', changed)
+
+        try:
+            parsed_response = json.loads(content)
+        except json.JSONDecodeError:
+            print(f"LLM did not return valid JSON: {content}")
+            yield sse_event('error', {'error': 'AI response could not be parsed. Please try again.'})
+            return
+        fields = summary_fields(parsed_response)
+        response_cache.put(cache_key, fields)
+        yield sse_event('done', apply_local_tags(dict(fields), transcript))
 
     except Exception as e:
         print(f"Error during summary generation: {e}")
-        return jsonify({'error': str(e)}), 500
+        yield sse_event('error', {'error': str(e)})
+
+def normalize_tasks(detected_tasks):
+    """detected_tasks as {'task', 'completed'} dicts; older notes stored bare strings."""
+    normalized_tasks = []
+    for task_item in detected_tasks or []:
+        if isinstance(task_item, dict) and 'task' in task_item:
+            normalized_tasks.append({'task': task_item['task'], 'completed': bool(task_item.get('completed', False))})
+        else:
+            normalized_tasks.append({'task': str(task_item), 'completed': False})
+    return normalized_tasks
+
+def note_tasks(note):
+    tasks = note.get('detected_tasks')
+    return normalize_tasks(tasks if isinstance(tasks, list) else [])
+
+def task_id(note_id, position):
+    return f"{note_id}:{position}"
+
+def sync_note_tasks(username, note_id, tasks, title, timestamp):
+    """Mirror a note's detected_tasks into the tasks collection, one document per position."""
+    operations = [
+        ReplaceOne({'_id': task_id(note_id, position)}, {
+            'username': username,
+            'note_id': note_id,
+            'position': position,
+            'task': task['task'],
+            'completed': task['completed'],
+            'note_title': title,
+            'timestamp': timestamp
+        }, upsert=True)
+        for position, task in enumerate(tasks)
+    ]
+    operations.append(DeleteMany({'note_id': note_id, 'position': {'$gte': len(tasks)}}))
+    tasks_collection.bulk_write(operations, ordered=False)
+
+def create_note(username, title, transcript, summary, tags, detected_tasks, audio_file_id, note_id=None):
+    """Insert a note and return its id as a string.
+
+    Passing note_id makes the write idempotent: a second call with the same id is a no-op.
+    """
+    note_data = {
+        'username': username,
+        'timestamp': datetime.now(),
+        'title': title,
+        'transcript': transcript,
+        'summary': summary,
+        'tags': tags,
+        'detected_tasks': [{"task": task_str, "completed": False} for task_str in detected_tasks or []],
+        'audio_file_id': audio_file_id
+    }
+    note_data['artifacts'] = {name: artifact_record(note_data, name) for name in ('tags', 'tasks')}
+    if note_id is None:
+        note_id = notes_collection.insert_one(note_data).inserted_id
+    else:
+        notes_collection.update_one({'_id': note_id}, {'$setOnInsert': note_data}, upsert=True)
+    sync_note_tasks(username, note_id, note_data['detected_tasks'], title, note_data['timestamp'])
+    index_note_text(username, note_id, note_data)
+    touch_vault(username)
+    print(f"Note saved for {username} - Title: {title}, ID: {note_id}")
+    return str(note_id)
 
 @app.route('/save_note', methods=['POST'])
 @login_required
@@ -216,32 +2113,29 @@ def save_note():
     tags = data.get('tags')
     detected_tasks_raw = data.get('detected_tasks') 
     audio_base64 = data.get('audio_base64')
+    upload_id = data.get('upload_id')
 
-    if not all([title, transcript, summary, audio_base64]):
+    if not all([title, transcript, summary]) or not (audio_base64 or upload_id):
         return jsonify({'error': 'Missing data for saving note.'}), 400
 
     try:
-        detected_tasks_for_db = [{"task": task_str, "completed": False} for task_str in detected_tasks_raw]
-
-        note_data = {
-            'username': session.get('username'),
-            'timestamp': datetime.now(),
-            'title': title,
-            'transcript': transcript,
-            'summary': summary,
-            'tags': tags,
-            'detected_tasks': detected_tasks_for_db, 
-            'audio_base64': audio_base64
-        }
+        if upload_id:
+            audio_file_id = claim_audio_upload(session.get('username'), upload_id)
+            if audio_file_id is None:
+                return jsonify({'error': 'Audio upload not found.'}), 404
+        else:
+            audio_file_id = store_audio(session.get('username'), base64.b64decode(audio_base64))
 
-        result = notes_collection.insert_one(note_data)
-        new_note_id = str(result.inserted_id) 
-        print(f"Note saved for {session.get('username')} - Title: {title}, ID: {new_note_id}")
+        new_note_id = create_note(
+            session.get('username'), title, transcript, summary, tags, detected_tasks_raw, audio_file_id
+        )
+        enqueue_artifacts(session.get('username'), [ObjectId(new_note_id)], ['embedding'])
+        start_artifact_sweep(session.get('username'))
         return jsonify({'message': 'Note saved successfully!', 'noteId': new_note_id}), 200
 
     except Exception as e:
         print(f"Error saving note: {e}")
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
 
 @app.route('/update_note', methods=['POST'])
 @login_required
@@ -269,30 +2163,40 @@ def update_note():
         }
 
         if detected_tasks is not None:
-            normalized_tasks = []
-            for task_item in detected_tasks:
-                if isinstance(task_item, dict) and 'task' in task_item:
-                    normalized_tasks.append({'task': task_item['task'], 'completed': task_item.get('completed', False)})
-                else: 
-                    normalized_tasks.append({'task': str(task_item), 'completed': False})
-            update_fields['detected_tasks'] = normalized_tasks
-
-        result = notes_collection.update_one(
+            update_fields['detected_tasks'] = normalize_tasks(detected_tasks)
+
+        note = notes_collection.find_one_and_update(
             {'_id': object_note_id, 'username': session.get('username')},
-            {'$set': update_fields}
+            {'$set': update_fields},
+            projection=ARTIFACT_FIELDS,
+            return_document=ReturnDocument.AFTER
         )
 
-        if result.matched_count == 0:
+        if note is None:
             return jsonify({'error': 'Note not found or unauthorized to update.'}), 404
-        if result.modified_count == 0:
-            return jsonify({'message': 'No changes detected or note already up to date.'}), 200
 
+        touch_vault(session.get('username'))
+        response_cache.invalidate_note(object_note_id)
+        index_note_text(session.get('username'), object_note_id, update_fields)
+        stale = stale_artifacts(note)
+        if detected_tasks is not None or 'tasks' in stale:
+            # Task positions are addressed by /tasks/bulk, so the mirror is rebuilt right away.
+            build_task_artifacts([note])
+        else:
+            tasks_collection.update_many(
+                {'note_id': object_note_id},
+                {'$set': {'timestamp': update_fields['timestamp']}}
+            )
+        stale = [name for name in stale if name != 'tasks']
+        if stale:
+            enqueue_artifacts(session.get('username'), [object_note_id], stale)
+            start_artifact_sweep(session.get('username'))
         print(f"Note updated for {session.get('username')} - ID: {note_id}")
         return jsonify({'message': 'Note updated successfully!'}), 200
 
     except Exception as e:
         print(f"Error updating note: {e}")
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
 
 @app.route('/get_note_details/<note_id>', methods=['GET'])
 @login_required
@@ -312,26 +2216,50 @@ def get_note_details(note_id):
             if isinstance(note.get('timestamp'), datetime):
                 note['timestamp'] = {'$date': note['timestamp'].isoformat()}
 
-            if 'detected_tasks' in note and isinstance(note['detected_tasks'], list):
-                normalized_tasks = []
-                for task_item in note['detected_tasks']:
-                    if isinstance(task_item, dict) and 'task' in task_item:
-                        normalized_tasks.append({'task': task_item['task'], 'completed': task_item.get('completed', False)})
-                    else:
-                        normalized_tasks.append({'task': str(task_item), 'completed': False})
-                note['detected_tasks'] = normalized_tasks
-            else:
-                note['detected_tasks'] = [] 
+            note['detected_tasks'] = note_tasks(note)
+            for position, task in enumerate(note['detected_tasks']):
+                task['id'] = task_id(note['_id'], position)
 
             if 'embedding' in note:
                 del note['embedding']
+            has_audio = note.pop('audio_file_id', None) is not None
+            has_audio = note.pop('audio_base64', None) is not None or has_audio
+            if has_audio:
+                note['audio_url'] = url_for('note_audio', note_id=note['_id'])
 
             return jsonify({'note': note}), 200
         else:
             return jsonify({'error': 'Note not found or you do not have permission to view it.'}), 404
     except Exception as e:
         print(f"Error fetching note details: {e}")
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+
+@app.route('/note_audio/<note_id>', methods=['GET'])
+@login_required
+def note_audio(note_id):
+    if not ObjectId.is_valid(note_id):
+        return jsonify({'error': 'Invalid note ID format.'}), 400
+
+    note = notes_collection.find_one(
+        {'_id': ObjectId(note_id), 'username': session.get('username')},
+        {'audio_file_id': 1, 'audio_base64': 1}
+    )
+    if not note:
+        return jsonify({'error': 'Note not found or you do not have permission to view it.'}), 404
+
+    try:
+        if note.get('audio_file_id'):
+            audio = audio_fs.get(note['audio_file_id'])
+            return stream_byte_range(
+                audio, audio.length, audio.content_type or 'audio/webm',
+                etag=(audio.metadata or {}).get('sha256')
+            )
+        if note.get('audio_base64'):
+            audio_bytes = base64.b64decode(note['audio_base64'])
+            return stream_byte_range(io.BytesIO(audio_bytes), len(audio_bytes), 'audio/webm')
+        return jsonify({'error': 'This note has no audio.'}), 404
+    except gridfs.errors.NoFile:
+        return jsonify({'error': 'Audio file is missing.'}), 404
 
 
 @app.route('/semantic')
@@ -339,6 +2267,56 @@ def get_note_details(note_id):
 def semantic():
     return render_template('semantic.html')
 
+def encode_cursor(note):
+    cursor = json.dumps({'t': note['timestamp'].isoformat(), 'id': str(note['_id'])})
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+def decode_cursor(cursor, id_type=ObjectId):
+    data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return datetime.fromisoformat(data['t']), id_type(data['id'])
+
+def list_notes_page(username, query):
+    """One keyset page of note cards for the query, with ETag / If-None-Match handling.
+
+    Request args: limit, cursor (from the previous page's next_cursor) and
+    fields (comma-separated extras from NOTE_OPTIONAL_FIELDS).
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', NOTES_PAGE_SIZE)), 1), NOTES_MAX_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        if cursor:
+            timestamp, last_id = decode_cursor(cursor)
+    except (ValueError, TypeError, KeyError):
+        return jsonify({'error': 'Invalid limit or cursor.'}), 400
+    extra_fields = [field for field in request.args.get('fields', '').split(',') if field in NOTE_OPTIONAL_FIELDS]
+
+    etag = text_hash(f"{username}:{vault_version(username)}:{request.full_path}")
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    if cursor:
+        query = {**query, '$or': [
+            {'timestamp': {'$lt': timestamp}},
+            {'timestamp': timestamp, '_id': {'$lt': last_id}}
+        ]}
+    projection = {field: 1 for field in NOTE_CARD_FIELDS + extra_fields}
+    notes = list(notes_collection.find(query, projection)
+                 .sort([('timestamp', -1), ('_id', -1)])
+                 .limit(limit + 1))
+
+    next_cursor = encode_cursor(notes[limit - 1]) if len(notes) > limit else None
+    notes = notes[:limit]
+    for note in notes:
+        note['_id'] = str(note['_id'])
+        note['has_embedding'] = note.pop('embedding_model', None) == EMBEDDING_MODEL
+
+    response = jsonify({'notes': notes, 'next_cursor': next_cursor})
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/get_user_notes', methods=['GET'])
 @login_required
 def get_user_notes():
@@ -347,15 +2325,10 @@ def get_user_notes():
         return jsonify({'error': 'User not logged in.'}), 401
 
     try:
-        user_notes = list(notes_collection.find({'username': username}, {'embedding': 0}).sort('timestamp', -1))
-        for note in user_notes:
-            note['_id'] = str(note['_id'])
-            if 'audio_base64' in note:
-                del note['audio_base64'] 
-        return jsonify(user_notes), 200
+        return list_notes_page(username, {'username': username})
     except Exception as e:
         print(f"Error fetching user notes: {e}")
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
 
 @app.route('/get_notes_by_category', methods=['GET'])
 @login_required
@@ -369,20 +2342,142 @@ def get_notes_by_category():
         return jsonify({'error': 'Category not provided.'}), 400
 
     try:
-        filtered_notes = list(notes_collection.find(
-            {'username': username, 'tags': category},
-            {'embedding': 0}
-        ).sort('timestamp', -1))
-
-        for note in filtered_notes:
-            note['_id'] = str(note['_id']) 
-            if 'audio_base64' in note:
-                del note['audio_base64']
-        return jsonify({'notes': filtered_notes}), 200
+        if category not in user_metadata(username)['tags']:
+            return jsonify({'notes': [], 'next_cursor': None}), 200
+        return list_notes_page(username, {'username': username, 'tags': category})
     except Exception as e:
         print(f"Error fetching notes by category: {e}")
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+
+
+@app.route('/user_metadata', methods=['GET'])
+@login_required
+def get_user_metadata():
+    """Note count, tag counts (most used first) and last-modified time of the vault."""
+    username = session.get('username')
+    try:
+        metadata = user_metadata(username)
+        tags = sorted(metadata['tags'].items(), key=lambda item: (-item[1], item[0]))
+        return jsonify({
+            'note_count': metadata['note_count'],
+            'tags': [{'tag': tag, 'count': count} for tag, count in tags],
+            'modified_at': metadata['modified_at']
+        }), 200
+    except Exception as e:
+        print(f"Error fetching user metadata: {e}")
+        return error_response(e)
+
+@app.route('/tasks', methods=['GET'])
+@login_required
+def list_tasks():
+    """Keyset page of the user's tasks across all notes, newest note first.
+
+    Request args: status (open, completed or all; default open), limit and cursor.
+    """
+    username = session.get('username')
+    status = request.args.get('status', 'open')
+    if status not in ('open', 'completed', 'all'):
+        return jsonify({'error': 'status must be open, completed or all.'}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', NOTES_PAGE_SIZE)), 1), NOTES_MAX_PAGE_SIZE)
+        cursor = request.args.get('cursor')
+        if cursor:
+            timestamp, last_id = decode_cursor(cursor, id_type=str)
+    except (ValueError, TypeError, KeyError):
+        return jsonify({'error': 'Invalid limit or cursor.'}), 400
+
+    query = {'username': username}
+    if status != 'all':
+        query['completed'] = status == 'completed'
+    if cursor:
+        query['$or'] = [
+            {'timestamp': {'$lt': timestamp}},
+            {'timestamp': timestamp, '_id': {'$lt': last_id}}
+        ]
+    try:
+        tasks = list(tasks_collection.find(query, {'username': 0})
+                     .sort([('timestamp', -1), ('_id', -1)])
+                     .limit(limit + 1))
+        next_cursor = encode_cursor(tasks[limit - 1]) if len(tasks) > limit else None
+        tasks = tasks[:limit]
+        for task in tasks:
+            task['note_id'] = str(task['note_id'])
+        return jsonify({'tasks': tasks, 'next_cursor': next_cursor}), 200
+    except Exception as e:
+        print(f"Error listing tasks: {e}")
+        return error_response(e)
 
+@app.route('/tasks/bulk', methods=['POST'])
+@login_required
+def bulk_update_tasks():
+    """Set the completed flag of many tasks: {"updates": [{"id": "<note_id>:<position>", "completed": true}, ...]}.
+
+    Each task is one positional $set on its note, so the rest of the note is left alone. Older notes
+    that still store bare strings get their whole detected_tasks list rewritten in the new form instead,
+    since a positional $set cannot reach into a string.
+    """
+    username = session.get('username')
+    updates = (request.get_json() or {}).get('updates') or []
+    requested = {}
+    for update in updates:
+        note_id, _, position = str(update.get('id', '')).partition(':')
+        if not ObjectId.is_valid(note_id) or not position.isdigit() or not isinstance(update.get('completed'), bool):
+            return jsonify({'error': f"Invalid task update: {update}"}), 400
+        requested.setdefault(ObjectId(note_id), {})[int(position)] = update['completed']
+    if not updates:
+        return jsonify({'error': 'No task updates provided.'}), 400
+
+    try:
+        notes = {'_id': {'$in': list(requested)}, 'username': username}
+        note_operations = []
+        for note in notes_collection.find(notes, {'detected_tasks': 1}):
+            stored = note.get('detected_tasks')
+            changes = requested[note['_id']]
+            if isinstance(stored, list) and all(isinstance(task, dict) for task in stored):
+                note_operations.extend(
+                    UpdateOne(
+                        {'_id': note['_id'], 'username': username, f'detected_tasks.{position}': {'$exists': True}},
+                        {'$set': {f'detected_tasks.{position}.completed': completed}}
+                    )
+                    for position, completed in changes.items()
+                )
+                continue
+            tasks = note_tasks(note)
+            for position, completed in changes.items():
+                if position < len(tasks):
+                    tasks[position]['completed'] = completed
+            # Matching the old list keeps a concurrent edit of the note from being overwritten.
+            note_operations.append(UpdateOne(
+                {'_id': note['_id'], 'username': username, 'detected_tasks': stored},
+                {'$set': {'detected_tasks': tasks}}
+            ))
+
+        error = None
+        result = {'nMatched': 0, 'nModified': 0}
+        if note_operations:
+            try:
+                result = notes_collection.bulk_write(note_operations, ordered=False).bulk_api_result
+            except BulkWriteError as e:
+                error, result = e, e.details
+
+        # The tasks collection mirrors what the notes now hold, including when only some writes landed.
+        task_operations = []
+        for note in notes_collection.find(notes, {'detected_tasks': 1}):
+            tasks = note_tasks(note)
+            task_operations.extend(
+                UpdateOne({'_id': task_id(note['_id'], position), 'username': username}, {'$set': {'completed': tasks[position]['completed']}})
+                for position in requested[note['_id']] if position < len(tasks)
+            )
+        if task_operations:
+            tasks_collection.bulk_write(task_operations, ordered=False)
+        if result['nModified']:
+            touch_vault(username)
+        if error is not None:
+            raise error
+        return jsonify({'matched': result['nMatched'], 'modified': result['nModified']}), 200
+    except Exception as e:
+        print(f"Error updating tasks: {e}")
+        return error_response(e)
 
 @app.route('/generate_embedding', methods=['POST'])
 @login_required
@@ -395,21 +2490,102 @@ def generate_embedding_route():
         return jsonify({'error': 'No text provided for embedding.'}), 400
 
     try:
-        response = openai_client.embeddings.create(
-            input=text,
-            model="text-embedding-3-small" 
-        )
-        embedding = response.data[0].embedding
+        embedding = embed_texts([text])[0]
         if note_id and ObjectId.is_valid(note_id):
-            notes_collection.update_one(
+            result = notes_collection.update_one(
                 {'_id': ObjectId(note_id), 'username': session.get('username')},
-                {'$set': {'embedding': embedding}}
+                {'$set': stored_embedding(embedding, text)}
             )
-        return jsonify({'embedding': embedding}), 200
+            if result.matched_count:
+                index_note_embedding(session.get('username'), note_id, embedding)
+                touch_vault(session.get('username'))
+            # The vector stays on the server; only callers without a note get it back.
+            return jsonify({'note_id': note_id, 'stored': bool(result.matched_count), 'embedding_format': embedding_format()}), 200
+        return jsonify({'embedding': compact_vector(embedding).tolist()}), 200
 
     except Exception as e:
         print(f"Error generating embedding: {e}")
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+
+@app.route('/retag_notes', methods=['POST'])
+@login_required
+def retag_notes():
+    """Run the local classifier over the whole vault and make its label each note's first tag."""
+    username = session.get('username')
+    note_classifier = get_note_classifier()
+    if note_classifier is None:
+        return jsonify({'error': 'No note classifier is loaded. Run `flask train-classifier` first.'}), 503
+
+    try:
+        notes = list(notes_collection.find({'username': username}, ARTIFACT_FIELDS))
+        retagged = build_tag_artifacts(notes)
+        if retagged:
+            touch_vault(username)
+
+        return jsonify({
+            'classifier_version': note_classifier['version'],
+            'notes': len(notes),
+            'retagged': retagged
+        }), 200
+    except Exception as e:
+        print(f"Error retagging notes: {e}")
+        return error_response(e)
+
+@app.route('/embed_notes', methods=['GET', 'POST'])
+@login_required
+def embed_notes():
+    """POST queues the notes that were never embedded for the artifact sweep; GET reports on it.
+
+    Notes embedded by an older model are left to `flask sweep-artifacts`, which rolls a
+    new model out a slice at a time instead of re-embedding whole vaults on page load.
+    """
+    username = session.get('username')
+    if request.method == 'POST':
+        note_ids = [note['_id'] for note in notes_collection.find(missing_embedding_filter(username), {'_id': 1})]
+        if note_ids:
+            enqueue_artifacts(username, note_ids, ['embedding'])
+        if note_ids or artifact_queue_collection.count_documents({'username': username}, limit=1):
+            start_artifact_sweep(username)
+
+    with artifact_sweeps_lock:
+        running = username in artifact_sweeps
+        error = artifact_sweep_errors.get(username)
+    job = {
+        'status': 'running' if running else 'error' if error else 'done',
+        'pending': artifact_queue_collection.count_documents({'username': username, 'artifact': 'embedding'}),
+        'error': error
+    }
+    return jsonify(job), 202 if request.method == 'POST' else 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of route timings and model usage."""
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/embedding_cache_stats', methods=['GET'])
+@login_required
+def embedding_cache_stats():
+    return jsonify(embedding_cache.stats()), 200
+
+@app.route('/semantic_graph', methods=['GET'])
+@login_required
+def semantic_graph():
+    """Nodes with cluster labels and 2-D positions, plus kNN edges, for the semantic map."""
+    try:
+        with span('semantic_graph'):
+            graph = get_semantic_graph(session['username'])
+        return jsonify(graph), 200
+    except Exception as e:
+        print(f"Error building semantic graph: {e}")
+        return error_response(e)
+
+@app.route('/response_cache_stats', methods=['GET'])
+@login_required
+def response_cache_stats():
+    return jsonify(response_cache.stats()), 200
 
 @app.route('/semantic_search', methods=['POST'])
 @login_required
@@ -417,58 +2593,168 @@ def semantic_search():
     data = request.get_json()
     query_text = data.get('query')
     target_note_id = data.get('noteId') 
-    num_results = data.get('num_results', 5)
+    mode = data.get('mode', 'vector')
 
     username = session.get('username')
     if not username:
         return jsonify({'error': 'User not logged in.'}), 401
-
+    if mode not in SEARCH_MODES:
+        return jsonify({'error': f"Unknown search mode. Use one of: {', '.join(SEARCH_MODES)}."}), 400
     try:
-        # Corrected projection: only exclude embedding, keep audio_base64
-        all_user_notes = list(notes_collection.find({'username': username, 'embedding': {'$exists': True}}, {})) # Fetch all fields including audio_base64 and embedding for processing.
-        if not all_user_notes:
-            return jsonify({'message': 'No notes with embeddings found for your account.'}), 200
+        num_results = min(max(int(data.get('num_results', 5)), 1), SEARCH_MAX_RESULTS)
+    except (ValueError, TypeError):
+        return jsonify({'error': 'num_results must be an integer.'}), 400
+    if mode != 'vector' and not query_text:
+        return jsonify({'error': f'Query text is required for {mode} search.'}), 400
 
-        query_embedding = None
-        if query_text:
-            query_response = openai_client.embeddings.create(input=query_text, model="text-embedding-3-small")
-            query_embedding = query_response.data[0].embedding
-        elif target_note_id and ObjectId.is_valid(target_note_id):
-            target_note = notes_collection.find_one({'_id': ObjectId(target_note_id), 'username': username})
-            if target_note and 'embedding' in target_note:
-                query_embedding = target_note['embedding']
+    try:
+        keyword_hits = []
+        if mode != 'vector':
+            with span('keyword_search'):
+                # Hybrid mode fuses a longer list from each side so notes found by only one still rank.
+                keyword_hits = get_keyword_index(username).search(query_text, num_results if mode == 'keyword' else num_results * 4)
+
+        vector_hits = []
+        if mode != 'keyword':
+            index = get_vector_index(username)
+            if not len(index) and mode == 'vector':
+                return jsonify({'message': 'No notes with embeddings found for your account.'}), 200
+
+            query_embedding = None
+            if query_text:
+                query_embedding = compact_vector(embed_texts([query_text])[0])
+            elif target_note_id and ObjectId.is_valid(target_note_id):
+                query_embedding = index.get_vector(target_note_id)
+                if query_embedding is None:
+                    target_note = notes_collection.find_one(
+                        {**indexed_embedding_filter(username), '_id': ObjectId(target_note_id)},
+                        {'embedding': 1}
+                    )
+                    if not target_note or target_note.get('embedding') is None or not len(target_note['embedding']):
+                        return jsonify({'error': 'Target note not found or no embedding for it.'}), 404
+                    query_embedding = compact_vector(target_note['embedding'])
             else:
-                return jsonify({'error': 'Target note not found or no embedding for it.'}), 404
-        else:
-            return jsonify({'error': 'Either query text or target note ID must be provided.'}), 400
+                return jsonify({'error': 'Either query text or target note ID must be provided.'}), 400
 
-        if not query_embedding:
-            return jsonify({'error': 'Could not generate query embedding.'}), 500
+            if query_embedding is None or not len(query_embedding):
+                return jsonify({'error': 'Could not generate query embedding.'}), 500
 
-        similarities = []
-        for note in all_user_notes:
-            if note['_id'] == ObjectId(target_note_id) and target_note_id: 
-                continue
-            if 'embedding' in note and note['embedding']:
-                similarity = np.dot(query_embedding, note['embedding'])
-                similarities.append((similarity, note))
-
-        similarities.sort(key=lambda x: x[0], reverse=True)
-        top_n_related_notes = [note for _, note in similarities[:num_results]]
-        for note in top_n_related_notes:
-            note['_id'] = str(note['_id'])
-            if 'embedding' in note:
-                del note['embedding']
-            if 'audio_base64' in note:
-                del note['audio_base64']
+            with span('vector_search'):
+                vector_hits = index.search(query_embedding, num_results if mode == 'vector' else num_results * 4, exclude_id=target_note_id)
 
+        if mode == 'hybrid':
+            hits = fuse_rankings(vector_hits, keyword_hits, num_results, float(data.get('alpha', HYBRID_ALPHA)))
+        else:
+            hits = vector_hits if mode == 'vector' else keyword_hits
+        hit_ids = [ObjectId(note_id) for note_id, _ in hits]
+        notes_by_id = {
+            str(note['_id']): note
+            for note in notes_collection.find(
+                {'_id': {'$in': hit_ids}, 'username': username},
+                {'embedding': 0, 'audio_base64': 0, 'audio_file_id': 0}
+            )
+        }
+        top_n_related_notes = []
+        for note_id, _ in hits:
+            note = notes_by_id.get(note_id)
+            if note:
+                note['_id'] = note_id
+                top_n_related_notes.append(note)
 
         return jsonify({'related_notes': top_n_related_notes}), 200
 
     except Exception as e:
         print(f"Error during semantic search: {e}")
-        return jsonify({'error': str(e)}), 500
-
+        return error_response(e)
+
+
+digest_executor = ThreadPoolExecutor(max_workers=DIGEST_WORKERS, thread_name_prefix='digest')
+
+def digest_leaf(note):
+    text = f"Title: {note.get('title', 'Untitled')}\nSummary: {note.get('summary', 'No summary.')}"[:DIGEST_NOTE_CHARS]
+    return {'key': text_hash(f"{note['_id']}:{text}"), 'text': text, 'note_ids': [str(note['_id'])], 'complete': True}
+
+def digest_groups(nodes):
+    """Split nodes into runs ending where a node's own hash says so, about DIGEST_FAN_IN long."""
+    if len(nodes) <= DIGEST_FAN_IN:
+        return [nodes]
+    groups, current = [], []
+    for node in nodes:
+        current.append(node)
+        if int(text_hash(node['key'])[:8], 16) % DIGEST_FAN_IN == 0 or len(current) >= 4 * DIGEST_FAN_IN:
+            groups.append(current)
+            current = []
+    if current:
+        groups.append(current)
+    if len(groups) == len(nodes):
+        groups = [nodes[start:start + DIGEST_FAN_IN] for start in range(0, len(nodes), DIGEST_FAN_IN)]
+    return groups
+
+def digest_group(children):
+    """Topic and digest of one group of notes or lower-level digests, cached when every child is complete."""
+    key = response_cache.key(DIGEST_MODEL, DIGEST_PROMPT_VERSION, text_hash(json.dumps([child['key'] for child in children])))
+    complete = all(child['complete'] for child in children)
+    cached = response_cache.get(key) if complete else None
+    if cached is not None:
+        return cached
+
+    combined_text = "\n\n".join(f"{i + 1}. {child['text']}" for i, child in enumerate(children))
+    chat_completion = openai_client.chat.completions.create(
+        model=DIGEST_MODEL,
+        messages=[
+            {"role": "system", "content": (
+                "You condense collections of notes. Reply with a JSON object with two keys: "
+                "\"topic\", the single most prominent common topic as a concise string (\"Miscellaneous\" if there is none), "
+                "and \"digest\", two to four sentences covering what the notes say."
+            )},
+            {"role": "user", "content": f"Notes:\n{combined_text}"}
+        ],
+        response_format={"type": "json_object"},
+        max_tokens=300
+    )
+    with span('json_parse'):
+        parsed = json.loads(chat_completion.choices[0].message.content)
+    topic = str(parsed.get('topic') or 'Miscellaneous').strip()
+    digest = str(parsed.get('digest') or '').strip()
+    node = {
+        'key': key,
+        'text': f"Topic: {topic}\nDigest: {digest}",
+        'topic': topic,
+        'digest': digest,
+        'note_ids': [note_id for child in children for note_id in child['note_ids']],
+        'complete': complete
+    }
+    if complete:
+        response_cache.put(key, node, note_ids=node['note_ids'])
+    return node
+
+def digest_stand_in(children):
+    """Cheap placeholder for a group that missed the deadline: the first line of each child."""
+    text = "Topics: " + "; ".join(child['text'].split('\n', 1)[0].split(': ', 1)[-1] for child in children)
+    return {'key': text_hash(text), 'text': text[:DIGEST_NOTE_CHARS], 'note_ids': [], 'complete': False}
+
+def build_digest(notes):
+    """Reduce the notes level by level to one {'topic', 'digest', 'complete'} node."""
+    deadline = time.time() + DIGEST_TIMEOUT
+    nodes = [digest_leaf(note) for note in sorted(notes, key=lambda note: str(note['_id']))]
+    while True:
+        groups = digest_groups(nodes)
+        if len(groups) == 1:
+            return digest_group(groups[0])
+        if time.time() >= deadline:
+            # Groups of stand-ins are neither cacheable nor awaited any more; only the root is worth a call.
+            nodes = [digest_stand_in(group) for group in groups]
+            continue
+        futures = [digest_executor.submit(digest_group, group) for group in groups]
+        done, _ = wait(futures, timeout=max(0, deadline - time.time()))
+        nodes = []
+        for future, group in zip(futures, groups):
+            if future in done and future.exception() is None:
+                nodes.append(future.result())
+            else:
+                if future in done:
+                    print(f"Digest group failed: {future.exception()}")
+                nodes.append(digest_stand_in(group))
 
 @app.route('/generate_common_topic', methods=['POST'])
 @login_required
@@ -490,10 +2776,29 @@ def generate_common_topic():
         if not notes_to_analyze:
             return jsonify({'error': 'No valid notes found for the provided IDs.'}), 404
 
+        notes_to_analyze.sort(key=lambda note: str(note['_id']))
         combined_text = "Following are summaries of several notes:\n"
         for i, note in enumerate(notes_to_analyze):
             combined_text += f"{i+1}. Title: {note.get('title', 'Untitled')}\n   Summary: {note.get('summary', 'No summary.')}\n"
 
+        if data.get('mode') == 'digest' or count_tokens(combined_text) > DIGEST_DIRECT_TOKENS:
+            root = build_digest(notes_to_analyze)
+            return jsonify({
+                'common_topic': root['topic'],
+                'digest': root['digest'],
+                'complete': root['complete'],
+                'notes': len(notes_to_analyze)
+            }), 200
+
+        input_hash = text_hash(json.dumps([
+            [str(note['_id']), text_hash(f"{note.get('title', '')}\n{note.get('summary', '')}")]
+            for note in notes_to_analyze
+        ]))
+        cache_key = response_cache.key("gpt-3.5-turbo", TOPIC_PROMPT_VERSION, input_hash)
+        common_topic = response_cache.get(cache_key)
+        if common_topic is not None:
+            return jsonify({'common_topic': common_topic}), 200
+
         topic_prompt = (
             "You are an intelligent assistant. Analyze the following collection of note titles and summaries.\n"
             "Your task is to identify the single most prominent common topic or theme that connects these notes.\n"
@@ -517,12 +2822,13 @@ def generate_common_topic():
         common_topic = chat_completion.choices[0].message.content.strip()
         if not common_topic:
             common_topic = "Miscellaneous"
+        response_cache.put(cache_key, common_topic, note_ids=[note['_id'] for note in notes_to_analyze])
 
         return jsonify({'common_topic': common_topic}), 200
 
     except Exception as e:
         print(f"Error generating common topic: {e}")
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
 
 @app.route('/idrak')
 @login_required
@@ -545,36 +2851,38 @@ def ask_idrak():
         return jsonify({'error': 'User not logged in.'}), 401
 
     try:
-        user_notes = list(notes_collection.find({'username': username}, {'title': 1, 'summary': 1, 'transcript': 1}).sort('timestamp', -1))
-
-        context_notes = []
-        for note in user_notes:
-            note_content = f"Title: {note.get('title', 'Untitled')}\n"
-            if note.get('summary'):
-                note_content += f"Summary: {note['summary']}\n"
-            elif note.get('transcript'): 
-                note_content += f"Transcript: {note['transcript']}\n"
-            context_notes.append(note_content)
-        combined_notes_context = "\n---\n".join(context_notes)
-        messages = [
-            {"role": "system", "content": (
-                "You are an intelligent assistant named Idrak. Your purpose is to answer questions "
-                "about the user's notes. You have access to all their notes, including titles, "
-                "summaries, and full transcripts. When answering, consolidate information from "
-                "relevant notes to provide a comprehensive and helpful response. "
-                "If the question cannot be answered from the provided notes, state that. "
-                "Be concise but thorough. Maintain context of the previous conversation."
-            )},
-        ]
-        for msg in conversation_history:
-            messages.append({"role": msg['role'], "content": msg['content']})
-        messages.append({
-            "role": "user",
-            "content": (
-                f"Here are my notes:\n\n{combined_notes_context}\n\n"
-                f"My question: {user_prompt}"
-            )
-        })
+        with span('prompt_build'):
+            context_notes, context_tokens = select_context_notes(username, user_prompt)
+            combined_notes_context = "\n---\n".join(context_notes)
+            messages = [
+                {"role": "system", "content": (
+                    "You are an intelligent assistant named Idrak. Your purpose is to answer questions "
+                    "about the user's notes. You are given the notes most relevant to the question, "
+                    "including titles, summaries, and transcripts. When answering, consolidate information from "
+                    "relevant notes to provide a comprehensive and helpful response. "
+                    "If the question cannot be answered from the provided notes, state that. "
+                    "Be concise but thorough. Maintain context of the previous conversation."
+                )},
+            ]
+            # The client's history already ends with the current question; it is re-sent below with the notes.
+            if conversation_history and conversation_history[-1].get('role') == 'user' \
+                    and conversation_history[-1].get('content') == user_prompt:
+                conversation_history = conversation_history[:-1]
+            messages.extend(compact_history(conversation_history))
+            messages.append({
+                "role": "user",
+                "content": (
+                    f"Here are my notes:\n\n{combined_notes_context}\n\n"
+                    f"My question: {user_prompt}"
+                )
+            })
+
+        prompt_tokens = sum(count_tokens(msg['content']) for msg in messages)
+        print(f"Idrak request for {username}: {len(context_notes)} notes ({context_tokens} tokens), "
+              f"{len(messages) - 2} history messages, {prompt_tokens} prompt tokens")
+
+        if data.get('stream'):
+            return Response(stream_with_context(stream_idrak_answer(messages)), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
         chat_completion = openai_client.chat.completions.create(
             model="gpt-4o",  
@@ -586,11 +2894,63 @@ def ask_idrak():
 
     except Exception as e:
         print(f"Error asking Idrak: {e}")
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+
+def stream_idrak_answer(messages):
+    """SSE stream: a 'delta' event per chunk of the answer, then 'done' with the full text."""
+    try:
+        stream = openai_client.chat.completions.create(
+            model="gpt-4o",
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        parts = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield sse_event('delta', {'text': parts[-1]})
+        yield sse_event('done', {'response': ''.join(parts).strip()})
+    except Exception as e:
+        print(f"Error asking Idrak: {e}")
+        yield sse_event('error', {'error': str(e)})
+
+def pdf_export_key(conversation_history, pdf_prompt):
+    return text_hash(json.dumps(
+        {'history': conversation_history, 'prompt': pdf_prompt, 'version': PDF_TEMPLATE_VERSION},
+        sort_keys=True
+    ))
+
+def pdf_font_path():
+    for path in [PDF_FONT_PATH] + PDF_FONT_FALLBACKS:
+        if path and os.path.exists(path):
+            return path
+    return None
+
+def render_pdf(text, path):
+    """Lay the export out with fpdf2 and write it straight to path."""
+    from fpdf import FPDF
+    pdf = FPDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    font_path = pdf_font_path()
+    if font_path:
+        pdf.add_font('Body', '', font_path)
+        family = 'Body'
+    else:
+        family = 'Helvetica'
+        text = text.encode('latin-1', 'replace').decode('latin-1')
+    pdf.add_page()
+    pdf.set_font(family, size=16)
+    pdf.cell(0, 10, "Idrak Conversation Export", align="C")
+    pdf.ln(20)
+    pdf.set_font(family, size=12)
+    pdf.multi_cell(0, 10, text)
+    pdf.output(path)
 
 @app.route('/generate_pdf', methods=['POST'])
 @login_required
 def generate_pdf():
+    """Queue a PDF export, or point straight at the file if the same export was made before."""
     data = request.get_json()
     conversation_history = data.get('conversation_history', [])
     pdf_prompt = data.get('prompt', "Please compile the conversation into a PDF.") 
@@ -600,38 +2960,626 @@ def generate_pdf():
         return jsonify({'error': 'User not logged in.'}), 401
 
     try:
-        pdf_generation_messages = [
-            {"role": "system", "content": "You are an assistant that generates content for a PDF document. Based on the provided conversation history and a specific request, compile relevant information into a structured text format suitable for a report or document. If the user asks for questions, generate a list of questions based on the conversation. Focus only on generating the text content for the PDF."},
-            {"role": "user", "content": f"Based on this conversation history, {pdf_prompt}:\n\n" + "\n".join([f"{msg['role']}: {msg['content']}" for msg in conversation_history])}
-        ]
-
-        pdf_content_completion = openai_client.chat.completions.create(
-            model="gpt-4o", 
-            messages=pdf_generation_messages,
-            max_tokens=1500 
-        )
-        generated_pdf_text = pdf_content_completion.choices[0].message.content.strip()
-        pdf = FPDF()
-        pdf.set_auto_page_break(auto=True, margin=15)
-        pdf.add_page()
-        pdf.set_font("Arial", size=12)
-        pdf.set_font("Arial", "B", 16)
-        pdf.cell(200, 10, txt="Idrak Conversation Export", ln=True, align="C")
-        pdf.ln(10)
-        pdf.set_font("Arial", size=12)
-        pdf.multi_cell(0, 10, generated_pdf_text)
-        pdf_output = pdf.output(dest='S').encode('latin1') 
-        return send_file(
-            io.BytesIO(pdf_output),
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name='idrak_conversation.pdf'
-        )
+        cache_key = pdf_export_key(conversation_history, pdf_prompt)
+        cached = exports_fs.find_one({'metadata.username': username, 'metadata.cache_key': cache_key})
+        if cached is not None:
+            return jsonify({'status': 'done', 'download_url': url_for('download_export', export_id=str(cached._id))}), 200
+
+        in_flight = jobs_collection.find_one({
+            'username': username, 'kind': 'pdf_export', 'cache_key': cache_key,
+            'status': {'$in': ['queued', 'running']}
+        })
+        if in_flight is not None:
+            return jsonify({'job_id': str(in_flight['_id']), 'status': in_flight['status']}), 202
+
+        now = datetime.utcnow()
+        job_id = jobs_collection.insert_one({
+            'username': username,
+            'kind': 'pdf_export',
+            'status': 'queued',
+            'stage': None,
+            'stages': {name: {'status': 'pending'} for name in PDF_EXPORT_STAGES},
+            'cache_key': cache_key,
+            'conversation_history': conversation_history,
+            'prompt': pdf_prompt,
+            'error': None,
+            'created_at': now,
+            'updated_at': now
+        }).inserted_id
+        job_executor.submit(run_job, job_id)
+        return jsonify({'job_id': str(job_id), 'status': 'queued'}), 202
 
     except Exception as e:
         print(f"Error generating PDF: {e}")
-        return jsonify({'error': str(e)}), 500
+        return error_response(e)
+
+@app.route('/exports/<export_id>', methods=['GET'])
+@login_required
+def download_export(export_id):
+    if not ObjectId.is_valid(export_id):
+        return jsonify({'error': 'Invalid export ID format.'}), 400
+    try:
+        export = exports_fs.get(ObjectId(export_id))
+    except gridfs.errors.NoFile:
+        return jsonify({'error': 'Export not found.'}), 404
+    metadata = export.metadata or {}
+    if metadata.get('username') != session.get('username'):
+        return jsonify({'error': 'Export not found.'}), 404
+    response = stream_byte_range(export, export.length, 'application/pdf', etag=metadata.get('cache_key'))
+    response.headers['Content-Disposition'] = f'attachment; filename="{export.filename}"'
+    return response
+
+NOTE_PIPELINE_STAGES = ['transcribe', 'summarize', 'save', 'embed']
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='jobs')
+
+def _stage_transcribe(job, results):
+    audio = audio_fs.get(job['upload_id'])
+    extension = (audio.filename or 'recording.webm').rsplit('.', 1)[-1]
+    tmp = tempfile.NamedTemporaryFile(suffix=f'.{extension}', dir=UPLOAD_TMP_DIR, delete=False)
+    try:
+        with tmp:
+            shutil.copyfileobj(audio, tmp, AUDIO_STREAM_CHUNK_SIZE)
+        return {'transcript': transcribe_file(tmp.name)}
+    finally:
+        os.remove(tmp.name)
+
+def _stage_summarize(job, results):
+    return summarize_transcript(results['transcribe']['transcript'])
+
+def _stage_save(job, results):
+    summary = results['summarize']
+    claim_audio_upload(job['username'], job['upload_id'])
+    create_note(
+        job['username'], summary['title'], results['transcribe']['transcript'], summary['summary'],
+        summary['tags'], summary['detected_tasks'], job['upload_id'], note_id=job['note_id']
+    )
+    return {'note_id': str(job['note_id'])}
+
+def _stage_embed(job, results):
+    summary = results['summarize']
+    text = summary['summary'] or results['transcribe']['transcript']
+    embedding = embed_texts([text])[0]
+    notes_collection.update_one(
+        {'_id': job['note_id'], 'username': job['username']},
+        {'$set': stored_embedding(embedding, text)}
+    )
+    index_note_embedding(job['username'], job['note_id'], embedding)
+    touch_vault(job['username'])
+    return {}
+
+NOTE_PIPELINE_HANDLERS = {
+    'transcribe': _stage_transcribe,
+    'summarize': _stage_summarize,
+    'save': _stage_save,
+    'embed': _stage_embed
+}
+
+PDF_EXPORT_STAGES = ['compose', 'render']
+
+def _stage_compose(job, results):
+    pdf_generation_messages = [
+        {"role": "system", "content": "You are an assistant that generates content for a PDF document. Based on the provided conversation history and a specific request, compile relevant information into a structured text format suitable for a report or document. If the user asks for questions, generate a list of questions based on the conversation. Focus only on generating the text content for the PDF."},
+        {"role": "user", "content": f"Based on this conversation history, {job['prompt']}:\n\n" + "\n".join([f"{msg['role']}: {msg['content']}" for msg in job['conversation_history']])}
+    ]
+    pdf_content_completion = openai_client.chat.completions.create(
+        model="gpt-4o", 
+        messages=pdf_generation_messages,
+        max_tokens=1500 
+    )
+    return {'text': pdf_content_completion.choices[0].message.content.strip()}
+
+def _stage_render(job, results):
+    tmp = tempfile.NamedTemporaryFile(suffix='.pdf', dir=UPLOAD_TMP_DIR, delete=False)
+    tmp.close()
+    try:
+        with span('pdf_render'):
+            render_pdf(results['compose']['text'], tmp.name)
+        with open(tmp.name, 'rb') as rendered:
+            export_id = exports_fs.put(
+                rendered, filename='idrak_conversation.pdf', content_type='application/pdf',
+                metadata={'username': job['username'], 'cache_key': job['cache_key']}
+            )
+    finally:
+        os.remove(tmp.name)
+    return {'export_id': str(export_id)}
+
+PDF_EXPORT_HANDLERS = {
+    'compose': _stage_compose,
+    'render': _stage_render
+}
+
+JOB_PIPELINES = {
+    'note_pipeline': (NOTE_PIPELINE_STAGES, NOTE_PIPELINE_HANDLERS),
+    'pdf_export': (PDF_EXPORT_STAGES, PDF_EXPORT_HANDLERS)
+}
+
+def run_job(job_id):
+    """Run the remaining stages of a job. Finished stages are stored on the job and skipped on retry."""
+    job = jobs_collection.find_one({'_id': job_id})
+    stages, handlers = JOB_PIPELINES[job.get('kind', 'note_pipeline')]
+    results = {name: stage['result'] for name, stage in job['stages'].items() if stage.get('status') == 'done'}
+    jobs_collection.update_one({'_id': job_id}, {'$set': {'status': 'running', 'error': None, 'updated_at': datetime.utcnow()}})
+
+    for name in stages:
+        if name in results:
+            continue
+        jobs_collection.update_one({'_id': job_id}, {'$set': {
+            'stage': name, f'stages.{name}.status': 'running', 'updated_at': datetime.utcnow()
+        }})
+        for attempt in range(1, JOB_STAGE_RETRIES + 1):
+            try:
+                with span(f'job_{name}'):
+                    results[name] = handlers[name](job, results)
+                break
+            except Exception as e:
+                print(f"Job {job_id} stage {name} attempt {attempt} failed: {e}")
+                if attempt == JOB_STAGE_RETRIES:
+                    jobs_collection.update_one({'_id': job_id}, {'$set': {
+                        'status': 'error', 'error': str(e), f'stages.{name}.status': 'error',
+                        'updated_at': datetime.utcnow()
+                    }})
+                    return
+                time.sleep(2 ** attempt)
+        jobs_collection.update_one({'_id': job_id}, {'$set': {
+            f'stages.{name}': {'status': 'done', 'result': results[name]}, 'updated_at': datetime.utcnow()
+        }})
+
+    jobs_collection.update_one({'_id': job_id}, {'$set': {'status': 'done', 'stage': None, 'updated_at': datetime.utcnow()}})
+
+def serialize_job(job):
+    serialized = {
+        'job_id': str(job['_id']),
+        'kind': job.get('kind', 'note_pipeline'),
+        'status': job['status'],
+        'stage': job.get('stage'),
+        'stages': {name: stage.get('status', 'pending') for name, stage in job['stages'].items()},
+        'result': {name: stage['result'] for name, stage in job['stages'].items() if stage.get('status') == 'done'},
+        'error': job.get('error')
+    }
+    if 'note_id' in job:
+        serialized['note_id'] = str(job['note_id'])
+    if 'render' in serialized['result']:
+        serialized['download_url'] = url_for('download_export', export_id=serialized['result']['render']['export_id'])
+    return serialized
+
+@app.route('/jobs', methods=['POST'])
+@login_required
+def submit_job():
+    """Queue transcribe -> summarize -> save -> embed for an uploaded recording."""
+    audio_file, error = validate_audio_upload()
+    if error:
+        return error
+
+    username = session.get('username')
+    path = spool_upload(audio_file)
+    try:
+        upload_id = ObjectId(keep_upload(username, path, audio_file))
+    finally:
+        os.remove(path)
+
+    now = datetime.utcnow()
+    job_id = jobs_collection.insert_one({
+        'username': username,
+        'kind': 'note_pipeline',
+        'status': 'queued',
+        'stage': None,
+        'stages': {name: {'status': 'pending'} for name in NOTE_PIPELINE_STAGES},
+        'upload_id': upload_id,
+        'note_id': ObjectId(),
+        'error': None,
+        'created_at': now,
+        'updated_at': now
+    }).inserted_id
+    job_executor.submit(run_job, job_id)
+    return jsonify({'job_id': str(job_id), 'status': 'queued'}), 202
+
+def find_user_job(job_id):
+    if not ObjectId.is_valid(job_id):
+        return None
+    return jobs_collection.find_one({'_id': ObjectId(job_id), 'username': session.get('username')})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_job(job_id):
+    job = find_user_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found.'}), 404
+    return jsonify(serialize_job(job)), 200
+
+@app.route('/jobs/<job_id>/retry', methods=['POST'])
+@login_required
+def retry_job(job_id):
+    job = find_user_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found.'}), 404
+    if job['status'] != 'error':
+        return jsonify({'error': 'Only failed jobs can be retried.'}), 409
+    jobs_collection.update_one({'_id': job['_id']}, {'$set': {'status': 'queued', 'updated_at': datetime.utcnow()}})
+    job_executor.submit(run_job, job['_id'])
+    return jsonify({'job_id': job_id, 'status': 'queued'}), 202
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+@login_required
+def job_events(job_id):
+    """SSE stream of job progress, one 'progress' event per change until the job ends."""
+    job = find_user_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found.'}), 404
+
+    def generate():
+        last = None
+        while True:
+            current = serialize_job(jobs_collection.find_one({'_id': job['_id']}))
+            if current != last:
+                yield sse_event('progress', current)
+                last = current
+            if current['status'] in ('done', 'error'):
+                return
+            time.sleep(0.5)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+# Every index the app's queries rely on. `flask create-indexes` creates them and
+# `flask verify-indexes` checks that none of ROUTE_QUERIES needs a collection scan.
+INDEXES = {
+    'notes': [
+        ([('username', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)], {'name': 'username_timestamp'}),
+        ([('username', ASCENDING), ('tags', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)],
+         {'name': 'username_tags_timestamp'}),
+        ([('username', ASCENDING)], {'name': 'username_embedded', 'partialFilterExpression': {'embedding': {'$exists': True}}}),
+    ],
+    'user_data': [
+        ([('username', ASCENDING)], {'name': 'username_unique', 'unique': True}),
+    ],
+    'jobs': [
+        ([('username', ASCENDING), ('created_at', DESCENDING)], {'name': 'username_created'}),
+    ],
+    'tasks': [
+        ([('username', ASCENDING), ('completed', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)],
+         {'name': 'username_completed_timestamp'}),
+        ([('username', ASCENDING), ('timestamp', DESCENDING), ('_id', DESCENDING)], {'name': 'username_timestamp'}),
+        ([('note_id', ASCENDING), ('position', ASCENDING)], {'name': 'note_position'}),
+    ],
+    'artifact_queue': [
+        ([('username', ASCENDING), ('enqueued_at', ASCENDING)], {'name': 'username_enqueued'}),
+        ([('enqueued_at', ASCENDING)], {'name': 'enqueued'}),
+    ],
+    'exports.files': [
+        ([('metadata.username', ASCENDING), ('metadata.cache_key', ASCENDING)], {'name': 'owner_cache_key'}),
+        ([('uploadDate', ASCENDING)], {'name': 'upload_date'}),
+    ],
+    'audio.files': [
+        ([('metadata.username', ASCENDING), ('metadata.sha256', ASCENDING)], {'name': 'owner_sha256'}),
+        ([('metadata.pending', ASCENDING), ('uploadDate', ASCENDING)], {'name': 'pending_upload_date', 'sparse': True}),
+    ],
+}
+
+def ensure_indexes():
+    for collection_name, indexes in INDEXES.items():
+        for keys, options in indexes:
+            db[collection_name].create_index(keys, **options)
+    embedding_cache_collection.create_index('created_at', expireAfterSeconds=EMBEDDING_CACHE_TTL)
+
+def route_queries(username):
+    """(route, collection, filter, sort) for the queries the routes issue."""
+    note_id = ObjectId()
+    return [
+        ('login / sign-up', users_collection, {'username': username}, None),
+        ('get_user_notes', notes_collection, {'username': username}, [('timestamp', -1), ('_id', -1)]),
+        ('get_user_notes (next page)', notes_collection, {'username': username, '$or': [
+            {'timestamp': {'$lt': datetime.utcnow()}},
+            {'timestamp': datetime.utcnow(), '_id': {'$lt': note_id}}
+        ]}, [('timestamp', -1), ('_id', -1)]),
+        ('get_notes_by_category', notes_collection, {'username': username, 'tags': 'Work'},
+         [('timestamp', -1), ('_id', -1)]),
+        ('semantic_search index load', notes_collection, indexed_embedding_filter(username), None),
+        ('semantic_search keyword index load', notes_collection, {'username': username}, None),
+        ('tasks (open)', tasks_collection, {'username': username, 'completed': False}, [('timestamp', -1), ('_id', -1)]),
+        ('tasks (all)', tasks_collection, {'username': username}, [('timestamp', -1), ('_id', -1)]),
+        ('embed_notes', notes_collection, missing_embedding_filter(username), None),
+        ('embed_notes status', artifact_queue_collection, {'username': username, 'artifact': 'embedding'}, None),
+        ('update_note artifact sweep', artifact_queue_collection, {'username': username}, [('enqueued_at', 1)]),
+        ('sweep-artifacts', artifact_queue_collection, {}, [('enqueued_at', 1)]),
+        ('get_note_details / update_note', notes_collection, {'_id': note_id, 'username': username}, None),
+        ('generate_common_topic', notes_collection, {'_id': {'$in': [note_id]}, 'username': username}, None),
+        ('ask_idrak fallback', notes_collection, {'username': username}, [('timestamp', -1)]),
+        ('store_audio dedupe', db['audio.files'], {'metadata.username': username, 'metadata.sha256': 'x'}, None),
+        ('generate_pdf cache', db['exports.files'], {'metadata.username': username, 'metadata.cache_key': 'x'}, None),
+        ('generate_pdf in-flight job', jobs_collection, {
+            'username': username, 'kind': 'pdf_export', 'cache_key': 'x', 'status': {'$in': ['queued', 'running']}
+        }, None),
+        ('prune-uploads', db['audio.files'], {'metadata.pending': True, 'uploadDate': {'$lt': datetime.utcnow()}}, None),
+    ]
+
+def plan_stages(plan):
+    """All stage names in an explain() plan tree."""
+    if isinstance(plan, dict):
+        stages = [plan['stage']] if 'stage' in plan else []
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+        return stages
+    if isinstance(plan, list):
+        return [stage for item in plan for stage in plan_stages(item)]
+    return []
+
+@app.cli.command('create-indexes')
+def create_indexes():
+    """Create the indexes declared in INDEXES."""
+    ensure_indexes()
+    click.echo("Indexes are up to date.")
+
+@app.cli.command('verify-indexes')
+@click.option('--username', default='index-check', help='Username to plug into the sample queries.')
+def verify_indexes(username):
+    """Explain every route query and fail if any of them falls back to a COLLSCAN."""
+    failures = 0
+    for route, collection, query, sort in route_queries(username):
+        cursor = collection.find(query)
+        if not hasattr(cursor, 'explain'):
+            # mongomock and similar stand-ins have no query planner to ask.
+            raise click.ClickException(
+                f"The database client ({type(cursor.cursor).__module__}) cannot explain queries; "
+                "run verify-indexes against a MongoDB server."
+            )
+        if sort:
+            cursor = cursor.sort(sort)
+        stages = plan_stages(cursor.explain()['queryPlanner']['winningPlan'])
+        status = 'FAIL' if 'COLLSCAN' in stages else 'ok'
+        failures += status == 'FAIL'
+        click.echo(f"[{status}] {route}: {' <- '.join(stages)}")
+    if failures:
+        raise click.ClickException(f"{failures} queries fall back to a collection scan.")
+
+
+@app.cli.command('migrate-audio')
+@click.option('--batch-size', default=100, show_default=True, help='Notes moved per bulk write.')
+def migrate_audio(batch_size):
+    """Move inline audio_base64 fields into GridFS."""
+    moved = 0
+    while True:
+        batch = list(notes_collection.find(
+            {'audio_base64': {'$exists': True}},
+            {'username': 1, 'audio_base64': 1}
+        ).limit(batch_size))
+        if not batch:
+            break
+        operations = []
+        for note in batch:
+            audio_file_id = store_audio(note['username'], base64.b64decode(note['audio_base64']))
+            operations.append(UpdateOne(
+                {'_id': note['_id']},
+                {'$set': {'audio_file_id': audio_file_id}, '$unset': {'audio_base64': ''}}
+            ))
+        notes_collection.bulk_write(operations, ordered=False)
+        moved += len(operations)
+        click.echo(f"Moved audio for {moved} notes")
+    click.echo(f"Done. {moved} notes migrated.")
+
+
+@app.cli.command('migrate-embeddings')
+@click.option('--batch-size', default=500, show_default=True, help='Notes re-encoded per bulk write.')
+def migrate_embeddings(batch_size):
+    """Re-encode stored note embeddings (legacy float lists included) into the configured format."""
+    target = embedding_format()
+    migrated = reembed = 0
+    last_id = None
+    while True:
+        query = {'embedding': {'$exists': True}, 'embedding_format': {'$ne': target}}
+        if last_id is not None:
+            query['_id'] = {'$gt': last_id}
+        batch = list(notes_collection.find(query, {'embedding': 1, 'embedding_format': 1}).sort('_id', ASCENDING).limit(batch_size))
+        if not batch:
+            break
+        operations = []
+        for note in batch:
+            if not embedding_fits(note.get('embedding_format')):
+                # Dimensions that were cut off cannot be restored. The vector stays (get_vector_index
+                # leaves it out) and sweep-artifacts queues the note for re-embedding.
+                operations.append(UpdateOne({'_id': note['_id']}, {'$unset': {'artifacts.embedding': ''}}))
+                reembed += 1
+                continue
+            vector = decode_embedding(note['embedding'])
+            operations.append(UpdateOne({'_id': note['_id']}, {'$set': {
+                'embedding': encode_embedding(vector), 'embedding_format': target
+            }}))
+        notes_collection.bulk_write(operations, ordered=False)
+        migrated += len(operations)
+        last_id = batch[-1]['_id']
+        click.echo(f"Processed {migrated} notes")
+    vector_indexes.clear()
+    click.echo(f"Done. {migrated - reembed} notes stored as {target}, {reembed} marked for re-embedding "
+               "(run sweep-artifacts to rebuild them).")
+
+@app.cli.command('benchmark-embeddings')
+@click.option('--username', default=None, help="Use this user's stored embeddings instead of synthetic ones.")
+@click.option('--notes', default=5000, show_default=True, help='Synthetic vault size.')
+@click.option('--dim', default=1536, show_default=True, help='Synthetic embedding dimensions.')
+@click.option('--queries', default=200, show_default=True)
+@click.option('-k', default=10, show_default=True, help='Results per query for recall@k.')
+def benchmark_embeddings(username, notes, dim, queries, k):
+    """Compare storage size, decode time, search latency and recall@k of the embedding formats."""
+    rng = np.random.default_rng(0)
+    if username:
+        vectors = np.stack([
+            decode_embedding(note['embedding'])
+            for note in notes_collection.find({'username': username, 'embedding': {'$exists': True}}, {'embedding': 1})
+        ])
+    else:
+        # Topic-like clusters, so near neighbours are meaningful.
+        centers = rng.standard_normal((max(1, notes // 50), dim)).astype(np.float32)
+        vectors = centers[rng.integers(len(centers), size=notes)] + 0.6 * rng.standard_normal((notes, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    picks = rng.choice(len(vectors), min(queries, len(vectors)), replace=False)
+    query_vectors = vectors[picks] + 0.1 * rng.standard_normal((len(picks), vectors.shape[1])).astype(np.float32)
+    truth = [set(np.argsort(-(vectors @ query))[:k].tolist()) for query in query_vectors]
+
+    list_bytes = len(BSON.encode({'embedding': vectors[0].astype(float).tolist()}))
+    click.echo(f"{len(vectors)} vectors x {vectors.shape[1]} dims; BSON float list: {list_bytes} bytes/vector")
+    click.echo(f"{'format':<14}{'bytes':>8}{'decode ms':>12}{'p50 ms':>9}{'p95 ms':>9}{'recall@' + str(k):>11}")
+    for storage, dimensions in [('float32', 0), ('int8', 0), ('float32', 512), ('float32', 256), ('int8', 256)]:
+        if dimensions >= vectors.shape[1]:
+            continue
+        encoded = [encode_embedding(vector, storage, dimensions) for vector in vectors]
+        started = time.perf_counter()
+        decoded = [decode_embedding(value) for value in encoded]
+        decode_ms = (time.perf_counter() - started) * 1000
+        index = VectorIndex()
+        for row, vector in enumerate(decoded):
+            index.upsert(row, vector)
+        latencies, recalls = [], []
+        for query, expected in zip(query_vectors, truth):
+            started = time.perf_counter()
+            hits = index.search(compact_vector(query, dimensions), k, approximate=False)
+            latencies.append((time.perf_counter() - started) * 1000)
+            recalls.append(len(expected & {row for row, _ in hits}) / k)
+        click.echo(
+            f"{embedding_format(storage, dimensions):<14}{len(encoded[0]):>8}{decode_ms:>12.1f}"
+            f"{np.percentile(latencies, 50):>9.2f}{np.percentile(latencies, 95):>9.2f}{np.mean(recalls):>11.3f}"
+        )
+
+@app.cli.command('backfill-tasks')
+@click.option('--batch-size', default=500, show_default=True, help='Notes processed per batch.')
+def backfill_tasks(batch_size):
+    """Normalize every note's detected_tasks and rebuild the tasks collection from them."""
+    processed = 0
+    last_id = None
+    while True:
+        query = {} if last_id is None else {'_id': {'$gt': last_id}}
+        batch = list(notes_collection.find(query, {'username': 1, 'title': 1, 'timestamp': 1, 'detected_tasks': 1})
+                     .sort('_id', ASCENDING).limit(batch_size))
+        if not batch:
+            break
+        normalized = []
+        for note in batch:
+            tasks = note_tasks(note)
+            if tasks != note.get('detected_tasks'):
+                normalized.append(UpdateOne({'_id': note['_id']}, {'$set': {'detected_tasks': tasks}}))
+            sync_note_tasks(note['username'], note['_id'], tasks, note.get('title'), note.get('timestamp'))
+        if normalized:
+            notes_collection.bulk_write(normalized, ordered=False)
+        processed += len(batch)
+        last_id = batch[-1]['_id']
+        click.echo(f"Processed {processed} notes")
+    click.echo(f"Done. Tasks synced for {processed} notes.")
+
+@app.cli.command('sweep-artifacts')
+@click.option('--batch-size', default=ARTIFACT_SWEEP_BATCH, show_default=True, help='Queue entries built per batch.')
+@click.option('--max-notes', default=1000, show_default=True,
+              help='Notes built by an older model version to queue this run (0 queues none).')
+def sweep_artifacts_command(batch_size, max_notes):
+    """Queue up to --max-notes outdated notes, newest first, then build everything queued.
+
+    Run it repeatedly after changing EMBEDDING_MODEL or retraining the classifier to
+    roll the new version out a slice at a time.
+    """
+    outdated = [
+        {f'artifacts.{name}.version': {'$ne': version}}
+        for name, version in artifact_versions().items() if version is not None
+    ]
+    queued = 0
+    if max_notes:
+        for note in notes_collection.find({'$or': outdated}, ARTIFACT_FIELDS).sort('_id', DESCENDING).limit(max_notes):
+            stale = stale_artifacts(note)
+            if stale:
+                enqueue_artifacts(note['username'], [note['_id']], stale)
+                queued += 1
+    click.echo(f"Queued {queued} outdated notes")
+    built = sweep_artifacts(batch_size=batch_size)
+    remaining = notes_collection.count_documents({'$or': outdated})
+    click.echo(f"Done. Built {built} artifacts; {remaining} notes still built by an older version.")
+
+@app.cli.command('prune-uploads')
+@click.option('--max-age-hours', default=24, show_default=True, help='Age after which unclaimed uploads are deleted.')
+@click.option('--export-max-age-hours', default=7 * 24, show_default=True, help='Age after which cached PDF exports are deleted.')
+def prune_uploads(max_age_hours, export_max_age_hours):
+    """Delete uploaded audio that was never attached to a note, and old PDF exports."""
+    cutoff = datetime.utcnow() - timedelta(hours=max_age_hours)
+    pruned = 0
+    for audio in audio_fs.find({'metadata.pending': True, 'uploadDate': {'$lt': cutoff}}):
+        # Only while still pending: a save may have claimed it since the find.
+        if db['audio.files'].delete_one({'_id': audio._id, 'metadata.pending': True}).deleted_count:
+            db['audio.chunks'].delete_many({'files_id': audio._id})
+            pruned += 1
+    click.echo(f"Deleted {pruned} unclaimed uploads.")
+
+    cutoff = datetime.utcnow() - timedelta(hours=export_max_age_hours)
+    pruned = 0
+    for export in exports_fs.find({'uploadDate': {'$lt': cutoff}}):
+        exports_fs.delete(export._id)
+        pruned += 1
+    click.echo(f"Deleted {pruned} PDF exports.")
+
+
+@app.cli.command('train-classifier')
+@click.option('--dataset', default=CLASSIFIER_DATASET, show_default=True, help='JSONL file with text/label rows.')
+def train_classifier(dataset):
+    """Train the TF-IDF + LogisticRegression tagger, benchmark it and save a new version."""
+    import joblib
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.metrics import accuracy_score, classification_report
+    from sklearn.model_selection import train_test_split
+
+    with open(dataset) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    texts = [row['text'] for row in rows]
+    labels = [row['label'] for row in rows]
+    X_train, X_test, y_train, y_test = train_test_split(
+        texts, labels, test_size=0.2, stratify=labels, random_state=42
+    )
+
+    started = time.perf_counter()
+    vectorizer = TfidfVectorizer(max_features=1000, ngram_range=(1, 2))
+    model = LogisticRegression(max_iter=1000)
+    model.fit(vectorizer.fit_transform(X_train), y_train)
+    train_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    y_pred = model.predict(vectorizer.transform(X_test))
+    batch_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    for text in X_test:
+        model.predict_proba(vectorizer.transform([text]))
+    single_seconds = time.perf_counter() - started
+    accuracy = accuracy_score(y_test, y_pred)
+
+    click.echo(classification_report(y_test, y_pred))
+    click.echo(f"Accuracy: {accuracy:.3f}")
+    click.echo(f"Training time: {train_seconds * 1000:.1f} ms on {len(X_train)} rows")
+    click.echo(f"Batch throughput: {len(X_test) / batch_seconds:,.0f} notes/s")
+    click.echo(f"Single-note latency: {single_seconds / len(X_test) * 1e6:,.0f} us")
+
+    os.makedirs(CLASSIFIER_DIR, exist_ok=True)
+    manifest_path = os.path.join(CLASSIFIER_DIR, 'note_classifier.json')
+    version = 1
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            version = json.load(f)['version'] + 1
+    artifact = f'note_classifier-v{version}.joblib'
+    joblib.dump({'vectorizer': vectorizer, 'model': model}, os.path.join(CLASSIFIER_DIR, artifact))
+    with open(manifest_path, 'w') as f:
+        json.dump({
+            'version': version,
+            'artifact': artifact,
+            'accuracy': accuracy,
+            'trained_at': datetime.utcnow().isoformat(),
+            'dataset': os.path.basename(dataset),
+            'labels': sorted(set(labels))
+        }, f, indent=2)
+    click.echo(f"Saved {artifact}")
+
+
+def create_app(config=None):
+    """WSGI entry point, e.g. `gunicorn 'app:create_app()'`.
+
+    Nothing here connects to Mongo or OpenAI; each worker does that on its first request that needs it.
+    """
+    if config:
+        app.config.update(config)
+    return app
 
 
 if '__main__' == __name__:
-    app.run(debug=True, port=8283)
+    ensure_indexes()
+    create_app().run(debug=True, port=8283)
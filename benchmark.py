@@ -0,0 +1,385 @@
+"""Load test for app.py with local stand-ins for MongoDB and OpenAI.
+
+    python benchmark.py
+    python benchmark.py --notes 100,1000,10000,100000 --concurrency 1,8,32 --latency-ms 80
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json       # exits 1 on a regression
+    python benchmark.py --startup-only --startup-target-ms 500
+
+Mongo is mongomock unless --mongo-uri points at a local mongod. OpenAI is a small
+HTTP server in this process that speaks the /v1 endpoints the app calls, so the
+real SDK, its connection pool and the app's concurrency limits are all exercised.
+Requests go through Flask's test client from a thread pool, one thread per
+concurrent user. Before the load test, app.py is imported in fresh interpreters
+under -X importtime to report how long a new worker takes to serve its first request.
+"""
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import numpy as np
+
+# Same topics as the generator in logisticRegression.ipynb.
+SEED_PROMPTS = {
+    "Idea": ["Brainstorming AI startup", "New plant health app idea", "Thought on sustainable tech"],
+    "Meeting": ["Team discussed deadlines", "Client feedback summary", "Meeting with mentor on next steps"],
+    "Study": ["Learning CNNs and ViTs", "Notes on thermodynamics", "Studied French Revolution timeline"],
+    "Work": ["Fixed bug in Flask route", "Completed frontend for dashboard", "Deployment issues resolved"],
+    "Personal": ["Feeling productive today", "Reflected on last week's habits", "Grateful for quiet moments"],
+    "Planning": ["Hackathon prep steps", "Roadmap for Q4 goals", "Weekend routine outline"],
+    "Question": ["Why does my model overfit?", "How to boost productivity?", "What's the best loss function?"],
+    "Tech": ["Exploring FastAPI", "Built a classifier with transformers", "Testing Whisper audio model"]
+}
+FILLER = "We went through the details, agreed on the next steps and wrote down the open questions."
+SUMMARY_JSON = json.dumps({
+    "title": "Synthetic note", "summary": "A generated summary.", "is_timeline": False,
+    "detected_tasks": ["Follow up"], "tags": ["Work"]
+})
+ROUTES = ['semantic_search', 'get_user_notes', 'ask_idrak', 'save_note']
+HERE = os.path.dirname(os.path.abspath(__file__))
+STARTUP_PROBE = (
+    "import time; started = time.perf_counter(); import app; imported = time.perf_counter(); "
+    "app.create_app().test_client().get('/'); "
+    "print(round((imported - started) * 1000, 1), round((time.perf_counter() - imported) * 1000, 1))"
+)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Answers embeddings, chat completions (plain, JSON and streamed) and transcriptions."""
+
+    protocol_version = 'HTTP/1.1'
+    latency = 0.05
+    dim = 1536
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type='application/json'):
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency * random.uniform(0.5, 1.5))
+        if self.path.endswith('/embeddings'):
+            self._embeddings(json.loads(body))
+        elif self.path.endswith('/chat/completions'):
+            self._chat(json.loads(body))
+        elif self.path.endswith('/audio/transcriptions'):
+            self._send(json.dumps({'text': f"{random.choice(SEED_PROMPTS['Meeting'])}. {FILLER}"}))
+        else:
+            self.send_error(404)
+
+    def _embeddings(self, payload):
+        inputs = payload['input'] if isinstance(payload['input'], list) else [payload['input']]
+        data = []
+        for i, text in enumerate(inputs):
+            seed = int(hashlib.sha256(str(text).encode('utf-8')).hexdigest()[:8], 16)
+            vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+            vector /= np.linalg.norm(vector)
+            if payload.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(vector.tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append({'object': 'embedding', 'index': i, 'embedding': embedding})
+        tokens = sum(len(str(text).split()) for text in inputs)
+        self._send(json.dumps({
+            'object': 'list', 'data': data, 'model': payload['model'],
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}
+        }))
+
+    def _chat(self, payload):
+        if payload.get('response_format', {}).get('type') == 'json_object':
+            content = SUMMARY_JSON
+        else:
+            content = f"Based on your notes: {FILLER}"
+        prompt_tokens = sum(len(str(message.get('content', '')).split()) for message in payload['messages'])
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': len(content.split()),
+                 'total_tokens': prompt_tokens + len(content.split())}
+        base = {'id': 'chatcmpl-bench', 'created': int(time.time()), 'model': payload['model']}
+        if not payload.get('stream'):
+            self._send(json.dumps({**base, 'object': 'chat.completion', 'usage': usage, 'choices': [
+                {'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}
+            ]}))
+            return
+        events = []
+        for start in range(0, len(content), 16):
+            events.append({**base, 'object': 'chat.completion.chunk', 'choices': [
+                {'index': 0, 'delta': {'content': content[start:start + 16]}, 'finish_reason': None}
+            ]})
+        events.append({**base, 'object': 'chat.completion.chunk', 'choices': [], 'usage': usage})
+        self._send(''.join(f"data: {json.dumps(event)}\n\n" for event in events) + "data: [DONE]\n\n",
+                   content_type='text/event-stream')
+
+
+def start_fake_openai(latency_ms, dim):
+    FakeOpenAIHandler.latency = latency_ms / 1000
+    FakeOpenAIHandler.dim = dim
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOpenAIHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_app(mongo_uri, openai_url):
+    """Import app.py wired to the stand-ins. Must run before anything else imports it."""
+    import pymongo
+    if mongo_uri:
+        real_client = pymongo.MongoClient
+        pymongo.MongoClient = lambda uri, **kwargs: real_client(
+            mongo_uri, **{key: value for key, value in kwargs.items() if not key.startswith('tls')}
+        )
+    else:
+        import mongomock
+        import mongomock.gridfs
+        mongomock.gridfs.enable_gridfs_integration()
+        pymongo.MongoClient = mongomock.MongoClient
+    os.environ['OPENAI_BASE_URL'] = openai_url
+    import app
+    return app
+
+
+def seed_vault(app, username, size, dim, rng):
+    """Insert size synthetic notes with topic-clustered embeddings."""
+    app.users_collection.insert_one({'username': username, 'password': 'benchmark'})
+    topics = list(SEED_PROMPTS.items())
+    centers = rng.standard_normal((len(topics), dim)).astype(np.float32)
+    now = datetime.now()
+    for start in range(0, size, 5000):
+        count = min(5000, size - start)
+        topic_ids = rng.integers(len(topics), size=count)
+        vectors = centers[topic_ids] + 0.8 * rng.standard_normal((count, dim)).astype(np.float32)
+        notes = []
+        for offset, (topic_id, vector) in enumerate(zip(topic_ids, vectors)):
+            label, prompts = topics[topic_id]
+            text = prompts[rng.integers(len(prompts))]
+            notes.append({
+                'username': username,
+                'timestamp': now - timedelta(minutes=start + offset),
+                'title': text,
+                'summary': f"{text}. {FILLER}",
+                'transcript': f"{text}. {FILLER} {FILLER}",
+                'tags': [label],
+                'detected_tasks': [{'task': 'Follow up', 'completed': False}],
+                'embedding': app.encode_embedding(vector),
+                'embedding_format': app.embedding_format(),
+                'embedding_model': app.EMBEDDING_MODEL
+            })
+        app.notes_collection.insert_many(notes)
+
+
+def clear_vault(app, username):
+    for collection in (app.notes_collection, app.tasks_collection, app.jobs_collection, app.users_collection):
+        collection.delete_many({'username': username})
+    for audio in app.audio_fs.find({'metadata.username': username}):
+        app.audio_fs.delete(audio._id)
+    app.vector_indexes.pop(username)
+    app.keyword_indexes.pop(username)
+    app.semantic_graphs.pop(username)
+
+
+def make_request(client, route, i):
+    label, prompts = random.choice(list(SEED_PROMPTS.items()))
+    text = random.choice(prompts)
+    if route == 'semantic_search':
+        return client.post('/semantic_search', json={'query': f"{text} {i}", 'num_results': 5})
+    if route == 'get_user_notes':
+        return client.get('/get_user_notes?limit=50')
+    if route == 'ask_idrak':
+        return client.post('/ask_idrak', json={'prompt': f"What did I note about {text.lower()}? ({i})", 'history': []})
+    if route == 'save_note':
+        return client.post('/save_note', json={
+            'title': text, 'transcript': f"{text}. {FILLER}", 'summary': text, 'tags': [label],
+            'detected_tasks': ['Follow up'], 'audio_base64': base64.b64encode(os.urandom(2048)).decode()
+        })
+    raise ValueError(f"Unknown route {route}")
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def app_imports(importtime_log):
+    """(module, cumulative ms) for each module app.py itself imported, from -X importtime output."""
+    children = []
+    for line in importtime_log.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        depth = len(name) - len(name.lstrip())
+        if depth == 3:
+            children.append((name.strip(), int(cumulative) / 1000))
+        elif depth == 1:
+            if name.strip() == 'app':
+                return children
+            children = []
+    return []
+
+
+def measure_startup(runs):
+    """Median import and first-request time of app.py in fresh interpreters, and the slowest imports."""
+    import_ms, request_ms, imports = [], [], []
+    for _ in range(runs):
+        probe = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_PROBE],
+                               cwd=HERE, capture_output=True, text=True)
+        if probe.returncode != 0:
+            raise click.ClickException(f"Importing app.py failed:\n{probe.stderr[-2000:]}")
+        imported, first_request = probe.stdout.split()[-2:]
+        import_ms.append(float(imported))
+        request_ms.append(float(first_request))
+        imports = app_imports(probe.stderr)
+    return {
+        'import_ms': round(float(np.median(import_ms)), 1),
+        'first_request_ms': round(float(np.median(request_ms)), 1)
+    }, sorted(imports, key=lambda item: -item[1])[:10]
+
+
+def run_scenario(app, username, route, concurrency, requests):
+    local = threading.local()
+
+    def one(i):
+        if not hasattr(local, 'client'):
+            local.client = app.app.test_client()
+            with local.client.session_transaction() as session:
+                session['username'] = username
+        started = time.perf_counter()
+        response = make_request(local.client, route, i)
+        response.get_data()
+        return time.perf_counter() - started, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(requests)))
+    wall = time.perf_counter() - started
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    return {
+        'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 2),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 2),
+        'throughput': round(requests / wall, 2),
+        'errors': sum(1 for _, status in results if status >= 400),
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Messages for every scenario that got slower, lost throughput or gained errors."""
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        if key == 'startup':
+            if current['import_ms'] > previous['import_ms'] * (1 + tolerance):
+                regressions.append(f"startup: import {previous['import_ms']} -> {current['import_ms']} ms")
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {previous['p95_ms']} -> {current['p95_ms']} ms")
+        if current['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append(f"{key}: throughput {previous['throughput']} -> {current['throughput']} req/s")
+        if current['errors'] > previous['errors']:
+            regressions.append(f"{key}: errors {previous['errors']} -> {current['errors']}")
+    return regressions
+
+
+def parse_ints(value):
+    return [int(part) for part in value.split(',') if part]
+
+
+def run_load_test(notes, concurrency, routes, requests, latency_ms, dim, mongo_uri, verbose):
+    server = start_fake_openai(latency_ms, dim)
+    app = load_app(mongo_uri, f"http://127.0.0.1:{server.server_address[1]}/v1")
+    rng = np.random.default_rng(0)
+    random.seed(0)
+
+    results = {}
+    click.echo(f"{'scenario':<32}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>9}{'errors':>8}{'peak MB':>9}")
+    for size in parse_ints(notes):
+        username = f"benchmark-{size}"
+        clear_vault(app, username)
+        started = time.perf_counter()
+        seed_vault(app, username, size, dim, rng)
+        click.echo(f"-- seeded {size} notes in {time.perf_counter() - started:.1f}s")
+        for route in routes.split(','):
+            for users in parse_ints(concurrency):
+                key = f"{route}@{size}x{users}"
+                with contextlib.ExitStack() as stack:
+                    if not verbose:
+                        stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+                    result = run_scenario(app, username, route, users, requests)
+                results[key] = result
+                click.echo(f"{key:<32}{result['p50_ms']:>9}{result['p95_ms']:>9}{result['p99_ms']:>9}"
+                           f"{result['throughput']:>9}{result['errors']:>8}{result['peak_rss_mb']:>9}")
+        clear_vault(app, username)
+    server.shutdown()
+    return results
+
+
+@click.command()
+@click.option('--notes', default='100,1000,10000', show_default=True, help='Comma-separated vault sizes.')
+@click.option('--concurrency', default='1,8,32', show_default=True, help='Comma-separated concurrent users.')
+@click.option('--routes', default=','.join(ROUTES), show_default=True, help='Comma-separated routes to drive.')
+@click.option('--requests', default=200, show_default=True, help='Requests per route and concurrency level.')
+@click.option('--latency-ms', default=50.0, show_default=True, help='Mean latency of the fake OpenAI server.')
+@click.option('--dim', default=1536, show_default=True, help='Embedding dimensions returned by the fake server.')
+@click.option('--mongo-uri', default=None, help='Use this mongod instead of mongomock.')
+@click.option('--baseline', type=click.Path(), default=None, help='Compare against this results file.')
+@click.option('--save-baseline', type=click.Path(), default=None, help='Write the results to this file.')
+@click.option('--tolerance', default=0.2, show_default=True, help='Allowed relative slowdown before flagging.')
+@click.option('--startup-runs', default=5, show_default=True, help='Fresh interpreters to time the import of app.py in.')
+@click.option('--startup-target-ms', default=1000.0, show_default=True,
+              help='Fail when import plus first request takes longer than this.')
+@click.option('--startup-only', is_flag=True, help='Only report startup time; skip the load test.')
+@click.option('--verbose', is_flag=True, help="Keep the app's own log output.")
+def main(notes, concurrency, routes, requests, latency_ms, dim, mongo_uri, baseline, save_baseline, tolerance,
+         startup_runs, startup_target_ms, startup_only, verbose):
+    results = {}
+    failures = []
+    if startup_runs:
+        startup, slowest = measure_startup(startup_runs)
+        results['startup'] = startup
+        total = startup['import_ms'] + startup['first_request_ms']
+        click.echo(f"Startup (median of {startup_runs}): import {startup['import_ms']} ms, "
+                   f"first request {startup['first_request_ms']} ms, target {startup_target_ms:g} ms")
+        for module, cumulative in slowest:
+            click.echo(f"  {module:<40}{cumulative:>9.1f} ms")
+        if total > startup_target_ms:
+            failures.append(f"startup: {total:.1f} ms is over the {startup_target_ms:g} ms target")
+    if not startup_only:
+        results.update(run_load_test(notes, concurrency, routes, requests, latency_ms, dim, mongo_uri, verbose))
+
+    if save_baseline:
+        with open(save_baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        click.echo(f"Saved results to {save_baseline}")
+    if baseline:
+        with open(baseline) as f:
+            failures.extend(compare(results, json.load(f), tolerance))
+    for message in failures:
+        click.echo(f"REGRESSION {message}")
+    if failures:
+        sys.exit(1)
+    if baseline:
+        click.echo("No regressions against the baseline.")
+
+
+if __name__ == '__main__':
+    main()
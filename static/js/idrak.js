@@ -51,7 +51,6 @@ function formatAIResponse(text) {
     return formattedHtml;
 }
 
-
 function appendMessage(sender, message, rawMessage = null) {
     if (!conversationStarted) {
         conversationStarted = true;
@@ -96,15 +95,40 @@ async function sendPromptToAI(promptText) {
             headers: {
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({ prompt: promptText, history: conversationHistory }) // Send full history
+            body: JSON.stringify({ prompt: promptText, history: conversationHistory, stream: true }) // Send full history
         });
 
-        const data = await response.json();
-        if (response.ok) {
-            appendMessage('ai', data.response, data.response); // Pass raw response to history
-        } else {
+        if (!response.ok) {
+            const data = await response.json();
             appendMessage('ai', `Error: ${data.error || 'Something went wrong.'}`);
+            return;
+        }
+
+        // Render the answer token by token as it streams in
+        const messageElement = document.createElement('div');
+        messageElement.classList.add('message-bubble', 'ai-message');
+        messagesBox.appendChild(messageElement);
+        let streamedText = '';
+        let finalText = null;
+        let errorText = null;
+        await readServerSentEvents(response, (eventName, payload) => {
+            if (eventName === 'delta') {
+                streamedText += payload.text;
+                messageElement.innerHTML = formatAIResponse(streamedText);
+                messagesBox.scrollTop = messagesBox.scrollHeight;
+            } else if (eventName === 'done') {
+                finalText = payload.response;
+            } else if (eventName === 'error') {
+                errorText = payload.error;
+            }
+        });
+
+        if (finalText !== null) {
+            messageElement.innerHTML = formatAIResponse(finalText);
+            conversationHistory.push({ role: 'assistant', content: finalText });
+        } else {
             // Don't add error messages to history that would confuse the model
+            messageElement.innerHTML = formatAIResponse(`Error: ${errorText || 'Something went wrong.'}`);
         }
     } catch (error) {
         console.error('Error sending prompt to AI:', error);
@@ -112,34 +136,68 @@ async function sendPromptToAI(promptText) {
     }
 }
 
+// Shows a status line without adding it to the conversation history
+function appendStatus(message) {
+    const messageElement = document.createElement('div');
+    messageElement.classList.add('message-bubble', 'ai-message');
+    messageElement.textContent = message;
+    messagesBox.appendChild(messageElement);
+    messagesBox.scrollTop = messagesBox.scrollHeight;
+    return messageElement;
+}
+
+function downloadPdf(url) {
+    const a = document.createElement('a');
+    a.href = url;
+    a.download = 'idrak_questions.pdf'; // Suggested filename
+    document.body.appendChild(a);
+    a.click();
+    a.remove();
+}
+
 async function generatePdf(history, pdfContentPrompt) {
+    // Leave the export requests themselves out so asking again hits the server's cache
+    const exportHistory = history.filter(msg =>
+        !(msg.role === 'user' && msg.content.toLowerCase().includes('generate a pdf of questions')));
     try {
         const response = await fetch('/generate_pdf', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
             },
-            body: JSON.stringify({ conversation_history: history, prompt: pdfContentPrompt })
+            body: JSON.stringify({ conversation_history: exportHistory, prompt: pdfContentPrompt })
         });
+        let job = await response.json();
+        if (!response.ok) {
+            appendStatus(`PDF Generation Error: ${job.error || 'Failed to generate PDF.'}`);
+            return;
+        }
 
-        if (response.ok) {
-            const blob = await response.blob();
-            const url = window.URL.createObjectURL(blob);
-            const a = document.createElement('a');
-            a.href = url;
-            a.download = 'idrak_questions.pdf'; // Suggested filename
-            document.body.appendChild(a);
-            a.click();
-            a.remove();
-            window.URL.revokeObjectURL(url);
-            appendMessage('ai', 'Your PDF has been generated and downloaded.');
-        } else {
-            const errorData = await response.json();
-            appendMessage('ai', `PDF Generation Error: ${errorData.error || 'Failed to generate PDF.'}`);
+        // The PDF is built in the background; poll the job until it has a download link
+        const statusElement = job.download_url ? null : appendStatus('Preparing your PDF...');
+        while (!job.download_url && job.status !== 'error') {
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const jobResponse = await fetch(`/jobs/${job.job_id}`);
+            job = await jobResponse.json();
+            if (!jobResponse.ok) {
+                throw new Error(job.error || `HTTP error! status: ${jobResponse.status}`);
+            }
         }
+        if (job.status === 'error') {
+            (statusElement || appendStatus('')).textContent = `PDF Generation Error: ${job.error || 'Failed to generate PDF.'}`;
+            return;
+        }
+
+        downloadPdf(job.download_url);
+        const doneElement = statusElement || appendStatus('');
+        doneElement.textContent = 'Your PDF is ready. ';
+        const link = document.createElement('a');
+        link.href = job.download_url;
+        link.textContent = 'Download it again';
+        doneElement.appendChild(link);
     } catch (error) {
         console.error('Error generating PDF:', error);
-        appendMessage('ai', 'An error occurred while generating the PDF.');
+        appendStatus('An error occurred while generating the PDF.');
     }
 }
 
@@ -79,31 +79,73 @@ noteDetailTitle.addEventListener('input', trackContentChanges);
 noteDetailSummary.addEventListener('input', trackContentChanges);
 noteDetailTranscript.addEventListener('input', trackContentChanges);
 
-async function fetchNotesForSidebar() {
-    notesList.innerHTML = '<li class="loading-notes-sidebar">Loading notes...</li>';
+// Follows next_cursor until every page of a notes listing has been fetched
+async function fetchAllNotes(url) {
+    const notes = [];
+    let cursor = null;
+    do {
+        const separator = url.includes('?') ? '&' : '?';
+        const pageUrl = cursor ? `${url}${separator}limit=200&cursor=${encodeURIComponent(cursor)}` : `${url}${separator}limit=200`;
+        const response = await fetch(pageUrl);
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || `HTTP error! status: ${response.status}`);
+        }
+        notes.push(...data.notes);
+        cursor = data.next_cursor;
+    } while (cursor);
+    return notes;
+}
+
+function appendSidebarNote(note) {
+    const listItem = document.createElement('li');
+    const link = document.createElement('a');
+    link.href = '#';
+    link.dataset.noteId = note._id; // Use note._id
+    link.innerHTML = `<span class="sidebar-icon">📄</span> ${note.title}`;
+    link.addEventListener('click', (e) => {
+        e.preventDefault();
+        loadNoteDetails(note._id); // Use note._id
+        // Remove 'active' from all, add to clicked
+        document.querySelectorAll('#notesList a').forEach(a => a.classList.remove('active'));
+        link.classList.add('active');
+    });
+    listItem.appendChild(link);
+    notesList.appendChild(listItem);
+}
+
+async function fetchNotesForSidebar(cursor = null) {
+    if (!cursor) {
+        notesList.innerHTML = '<li class="loading-notes-sidebar">Loading notes...</li>';
+    }
     try {
-        const response = await fetch('/get_user_notes');
-        const data = await response.json(); // Data is directly the array of notes
+        const url = cursor ? `/get_user_notes?cursor=${encodeURIComponent(cursor)}` : '/get_user_notes';
+        const response = await fetch(url);
+        const data = await response.json(); // { notes: [...], next_cursor: ... }
 
         if (response.ok) {
-            notesList.innerHTML = ''; 
-            if (data.length > 0) { // Check if the array has elements
-                data.forEach(note => {
-                    const listItem = document.createElement('li');
-                    const link = document.createElement('a');
-                    link.href = '#';
-                    link.dataset.noteId = note._id; // Use note._id
-                    link.innerHTML = `<span class="sidebar-icon">📄</span> ${note.title}`;
-                    link.addEventListener('click', (e) => {
+            if (!cursor) {
+                notesList.innerHTML = ''; 
+            } else {
+                const loadMore = notesList.querySelector('.load-more-notes');
+                if (loadMore) loadMore.remove();
+            }
+            if (data.notes.length > 0 || cursor) {
+                data.notes.forEach(appendSidebarNote);
+                // More notes are fetched a page at a time on demand
+                if (data.next_cursor) {
+                    const loadMoreItem = document.createElement('li');
+                    loadMoreItem.className = 'load-more-notes';
+                    const loadMoreLink = document.createElement('a');
+                    loadMoreLink.href = '#';
+                    loadMoreLink.textContent = 'Load more...';
+                    loadMoreLink.addEventListener('click', (e) => {
                         e.preventDefault();
-                        loadNoteDetails(note._id); // Use note._id
-                        // Remove 'active' from all, add to clicked
-                        document.querySelectorAll('#notesList a').forEach(a => a.classList.remove('active'));
-                        link.classList.add('active');
+                        fetchNotesForSidebar(data.next_cursor);
                     });
-                    listItem.appendChild(link);
-                    notesList.appendChild(listItem);
-                });
+                    loadMoreItem.appendChild(loadMoreLink);
+                    notesList.appendChild(loadMoreItem);
+                }
             } else {
                 notesList.innerHTML = '<li class="no-notes-sidebar">No notes yet.</li>';
             }
@@ -187,17 +229,35 @@ async function loadNoteDetails(noteId) {
                     `;
                     noteDetailTasks.appendChild(listItem);
 
-                    // Add event listener to checkbox for tracking changes
-                    listItem.querySelector('input[type="checkbox"]').addEventListener('change', trackContentChanges);
+                    // Ticking a box saves just that task; it no longer waits for "Save Changes"
+                    listItem.querySelector('input[type="checkbox"]').addEventListener('change', async (event) => {
+                        const checkbox = event.target;
+                        try {
+                            const response = await fetch('/tasks/bulk', {
+                                method: 'POST',
+                                headers: { 'Content-Type': 'application/json' },
+                                body: JSON.stringify({ updates: [{ id: taskItem.id, completed: checkbox.checked }] })
+                            });
+                            if (!response.ok) {
+                                const data = await response.json();
+                                throw new Error(data.error || `HTTP error! status: ${response.status}`);
+                            }
+                            originalNoteContent.detected_tasks[index].completed = checkbox.checked;
+                        } catch (error) {
+                            console.error('Error updating task:', error);
+                            checkbox.checked = !checkbox.checked;
+                        }
+                        trackContentChanges();
+                    });
                 });
             } else {
                 noteDetailTasks.textContent = 'No tasks detected.';
             }
 
-            // Audio (UNCOMMENTED AND CORRECTED)
-            if (note.audio_base64) {
-                // Assuming the audio type is webm, adjust if needed (e.g., mp3)
-                noteDetailAudio.src = `data:audio/webm;base64,${note.audio_base64}`;
+            // Audio is streamed from the server (supports seeking via Range requests)
+            if (note.audio_url) {
+                noteDetailAudio.preload = 'metadata';
+                noteDetailAudio.src = note.audio_url;
                 noteDetailAudio.style.display = 'block';
             } else {
                 noteDetailAudio.style.display = 'none';
@@ -344,6 +404,7 @@ async function saveNewTranscribedNote(title, transcript, summary, tags, detected
         if (response.ok) {
             alert(data.message || 'New note saved successfully!');
             fetchNotesForSidebar(); // Refresh sidebar
+            loadCategoryFilter();
             // Optionally load the new note details
             // if (data.noteId) loadNoteDetails(data.noteId);
             
@@ -438,14 +499,17 @@ sidebarSearchInput.addEventListener('input', () => {
 
 async function performSearch(query) {
     try {
-        const response = await fetch(`/get_user_notes`); 
-        const allNotes = await response.json();
-
-        const filteredNotes = allNotes.filter(note => 
-            (note.title && note.title.toLowerCase().includes(query.toLowerCase())) ||
-            (note.summary && note.summary.toLowerCase().includes(query.toLowerCase())) ||
-            (note.transcript && note.transcript.toLowerCase().includes(query.toLowerCase()))
-        );
+        // Keyword mode ranks with the server's BM25 index, without an embedding call
+        const response = await fetch('/semantic_search', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ query: query, mode: 'keyword', num_results: 50 })
+        });
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || `HTTP error! status: ${response.status}`);
+        }
+        const filteredNotes = data.related_notes || [];
 
 
         searchLoading.style.display = 'none';
@@ -484,6 +548,28 @@ async function performSearch(query) {
 }
 
 
+// Fills the category filter with the tags actually used in the vault, most used first
+async function loadCategoryFilter() {
+    try {
+        const response = await fetch('/user_metadata');
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || `HTTP error! status: ${response.status}`);
+        }
+        const selected = categoryFilter.value;
+        categoryFilter.innerHTML = '<option value="">All Categories</option>';
+        data.tags.forEach(({ tag, count }) => {
+            const option = document.createElement('option');
+            option.value = tag;
+            option.textContent = `${tag} (${count})`;
+            categoryFilter.appendChild(option);
+        });
+        categoryFilter.value = data.tags.some(({ tag }) => tag === selected) ? selected : '';
+    } catch (error) {
+        console.error('Error loading categories:', error);
+    }
+}
+
 categoryFilter.addEventListener('change', () => {
     const selectedCategory = categoryFilter.value;
     searchInput.value = '';
@@ -501,13 +587,12 @@ async function filterNotesByCategory(category) {
     welcomeMessage.style.display = 'none'; 
 
     try {
-        const response = await fetch(`/get_notes_by_category?category=${encodeURIComponent(category)}`);
-        const data = await response.json();
+        const notes = await fetchAllNotes(`/get_notes_by_category?category=${encodeURIComponent(category)}`);
 
         searchLoading.style.display = 'none';
 
-        if (response.ok && data.notes && data.notes.length > 0) {
-            data.notes.forEach(note => {
+        if (notes.length > 0) {
+            notes.forEach(note => {
                 const resultItem = document.createElement('div');
                 resultItem.className = 'search-result-item';
                 resultItem.innerHTML = `
@@ -538,6 +623,7 @@ async function filterNotesByCategory(category) {
 
 document.addEventListener('DOMContentLoaded', () => {
     fetchNotesForSidebar();
+    loadCategoryFilter();
     introSection.style.display = 'flex'; 
     noteDetailView.style.display = 'none';
     formattingToolbar.style.display = 'none'; 
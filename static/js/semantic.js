@@ -111,16 +111,46 @@ function showLoading(show) {
     loadingSpinner.style.display = show ? 'block' : 'none';
 }
 
+// Follows next_cursor until every page of the user's notes has been fetched
+async function fetchAllNotes(url) {
+    const notes = [];
+    let cursor = null;
+    do {
+        const response = await fetch(cursor ? `${url}?limit=200&cursor=${encodeURIComponent(cursor)}` : `${url}?limit=200`);
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        const data = await response.json();
+        notes.push(...data.notes);
+        cursor = data.next_cursor;
+    } while (cursor);
+    return notes;
+}
+
+// Queues notes without embeddings on the server and polls until its sweep finishes
+async function waitForEmbeddingJob() {
+    let response = await fetch('/embed_notes', { method: 'POST' });
+    if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+    }
+    let job = await response.json();
+    while (job.status === 'queued' || job.status === 'running') {
+        await new Promise(resolve => setTimeout(resolve, 1000));
+        response = await fetch('/embed_notes');
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+        job = await response.json();
+    }
+    return job;
+}
+
 async function fetchAndProcessNotes() {
     showLoading(true);
     showMessage('Fetching notes...', 'info');
     try {
         // 1. Fetch all user notes
-        const notesResponse = await fetch('/get_user_notes');
-        if (!notesResponse.ok) {
-            throw new Error(`HTTP error! status: ${notesResponse.status}`);
-        }
-        allNotes = await notesResponse.json();
+        allNotes = await fetchAllNotes('/get_user_notes');
 
         if (allNotes.length === 0) {
             showMessage('No notes found. Create some notes to see the semantic map.', 'info');
@@ -128,43 +158,26 @@ async function fetchAndProcessNotes() {
             return;
         }
 
-        // 2. Generate embeddings for any notes missing them
-        let notesToEmbed = allNotes.filter(note => !note.embedding);
-        if (notesToEmbed.length > 0) {
-            showMessage(`Generating embeddings for ${notesToEmbed.length} notes... This might take a while.`, 'info');
-            for (const note of notesToEmbed) {
-                try {
-                    const textToEmbed = note.summary || note.transcript || note.title;
-                    if (!textToEmbed) {
-                        console.warn(`Note ${note._id} has no content to embed.`);
-                        continue;
-                    }
-                    const embedResponse = await fetch('/generate_embedding', {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ text: textToEmbed, note_id: note._id })
-                    });
-                    if (!embedResponse.ok) {
-                        throw new Error(`HTTP error! status: ${embedResponse.status}`);
-                    }
-                    const result = await embedResponse.json();
-                    // Update the note object in our local 'allNotes' array
-                    const index = allNotes.findIndex(n => n._id === note._id);
-                    if (index !== -1) {
-                        allNotes[index].embedding = result.embedding;
-                    }
-                } catch (error) {
-                    console.error(`Error generating embedding for note ${note._id}:`, error);
-                    showMessage(`Failed to generate embedding for some notes. Check console for details.`, 'error');
+        // 2. Let the server embed any notes that have no embedding yet
+        if (allNotes.some(note => !note.has_embedding)) {
+            showMessage('Generating embeddings for new notes... This might take a while.', 'info');
+            try {
+                const job = await waitForEmbeddingJob();
+                if (job.status === 'error') {
+                    throw new Error(job.error);
                 }
+                allNotes = await fetchAllNotes('/get_user_notes');
+                showMessage('Embeddings generation complete.', 'success');
+            } catch (error) {
+                console.error('Error generating embeddings:', error);
+                showMessage(`Failed to generate embedding for some notes. Check console for details.`, 'error');
             }
-            showMessage('Embeddings generation complete.', 'success');
         } else {
             showMessage('All notes already have embeddings.', 'info');
         }
 
         // Filter for notes that successfully have embeddings now
-        const embeddedNotes = allNotes.filter(note => note.embedding);
+        const embeddedNotes = allNotes.filter(note => note.has_embedding);
 
         if (embeddedNotes.length === 0) {
             showMessage('No notes with embeddings available to form a map. Please ensure notes have content for embedding generation.', 'info');
@@ -172,21 +185,35 @@ async function fetchAndProcessNotes() {
             return;
         }
 
+        // 3. Ask the server for the similarity graph: clusters, layout and nearest-neighbour edges
+        const graphResponse = await fetch('/semantic_graph');
+        if (!graphResponse.ok) {
+            throw new Error(`HTTP error! status: ${graphResponse.status}`);
+        }
+        const graph = await graphResponse.json();
+        const notesById = {};
+        embeddedNotes.forEach(note => {
+            notesById[note._id] = note;
+        });
+
         nodes.clear();
         edges.clear();
 
-        const uniqueTags = new Set();
-        const tagNodeIds = {}; // Maps tag name to node ID
-        let tagColorIndex = 0;
+        const layoutScale = 60 * Math.sqrt(graph.nodes.length) + 200;
+        const clusterMembers = {};
 
-        // Add all notes as box nodes
-        embeddedNotes.forEach((note, index) => {
-            const nodeColor = noteColors[index % noteColors.length]; // Cycle through colors
+        // Add all notes as box nodes, coloured by cluster and placed by the server's layout
+        graph.nodes.forEach(graphNode => {
+            const note = notesById[graphNode.id] || {};
+            const nodeColor = noteColors[graphNode.cluster % noteColors.length];
+            (clusterMembers[graphNode.cluster] = clusterMembers[graphNode.cluster] || []).push(graphNode);
             nodes.add({
-                id: note._id,
+                id: graphNode.id,
                 label: note.title || 'Untitled Note',
                 title: note.summary || 'No summary.', // Tooltip on hover
                 shape: 'box',
+                x: graphNode.x * layoutScale,
+                y: graphNode.y * layoutScale,
                 color: {
                     background: nodeColor,
                     border: nodeColor
@@ -200,61 +227,42 @@ async function fetchAndProcessNotes() {
                 widthConstraint: { maximum: 180 },
                 shadow: true
             });
+        });
 
-            // Collect unique tags and create tag nodes
-            if (note.tags && note.tags.length > 0) {
-                note.tags.forEach(tag => {
-                    if (!uniqueTags.has(tag)) {
-                        uniqueTags.add(tag);
-                        const tagNodeId = `tag_${tag.replace(/\s+/g, '_').toLowerCase()}`;
-                        tagNodeIds[tag] = tagNodeId;
-                        nodes.add({
-                            id: tagNodeId,
-                            label: tag,
-                            shape: 'circle', // Tag nodes are circles
-                            color: {
-                                background: 'black', // Black background for tags
-                                border: 'black'
-                            },
-                            font: {
-                                color: 'white', // White text for tags
-                                size: 16,
-                                face: 'Arial',
-                                background: 'transparent'
-                            },
-                            size: 30, // Slightly smaller than central topic, larger than notes
-                            shadow: true,
-                        });
-                    }
-                    // Connect note to its tag node
-                    edges.add({ from: tagNodeIds[tag], to: note._id, color: 'black' });
+        // Label each cluster with its most common tag, placed at the middle of its notes
+        Object.entries(clusterMembers).forEach(([cluster, members]) => {
+            const tagCounts = {};
+            members.forEach(member => {
+                ((notesById[member.id] || {}).tags || []).forEach(tag => {
+                    tagCounts[tag] = (tagCounts[tag] || 0) + 1;
                 });
-            } else {
-                // Handle notes without tags: connect to a generic 'Untagged' node
-                const untaggedNodeId = 'untagged_notes';
-                if (!nodes.get(untaggedNodeId)) {
-                    nodes.add({
-                        id: untaggedNodeId,
-                        label: 'Untagged Notes',
-                        shape: 'circle',
-                        color: {
-                            background: '#B0C4DE', // Light steel blue
-                            border: '#778899' // Light slate grey
-                        },
-                        font: {
-                            color: 'black',
-                            size: 16,
-                            face: 'Arial',
-                            background: 'transparent'
-                        },
-                        size: 30,
-                        shadow: true,
-                    });
-                }
-                edges.add({ from: untaggedNodeId, to: note._id, color: 'black' });
-            }
+            });
+            const topTag = Object.keys(tagCounts).sort((a, b) => tagCounts[b] - tagCounts[a])[0];
+            const clusterColor = noteColors[cluster % noteColors.length];
+            nodes.add({
+                id: `cluster_${cluster}`,
+                label: topTag || 'Untagged Notes',
+                shape: 'circle',
+                x: members.reduce((sum, member) => sum + member.x, 0) / members.length * layoutScale,
+                y: members.reduce((sum, member) => sum + member.y, 0) / members.length * layoutScale,
+                color: {
+                    background: 'black',
+                    border: clusterColor
+                },
+                font: {
+                    color: 'white',
+                    size: 16,
+                    face: 'Arial',
+                    background: 'transparent'
+                },
+                size: 30,
+                shadow: true
+            });
         });
 
+        graph.edges.forEach(edge => {
+            edges.add({ from: edge.from, to: edge.to, width: 1 + 3 * Math.max(edge.similarity, 0), title: `Similarity: ${edge.similarity.toFixed(2)}` });
+        });
 
         // Initialize the network
         if (!network) {
@@ -263,12 +271,11 @@ async function fetchAndProcessNotes() {
             network.setData(data);
         }
 
-        network.once("stabilizationIterationsDone", function() {
-            network.fit();
-        });
-        network.stabilize();
+        // The server already laid the notes out, so skip the physics simulation
+        network.setOptions({ physics: { enabled: false } });
+        network.fit();
 
-        showMessage('Semantic map loaded! Notes are grouped by tags. You can drag nodes and pan/zoom the graph.', 'success');
+        showMessage('Semantic map loaded! Similar notes are linked and grouped into coloured clusters. You can drag nodes and pan/zoom the graph.', 'success');
 
     } catch (error) {
         console.error("Error building semantic map:", error);
@@ -17,6 +17,7 @@ let isRecording = false;
 let fullTranscriptText = '';
 let currentSummaryData = null; // Store the last generated summary data (includes title, tasks, and tags)
 let recordedAudioBlob = null;
+let recordedUploadId = null; // Server-side copy of the recording, kept by /transcribe_audio
 
 const TRANSCRIPT_TRUNCATE_LIMIT = 500;
 
@@ -40,6 +41,7 @@ micButton.addEventListener('click', async () => {
         fullTranscriptText = '';
         currentSummaryData = null;
         recordedAudioBlob = null;
+        recordedUploadId = null;
 
 
         // Start recording
@@ -78,12 +80,35 @@ micButton.addEventListener('click', async () => {
     }
 });
 
+function showTranscript(text) {
+    if (text.length > TRANSCRIPT_TRUNCATE_LIMIT) {
+        const truncatedText = text.substring(0, TRANSCRIPT_TRUNCATE_LIMIT) + '...';
+        transcriptContent.textContent = truncatedText;
+        const readMoreButton = document.createElement('button');
+        readMoreButton.className = 'read-more-button';
+        readMoreButton.textContent = 'Read More';
+        readMoreButton.onclick = () => {
+            transcriptContent.textContent = text;
+            readMoreButton.remove();
+        };
+        transcriptContent.appendChild(readMoreButton);
+    } else {
+        transcriptContent.textContent = text;
+    }
+
+    transcriptArea.style.display = 'block';
+    setTimeout(() => {
+        transcriptArea.style.opacity = 1;
+    }, 10);
+}
+
 async function sendAudioForTranscription(audioBlob) {
     const formData = new FormData();
     formData.append('audio_file', audioBlob, 'recording.webm');
+    formData.append('keep_audio', '1');
 
     try {
-        const response = await fetch('/transcribe_audio', {
+        const response = await fetch('/transcribe_audio_stream', {
             method: 'POST',
             body: formData,
         });
@@ -92,50 +117,37 @@ async function sendAudioForTranscription(audioBlob) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
 
-        const data = await response.json();
+        // Long recordings are transcribed in chunks; show them as they arrive
+        const partialChunks = [];
+        let data = null;
+        await readServerSentEvents(response, (eventName, payload) => {
+            if (eventName === 'chunk') {
+                partialChunks[payload.index] = payload.text;
+                loadingIndicator.textContent = `Transcribing... (${partialChunks.filter(Boolean).length}/${payload.total})`;
+                transcriptContent.textContent = partialChunks.filter(Boolean).join(' ');
+                transcriptArea.style.display = 'block';
+                transcriptArea.style.opacity = 1;
+            } else if (eventName === 'done' || eventName === 'error') {
+                data = payload;
+            }
+        });
         console.log('Transcription response:', data);
 
         loadingIndicator.style.display = 'none';
 
-        if (data.transcript) {
+        if (data && data.transcript) {
             fullTranscriptText = data.transcript;
-
-            if (fullTranscriptText.length > TRANSCRIPT_TRUNCATE_LIMIT) {
-                const truncatedText = fullTranscriptText.substring(0, TRANSCRIPT_TRUNCATE_LIMIT) + '...';
-                transcriptContent.textContent = truncatedText;
-                const readMoreButton = document.createElement('button');
-                readMoreButton.className = 'read-more-button';
-                readMoreButton.textContent = 'Read More';
-                readMoreButton.onclick = () => {
-                    transcriptContent.textContent = fullTranscriptText;
-                    readMoreButton.remove();
-                };
-                transcriptContent.appendChild(readMoreButton);
-            } else {
-                transcriptContent.textContent = fullTranscriptText;
-            }
-            
-            transcriptArea.style.display = 'block';
-            setTimeout(() => {
-                transcriptArea.style.opacity = 1;
-            }, 10);
+            recordedUploadId = data.upload_id || null;
+            showTranscript(fullTranscriptText);
 
             setTimeout(() => {
                 generateSummaryButton.style.display = 'block';
             }, 500);
 
-        } else if (data.error) {
-            transcriptArea.style.display = 'block';
-            transcriptContent.textContent = `Error: ${data.error}`;
-            setTimeout(() => {
-                transcriptArea.style.opacity = 1;
-            }, 10);
+        } else if (data && data.error) {
+            showTranscript(`Error: ${data.error}`);
         } else {
-            transcriptArea.style.display = 'block';
-            transcriptContent.textContent = 'No transcript received.';
-            setTimeout(() => {
-                transcriptArea.style.opacity = 1;
-            }, 10);
+            showTranscript('No transcript received.');
         }
 
     } catch (error) {
@@ -150,6 +162,34 @@ async function sendAudioForTranscription(audioBlob) {
     }
 }
 
+function renderSummaryFields(data) {
+    // Display Title
+    if (data.title) {
+        noteTitleElement.textContent = data.title;
+    } else {
+        noteTitleElement.textContent = 'Untitled Note';
+    }
+
+    if (data.summary) {
+        summaryContent.textContent = data.summary;
+    } else {
+        summaryContent.textContent = 'No summary generated.';
+    }
+
+    tagsContent.innerHTML = '';
+    if (Array.isArray(data.tags) && data.tags.length > 0) {
+        const tagHtml = data.tags.map(tag => `<span class="tag-item">#${String(tag).replace(/\s/g, '')}</span>`).join('');
+        tagsContent.innerHTML = tagHtml;
+    }
+
+    tasksContent.innerHTML = '';
+    if (Array.isArray(data.detected_tasks) && data.detected_tasks.length > 0) {
+        tasksContent.innerHTML = '<h4>Tasks Detected:</h4><ul>' + 
+                                   data.detected_tasks.map(task => `<li>${task}</li>`).join('') + 
+                                   '</ul>';
+    }
+}
+
 generateSummaryButton.addEventListener('click', async () => {
     if (!fullTranscriptText) { 
         alert("No transcript available to summarize.");
@@ -170,14 +210,32 @@ generateSummaryButton.addEventListener('click', async () => {
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ transcript: fullTranscriptText }), 
+            body: JSON.stringify({ transcript: fullTranscriptText, stream: true }), 
         });
 
         if (!response.ok) {
             throw new Error(`HTTP error! status: ${response.status}`);
         }
 
-        const data = await response.json();
+        // Fields arrive one by one while the model is still writing the JSON
+        const partialData = {};
+        let data = null;
+        await readServerSentEvents(response, (eventName, payload) => {
+            if (eventName === 'fields') {
+                Object.assign(partialData, payload);
+                loadingIndicator.style.display = 'none';
+                summaryArea.style.display = 'block';
+                summaryArea.style.opacity = 1;
+                renderSummaryFields(partialData);
+            } else if (eventName === 'done') {
+                data = payload;
+            } else if (eventName === 'error') {
+                data = payload;
+            }
+        });
+        if (!data) {
+            throw new Error('The summary stream ended unexpectedly.');
+        }
         console.log('Summary response:', data);
 
         currentSummaryData = data; // Store the entire response data
@@ -185,30 +243,8 @@ generateSummaryButton.addEventListener('click', async () => {
         loadingIndicator.style.display = 'none';
         summaryArea.style.display = 'block';
 
-        // Display Title
-        if (data.title) {
-            noteTitleElement.textContent = data.title;
-        } else {
-            noteTitleElement.textContent = 'Untitled Note';
-        }
-
-        if (data.summary) {
-            summaryContent.textContent = data.summary;
-        } else {
-            summaryContent.textContent = 'No summary generated.';
-        }
-
-        tagsContent.innerHTML = '';
-        if (data.tags && data.tags.length > 0) {
-            const tagHtml = data.tags.map(tag => `<span class="tag-item">#${tag.replace(/\s/g, '')}</span>`).join('');
-            tagsContent.innerHTML = tagHtml;
-        }
-
-        tasksContent.innerHTML = '';
+        renderSummaryFields(data);
         if (data.detected_tasks && data.detected_tasks.length > 0) {
-            tasksContent.innerHTML = '<h4>Tasks Detected:</h4><ul>' + 
-                                       data.detected_tasks.map(task => `<li>${task}</li>`).join('') + 
-                                       '</ul>';
             setTimeout(() => {
                 uploadTasksButton.style.display = 'block';
             }, 500);
@@ -264,44 +300,26 @@ saveNoteButton.addEventListener('click', async () => {
     loadingIndicator.style.display = 'block';
     saveNoteButton.style.display = 'none';
 
+    const noteToSave = {
+        title: currentSummaryData.title, // Include the title
+        transcript: fullTranscriptText,
+        summary: currentSummaryData.summary,
+        tags: currentSummaryData.tags,
+        detected_tasks: currentSummaryData.detected_tasks
+    };
+
+    // The server already holds the recording from transcription, so only its ID is sent
+    if (recordedUploadId) {
+        noteToSave.upload_id = recordedUploadId;
+        await postNote(noteToSave);
+        return;
+    }
+
     const reader = new FileReader();
     reader.readAsDataURL(recordedAudioBlob);
     reader.onloadend = async function() {
-        const base64Audio = reader.result.split(',')[1];
-
-        const noteToSave = {
-            title: currentSummaryData.title, // Include the title
-            transcript: fullTranscriptText,
-            summary: currentSummaryData.summary,
-            tags: currentSummaryData.tags,
-            detected_tasks: currentSummaryData.detected_tasks,
-            audio_base64: base64Audio
-        };
-
-        try {
-            const response = await fetch('/save_note', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify(noteToSave),
-            });
-
-            if (!response.ok) {
-                throw new Error(`HTTP error! status: ${response.status}`);
-            }
-
-            const result = await response.json();
-            console.log('Save note response:', result);
-            alert(result.message);
-            loadingIndicator.style.display = 'none';
-
-        } catch (error) {
-            console.error('Error saving note:', error);
-            alert(`Failed to save note: ${error.message}`);
-            loadingIndicator.style.display = 'none';
-            saveNoteButton.style.display = 'block';
-        }
+        noteToSave.audio_base64 = reader.result.split(',')[1];
+        await postNote(noteToSave);
     };
     reader.onerror = function(error) {
         console.error('Error reading audio blob:', error);
@@ -310,3 +328,30 @@ saveNoteButton.addEventListener('click', async () => {
         saveNoteButton.style.display = 'block';
     };
 });
+
+async function postNote(noteToSave) {
+    try {
+        const response = await fetch('/save_note', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(noteToSave),
+        });
+
+        if (!response.ok) {
+            throw new Error(`HTTP error! status: ${response.status}`);
+        }
+
+        const result = await response.json();
+        console.log('Save note response:', result);
+        alert(result.message);
+        loadingIndicator.style.display = 'none';
+
+    } catch (error) {
+        console.error('Error saving note:', error);
+        alert(`Failed to save note: ${error.message}`);
+        loadingIndicator.style.display = 'none';
+        saveNoteButton.style.display = 'block';
+    }
+}
\ No newline at end of file
@@ -0,0 +1,114 @@
+"""Runs app.py against mongomock and an in-process OpenAI stand-in.
+
+MONGO_TEST_URI, when set, names a real mongod for the tests marked `mongod`.
+"""
+import hashlib
+import os
+import sys
+
+import mongomock
+import mongomock.gridfs
+import numpy as np
+import pymongo
+import pytest
+
+RealMongoClient = pymongo.MongoClient
+mongomock.gridfs.enable_gridfs_integration()
+pymongo.MongoClient = mongomock.MongoClient
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as flowsync  # noqa: E402
+
+DIM = 32
+
+
+class _Obj:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+def fake_vector(text):
+    rng = np.random.default_rng(int(hashlib.sha256(text.encode()).hexdigest()[:8], 16))
+    vector = rng.standard_normal(DIM)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class FakeEmbeddings:
+    def __init__(self):
+        self.calls = 0
+        self.before_create = None
+
+    def create(self, input, model, **kwargs):
+        self.calls += 1
+        if self.before_create is not None:
+            self.before_create()
+        items = input if isinstance(input, list) else [input]
+        return _Obj(data=[_Obj(embedding=fake_vector(text), index=i) for i, text in enumerate(items)], usage=None)
+
+
+class FakeChat:
+    def __init__(self):
+        self.calls = 0
+        self.reply = None
+
+    def create(self, model, messages, **kwargs):
+        self.calls += 1
+        if self.reply is not None:
+            content = self.reply(messages, kwargs)
+        elif kwargs.get('response_format'):
+            content = '{"title": "T", "summary": "S", "is_timeline": false, "detected_tasks": ["a"], "tags": ["Work"]}'
+        else:
+            content = 'Topic'
+        return _Obj(choices=[_Obj(message=_Obj(content=content))], usage=None)
+
+
+class FakeOpenAI:
+    def __init__(self):
+        self.embeddings = FakeEmbeddings()
+        self.chat = _Obj(completions=FakeChat())
+        self.audio = _Obj(transcriptions=_Obj(create=lambda **kwargs: _Obj(text='transcript')))
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    fake = FakeOpenAI()
+    monkeypatch.setattr(flowsync, 'openai_client', flowsync.ManagedOpenAI(fake))
+    return fake
+
+
+@pytest.fixture
+def app(monkeypatch, fake_openai):
+    """app.py on a fresh mongomock database with every in-memory cache emptied."""
+    monkeypatch.setattr(flowsync, '_mongo_client', mongomock.MongoClient())
+    monkeypatch.setattr(flowsync, '_gridfs_buckets', {})
+    monkeypatch.setattr(flowsync.embedding_cache, 'ttl_index_ready', False)
+    for cache in (flowsync.vector_indexes, flowsync.keyword_indexes, flowsync.semantic_graphs,
+                  flowsync.response_cache.entries, flowsync.embedding_cache.memory, flowsync.history_summary_cache,
+                  flowsync.user_openai_slots):
+        cache.clear()
+    flowsync.user_cache.entries.clear()
+    return flowsync
+
+
+@pytest.fixture
+def client(app):
+    app.users_collection.insert_one({'username': 'alice', 'password': 'secret'})
+    test_client = app.app.test_client()
+    with test_client.session_transaction() as session:
+        session['username'] = 'alice'
+    return test_client
+
+
+@pytest.fixture
+def mongod(monkeypatch):
+    """app.py on the mongod at MONGO_TEST_URI, in a throwaway database; skipped without one."""
+    uri = os.environ.get('MONGO_TEST_URI')
+    if not uri:
+        pytest.skip('MONGO_TEST_URI is not set')
+    real_client = RealMongoClient(uri, serverSelectionTimeoutMS=2000)
+    name = f"flowsync_test_{os.getpid()}"
+    monkeypatch.setattr(flowsync, '_mongo_client', {'NoteSync': real_client[name]})
+    monkeypatch.setattr(flowsync, '_gridfs_buckets', {})
+    yield flowsync
+    real_client.drop_database(name)
+    real_client.close()
@@ -0,0 +1,51 @@
+import time
+
+import numpy as np
+
+from conftest import fake_vector
+
+
+def wait_for_sweep(app, username, timeout=5):
+    deadline = time.time() + timeout
+    while username in app.artifact_sweeps or app.artifact_queue_collection.count_documents({'username': username}):
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def edit(client, note_id, title, summary):
+    response = client.post('/update_note', json={'noteId': note_id, 'title': title, 'summary': summary, 'transcript': 't'})
+    assert response.status_code == 200
+
+
+def test_edits_re_embed_only_when_the_embedding_input_changes(app, client, fake_openai):
+    note_id = app.create_note('alice', 'title', 't', 'first summary', ['Work'], ['a'], None)
+    app.enqueue_artifacts('alice', [app.ObjectId(note_id)], ['embedding'])
+    app.sweep_artifacts('alice')
+    calls = fake_openai.embeddings.calls
+
+    edit(client, note_id, 'new title', 'first summary')
+    wait_for_sweep(app, 'alice')
+    assert fake_openai.embeddings.calls == calls
+    assert app.tasks_collection.find_one({'note_id': app.ObjectId(note_id)})['note_title'] == 'new title'
+
+    edit(client, note_id, 'new title', 'second summary')
+    wait_for_sweep(app, 'alice')
+    assert fake_openai.embeddings.calls == calls + 1
+    note = app.notes_collection.find_one({'_id': app.ObjectId(note_id)})
+    assert app.stale_artifacts(note) == []
+    assert np.allclose(app.get_vector_index('alice').get_vector(note_id), fake_vector('second summary'), atol=1e-6)
+
+
+def test_new_notes_record_the_tags_the_classifier_would_build(app, client, monkeypatch):
+    monkeypatch.setattr(app, 'get_note_classifier', lambda: {'version': 'v1'})
+    classified = []
+    monkeypatch.setattr(app, 'classify_notes', lambda texts: classified.extend(texts) or [('Home', 1.0)] * len(texts))
+
+    note_id = app.create_note('alice', 'title', 't', 'summary', ['Work'], [], None)
+    note = app.notes_collection.find_one({'_id': app.ObjectId(note_id)})
+    assert 'tags' not in app.stale_artifacts(note)
+
+    edit(client, note_id, 'new title', 'summary')
+    wait_for_sweep(app, 'alice')
+    assert classified == []
+    assert app.notes_collection.find_one({'_id': app.ObjectId(note_id)})['tags'] == ['Work']
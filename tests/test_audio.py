@@ -0,0 +1,34 @@
+import base64
+from datetime import timedelta
+
+
+def age(app, file_id):
+    # uploadDate and the prune cutoff can fall in the same millisecond.
+    app.db['audio.files'].update_one({'_id': file_id}, {'$set': {'uploadDate': app.datetime.utcnow() - timedelta(hours=1)}})
+
+
+def test_saved_note_keeps_audio_it_shares_with_an_unclaimed_upload(app, client):
+    audio = b'same recording'
+    upload_id = app.store_audio('alice', audio, pending=True)
+
+    response = client.post('/save_note', json={
+        'title': 't', 'transcript': 't', 'summary': 's', 'tags': ['Work'], 'detected_tasks': [],
+        'audio_base64': base64.b64encode(audio).decode()
+    })
+    assert response.status_code == 200
+    note = app.notes_collection.find_one({'_id': app.ObjectId(response.get_json()['noteId'])})
+    assert note['audio_file_id'] == upload_id
+
+    age(app, upload_id)
+    result = app.app.test_cli_runner().invoke(args=['prune-uploads', '--max-age-hours', '0'])
+    assert 'Deleted 0 unclaimed uploads.' in result.output
+    assert app.audio_fs.get(upload_id).read() == audio
+
+
+def test_prune_deletes_unclaimed_uploads(app):
+    upload_id = app.store_audio('alice', b'never saved', pending=True)
+    age(app, upload_id)
+    result = app.app.test_cli_runner().invoke(args=['prune-uploads', '--max-age-hours', '0'])
+    assert 'Deleted 1 unclaimed uploads.' in result.output
+    assert not app.audio_fs.exists(upload_id)
+    assert app.db['audio.chunks'].count_documents({'files_id': upload_id}) == 0
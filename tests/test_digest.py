@@ -0,0 +1,31 @@
+import json
+import threading
+
+
+def test_levels_past_the_deadline_go_straight_to_the_root(app, fake_openai, monkeypatch):
+    monkeypatch.setattr(app, 'DIGEST_FAN_IN', 2)
+    monkeypatch.setattr(app, 'DIGEST_TIMEOUT', 0.2)
+    release = threading.Event()
+    prompts = []
+
+    def reply(messages, kwargs):
+        prompts.append(messages[-1]['content'])
+        if 'Title:' in messages[-1]['content']:
+            # Note-level groups miss the deadline.
+            release.wait(5)
+        return json.dumps({'topic': 'Work', 'digest': 'Notes about work.'})
+    fake_openai.chat.completions.reply = reply
+
+    notes = [{'_id': app.ObjectId(), 'title': f"note {i}", 'summary': 'work'} for i in range(32)]
+    try:
+        root = app.build_digest(notes)
+    finally:
+        release.set()
+    # Once every worker is parked here, everything submitted before has run.
+    drained = threading.Barrier(app.DIGEST_WORKERS + 1)
+    for _ in range(app.DIGEST_WORKERS):
+        app.digest_executor.submit(drained.wait, 5)
+    drained.wait(5)
+
+    assert root['complete'] is False
+    assert sum('Title:' not in prompt for prompt in prompts) == 1
@@ -0,0 +1,35 @@
+import numpy as np
+
+
+def insert_embedded(app, vector, embedding_format):
+    return app.notes_collection.insert_one({
+        'username': 'alice', 'title': 't', 'summary': 's',
+        'embedding': app.Binary(np.asarray(vector, dtype='<f4').tobytes(), app.EMBEDDING_SUBTYPES['float32']),
+        'embedding_format': embedding_format, 'embedding_model': app.EMBEDDING_MODEL
+    }).inserted_id
+
+
+def test_truncated_vectors_are_left_out_of_the_index_and_queued_for_re_embedding(app, monkeypatch):
+    rng = np.random.default_rng(0)
+    # Stored at 8 dimensions by an earlier EMBEDDING_DIMENSIONS; inserted first so the index sees it first.
+    truncated = insert_embedded(app, rng.standard_normal(8), 'float32/8')
+    full = [insert_embedded(app, rng.standard_normal(32), 'float32') for _ in range(3)]
+    monkeypatch.setattr(app, 'EMBEDDING_DIMENSIONS', 16)
+
+    result = app.app.test_cli_runner().invoke(args=['migrate-embeddings'])
+    assert '3 notes stored as float32/16, 1 marked for re-embedding' in result.output
+
+    index = app.get_vector_index('alice')
+    assert len(index) == 3 and index.dim == 16
+    assert index.get_vector(str(truncated)) is None
+    assert all(index.get_vector(str(note_id)) is not None for note_id in full)
+    note = app.notes_collection.find_one({'_id': truncated})
+    assert 'embedding' in app.stale_artifacts(note)
+
+
+def test_index_keeps_full_vectors_when_a_truncated_one_comes_first(app):
+    rng = np.random.default_rng(1)
+    insert_embedded(app, rng.standard_normal(8), 'float32/8')
+    for _ in range(3):
+        insert_embedded(app, rng.standard_normal(32), 'float32')
+    assert len(app.get_vector_index('alice')) == 3
@@ -0,0 +1,57 @@
+import base64
+import threading
+import time
+
+
+def save_note(client, title):
+    response = client.post('/save_note', json={
+        'title': title, 'transcript': f"{title} transcript", 'summary': f"{title} summary", 'tags': ['Work'],
+        'detected_tasks': [], 'audio_base64': base64.b64encode(title.encode()).decode()
+    })
+    assert response.status_code == 200
+    return response.get_json()['noteId']
+
+
+def wait_for_embeddings(client, timeout=5):
+    deadline = time.time() + timeout
+    job = client.get('/embed_notes').get_json()
+    while job['status'] == 'running':
+        assert time.time() < deadline, job
+        time.sleep(0.01)
+        job = client.get('/embed_notes').get_json()
+    return job
+
+
+def test_notes_saved_during_a_sweep_are_embedded(app, client, fake_openai):
+    first_batch_started = threading.Event()
+    release = threading.Event()
+
+    def hold_first_batch():
+        if not first_batch_started.is_set():
+            first_batch_started.set()
+            assert release.wait(5)
+    fake_openai.embeddings.before_create = hold_first_batch
+
+    save_note(client, 'note 0')
+    assert first_batch_started.wait(5)
+    # The running pass read its queue entries before these existed.
+    for i in range(1, 5):
+        save_note(client, f"note {i}")
+    release.set()
+
+    assert wait_for_embeddings(client) == {'status': 'done', 'pending': 0, 'error': None}
+    assert app.notes_collection.count_documents({'username': 'alice', 'embedding': {'$exists': False}}) == 0
+    assert len(app.get_vector_index('alice')) == 5
+
+
+def test_embed_notes_leaves_notes_from_an_older_model_to_sweep_artifacts(app, client, fake_openai):
+    app.notes_collection.insert_many([
+        {'username': 'alice', 'title': 'old', 'summary': 'old model', 'embedding': [1.0, 0.0], 'embedding_model': 'older-model'},
+        {'username': 'alice', 'title': 'new', 'summary': 'never embedded'}
+    ])
+
+    assert client.post('/embed_notes').status_code == 202
+    assert wait_for_embeddings(client)['status'] == 'done'
+    assert fake_openai.embeddings.calls == 1
+    assert app.notes_collection.find_one({'title': 'old'})['embedding_model'] == 'older-model'
+    assert app.notes_collection.find_one({'title': 'new'})['embedding_model'] == app.EMBEDDING_MODEL
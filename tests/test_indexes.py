@@ -0,0 +1,24 @@
+def test_verify_indexes_explains_why_it_cannot_run_on_a_mock(app):
+    result = app.app.test_cli_runner().invoke(args=['verify-indexes'])
+    assert result.exit_code == 1
+    assert 'cannot explain queries' in result.output
+    assert 'Traceback' not in result.output
+
+
+def test_every_route_query_uses_an_index(mongod):
+    runner = mongod.app.test_cli_runner()
+    assert runner.invoke(args=['create-indexes']).exit_code == 0
+
+    result = runner.invoke(args=['verify-indexes'])
+    assert result.exit_code == 0, result.output
+    assert '[FAIL]' not in result.output
+
+
+def test_index_load_query_is_the_one_verify_indexes_explains(app, monkeypatch):
+    issued = []
+    find = app.notes_collection.find
+    monkeypatch.setitem(vars(app.notes_collection), 'find', lambda query, *args, **kwargs: issued.append(query) or find(query, *args, **kwargs))
+    app.get_vector_index('alice')
+
+    declared = {route: query for route, _, query, _ in app.route_queries('alice')}
+    assert issued == [declared['semantic_search index load']]
@@ -0,0 +1,29 @@
+def mongo_count(app):
+    return sum(series['count'] for (route, stage), series in app.stage_seconds.series.items() if stage == 'mongo')
+
+
+def test_find_streams_documents_and_records_one_mongo_span(app):
+    app.notes_collection.insert_many([{'username': 'alice', 'n': i} for i in range(10)])
+    before = mongo_count(app)
+
+    cursor = app.notes_collection.find({'username': 'alice'}).sort('n', 1)
+    assert [document['n'] for document in cursor] == list(range(10))
+
+    # One span for the find() call and one for iterating it.
+    assert mongo_count(app) == before + 2
+
+
+def test_timed_cursor_hands_out_documents_before_reading_the_rest(app):
+    def source():
+        yield {'n': 0}
+        raise AssertionError('read past the first document')
+
+    assert next(iter(app._TimedCursor(source())))['n'] == 0
+
+
+def test_abandoned_cursor_still_records_its_span(app):
+    app.notes_collection.insert_many([{'username': 'alice', 'n': i} for i in range(3)])
+    before = mongo_count(app)
+    for document in app.notes_collection.find({'username': 'alice'}):
+        break
+    assert mongo_count(app) == before + 2
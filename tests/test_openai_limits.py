@@ -0,0 +1,23 @@
+import threading
+
+
+def test_saturated_model_api_returns_503_with_retry_after(app, client, monkeypatch):
+    app.notes_collection.insert_one({'username': 'alice', 'title': 't', 'embedding': [1.0] * 32})
+    monkeypatch.setattr(app, 'OPENAI_QUEUE_TIMEOUT', 0.01)
+    held = threading.BoundedSemaphore(1)
+    held.acquire()
+    app.user_openai_slots.put('alice', held)
+
+    response = client.post('/semantic_search', json={'query': 'anything'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(app.OPENAI_BUSY_RETRY_AFTER)
+    assert 'Too many AI requests' in response.get_json()['error']
+
+
+def test_per_user_slots_are_bounded(app, client, fake_openai, monkeypatch):
+    monkeypatch.setattr(app.user_openai_slots, 'max_entries', 2)
+    for username in ('bob', 'carol', 'alice'):
+        with app.app.test_request_context():
+            app.session['username'] = username
+            app.embed_texts([f"text for {username}"])
+    assert set(app.user_openai_slots.entries) == {'carol', 'alice'}
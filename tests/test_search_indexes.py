@@ -0,0 +1,31 @@
+def test_vector_indexes_keep_only_the_most_recent_users(app, monkeypatch):
+    monkeypatch.setattr(app.vector_indexes, 'max_entries', 2)
+    for username in ('alice', 'bob', 'carol'):
+        app.get_vector_index(username)
+    assert app.vector_indexes.get('alice') is None
+    assert app.vector_indexes.get('bob') is not None
+    assert app.vector_indexes.get('carol') is not None
+
+
+def test_keyword_indexes_keep_only_the_most_recent_users(app, monkeypatch):
+    monkeypatch.setattr(app.keyword_indexes, 'max_entries', 2)
+    for username in ('alice', 'bob', 'carol'):
+        app.get_keyword_index(username)
+    assert app.keyword_indexes.get('alice') is None
+    assert app.keyword_indexes.get('bob') is not None
+    assert app.keyword_indexes.get('carol') is not None
+
+
+def test_semantic_search_rejects_a_bad_result_count(app, client):
+    for num_results in ('abc', None, [3]):
+        response = client.post('/semantic_search', json={'query': 'work', 'mode': 'keyword', 'num_results': num_results})
+        assert response.status_code == 400
+        assert response.get_json() == {'error': 'num_results must be an integer.'}
+
+
+def test_semantic_search_clamps_the_result_count(app, client):
+    for i in range(app.SEARCH_MAX_RESULTS + 5):
+        app.create_note('alice', f"work {i}", 't', 'work', ['Work'], [], None)
+    response = client.post('/semantic_search', json={'query': 'work', 'mode': 'keyword', 'num_results': 10 ** 6})
+    assert response.status_code == 200
+    assert len(response.get_json()['related_notes']) == app.SEARCH_MAX_RESULTS
@@ -0,0 +1,23 @@
+import numpy as np
+
+
+def edges(payload):
+    return {(edge['from'], edge['to']) for edge in payload['edges']}
+
+
+def test_patched_graph_matches_a_rebuild_without_keeping_the_matrix(app):
+    rng = np.random.default_rng(0)
+    index = app.VectorIndex()
+    for i in range(100):
+        index.upsert(f"n{i}", rng.standard_normal(16))
+    graph = app.SemanticGraph()
+    graph.sync(index)
+
+    for i in range(3):
+        index.upsert(f"n{i}", rng.standard_normal(16))
+    index.upsert('n100', rng.standard_normal(16))
+    patched = graph.sync(index)
+
+    assert graph.changes_since_build == 4
+    assert not any(isinstance(value, np.ndarray) and value.shape == (101, 16) for value in vars(graph).values())
+    assert edges(patched) == edges(app.SemanticGraph().sync(index))
@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in a fresh interpreter: conftest has already imported numpy in this one.
+CONCURRENT_FIRST_REQUESTS = textwrap.dedent('''
+    import sys
+    import threading
+
+    import mongomock
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+    import app as flowsync
+    flowsync._mongo_client = mongomock.MongoClient()
+    flowsync.notes_collection.insert_many([
+        {'username': 'alice', 'title': str(i), 'embedding': [float(i == j) for j in range(8)]} for i in range(8)
+    ])
+
+    statuses = []
+    start = threading.Barrier(8)
+
+    def first_request():
+        client = flowsync.app.test_client()
+        with client.session_transaction() as session:
+            session['username'] = 'alice'
+        start.wait()
+        statuses.append(client.get('/semantic_graph').status_code)
+
+    threads = [threading.Thread(target=first_request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(sorted(statuses))
+''')
+
+
+def test_concurrent_first_requests_on_a_fresh_worker():
+    result = subprocess.run([sys.executable, '-c', CONCURRENT_FIRST_REQUESTS], cwd=ROOT, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split('\n')[-2] == str([200] * 8), result.stdout
@@ -0,0 +1,44 @@
+import io
+
+import pytest
+from werkzeug.test import EnvironBuilder
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('', None),
+    ('{', {}),
+    ('{"title": "Wee', {'title': 'Wee'}),
+    ('{"title": "Weekly sync", "summ', {'title': 'Weekly sync'}),
+    ('{"title": "Weekly sync", "summary":', {'title': 'Weekly sync'}),
+    ('{"tags": ["Work", "Pla', {'tags': ['Work', 'Pla']}),
+    ('{"tasks": [{"task": "a"}, {"task": "b', {'tasks': [{'task': 'a'}, {'task': 'b'}]}),
+    ('{"is_timeline": tr', None),
+    ('{"title": "a, b", "n": 1', {'title': 'a, b', 'n': 1}),
+])
+def test_parse_partial_json_closes_truncated_objects(app, text, expected):
+    assert app.parse_partial_json(text) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('{"quote": "she said \\"hi', {'quote': 'she said "hi'}),
+    ('{"quote": "she said \\"hi\\"", "next": "x', {'quote': 'she said "hi"', 'next': 'x'}),
+    ('{"path": "C:\\\\', {'path': 'C:\\'}),
+    ('{"path": "a\\', {'path': 'a'}),
+    ('{"brace": "{[", "n": [1', {'brace': '{[', 'n': [1]}),
+    ('{"line": "one\\ntwo', {'line': 'one\ntwo'}),
+])
+def test_parse_partial_json_handles_escapes_inside_strings(app, text, expected):
+    assert app.parse_partial_json(text) == expected
+
+
+def test_streamed_upload_is_removed_when_the_client_leaves_before_reading(app, client, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'UPLOAD_TMP_DIR', str(tmp_path))
+    cookie = client.get_cookie('session')
+    environ = EnvironBuilder(path='/transcribe_audio_stream', method='POST', headers={'Cookie': f"session={cookie.value}"},
+                             data={'audio_file': (io.BytesIO(b'audio'), 'clip.webm')}).get_environ()
+
+    # What the server does when the client disconnects: close the body without reading it.
+    body = app.app(environ, lambda status, headers: None)
+    assert list(tmp_path.iterdir())
+    body.close()
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,37 @@
+from pymongo.errors import BulkWriteError
+
+
+def bulk(client, *updates):
+    return client.post('/tasks/bulk', json={'updates': [{'id': task_id, 'completed': completed} for task_id, completed in updates]})
+
+
+def test_bulk_update_rewrites_legacy_string_tasks(app, client):
+    note_id = app.notes_collection.insert_one({
+        'username': 'alice', 'title': 'old', 'timestamp': app.datetime.now(), 'detected_tasks': ['call bob', 'file taxes']
+    }).inserted_id
+    app.sync_note_tasks('alice', note_id, app.note_tasks({'detected_tasks': ['call bob', 'file taxes']}), 'old', app.datetime.now())
+
+    response = bulk(client, (f"{note_id}:1", True))
+    assert response.status_code == 200
+    assert response.get_json() == {'matched': 1, 'modified': 1}
+    assert app.notes_collection.find_one({'_id': note_id})['detected_tasks'] == [
+        {'task': 'call bob', 'completed': False}, {'task': 'file taxes', 'completed': True}
+    ]
+    assert app.tasks_collection.find_one({'_id': f"{note_id}:1"})['completed'] is True
+
+
+def test_tasks_mirror_follows_the_note_writes_that_landed(app, client, monkeypatch):
+    first = app.ObjectId(app.create_note('alice', 'one', 't', 's', ['Work'], ['a'], None))
+    second = app.ObjectId(app.create_note('alice', 'two', 't', 's', ['Work'], ['b'], None))
+    collection = app.notes_collection.collection
+
+    def first_write_only(operations, ordered=True):
+        collection.bulk_write(operations[:1], ordered=ordered)
+        raise BulkWriteError({'nMatched': 1, 'nModified': 1, 'writeErrors': [{'index': 1, 'errmsg': 'failed'}]})
+    # Set on the instance dict, so undoing it removes the override instead of pinning this test's collection.
+    monkeypatch.setitem(vars(app.notes_collection), 'bulk_write', first_write_only)
+
+    response = bulk(client, (f"{first}:0", True), (f"{second}:0", True))
+    assert response.status_code == 500
+    assert app.tasks_collection.find_one({'_id': f"{first}:0"})['completed'] is True
+    assert app.tasks_collection.find_one({'_id': f"{second}:0"})['completed'] is False
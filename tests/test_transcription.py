@@ -0,0 +1,37 @@
+import pytest
+
+
+@pytest.mark.parametrize('parts, expected', [
+    (['we met to plan the launch of', 'plan the launch of the new app'], 'we met to plan the launch of the new app'),
+    # Case and punctuation differ between the two transcriptions of the overlap.
+    (['Sales were up. Next quarter', 'up, next quarter we hire'], 'Sales were up. Next quarter we hire'),
+    (['one two three', 'two three four', 'three four five'], 'one two three four five'),
+])
+def test_stitch_drops_words_repeated_across_the_overlap(app, parts, expected):
+    assert app.stitch_transcripts(parts) == expected
+
+
+@pytest.mark.parametrize('parts, expected', [
+    (['the meeting ended', 'after lunch we reviewed'], 'the meeting ended after lunch we reviewed'),
+    # One shared word at the boundary is not treated as overlap.
+    (['it went well', 'well enough to ship'], 'it went well well enough to ship'),
+    (['a b', 'c d'], 'a b c d'),
+])
+def test_stitch_keeps_chunks_that_do_not_overlap(app, parts, expected):
+    assert app.stitch_transcripts(parts) == expected
+
+
+@pytest.mark.parametrize('parts, expected', [
+    ([], ''),
+    ([''], ''),
+    (['', 'hello there'], 'hello there'),
+    (['hello there', '', '   '], 'hello there'),
+    (['we met to plan the', '', 'plan the launch'], 'we met to plan the launch'),
+])
+def test_stitch_skips_empty_chunks(app, parts, expected):
+    assert app.stitch_transcripts(parts) == expected
+
+
+def test_stitch_only_looks_at_the_overlap_window(app):
+    repeated = ' '.join(['word'] * 50)
+    assert app.stitch_transcripts([repeated, repeated], max_overlap_words=40) == ' '.join(['word'] * 60)
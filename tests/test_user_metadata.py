@@ -0,0 +1,24 @@
+def test_metadata_put_back_by_a_slow_scan_is_not_served(app, client):
+    app.create_note('alice', 'one', 't', 's', ['Work'], [], None)
+    outdated = app.user_metadata('alice')
+
+    # A write lands while another request is still building the entry it is about to cache.
+    app.create_note('alice', 'two', 't', 's', ['Home'], [], None)
+    app.user_cache.put('alice', outdated)
+
+    metadata = app.user_metadata('alice')
+    assert metadata['note_count'] == 2
+    assert metadata['tags'] == {'Work': 1, 'Home': 1}
+
+
+def test_list_etag_follows_the_stored_version(app, client):
+    app.create_note('alice', 'one', 't', 's', ['Work'], [], None)
+    etag = client.get('/get_user_notes').headers['ETag']
+    outdated = app.user_metadata('alice')
+
+    app.create_note('alice', 'two', 't', 's', ['Work'], [], None)
+    app.user_cache.put('alice', outdated)
+
+    response = client.get('/get_user_notes', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert len(response.get_json()['notes']) == 2